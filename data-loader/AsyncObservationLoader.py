@@ -0,0 +1,808 @@
+"""Coroutine equivalents of the ObservationLoader functions, for running the loader inside an asyncio service, such as
+one accepting pushes from field gateways.  prepare_observations, identify_template, create_template, save_observations
+and send_request take the same arguments as their blocking counterparts and give the same outcomes and ResultTypes,
+but send their requests over the asyncio keep-alive connections of an AsyncSosSession.  Thousands of loads can run at
+once on one event loop, the requests to each endpoint are limited by the session they share, and any load can be
+cancelled.
+
+    async with AsyncObservationLoader.AsyncSosSession(pool_size=8) as session:
+        results = await asyncio.gather(*[AsyncObservationLoader.prepare_observations(
+            push.observations, push.procedure, push.obs_property, push.offering, push.template_metadata, endpoint,
+            session, templates=templates) for push in pushes])
+
+Reading and parsing the observations blocks, so it runs in the default executor of the event loop, a pool of threads
+shared by every load, rather than on the loop itself.
+"""
+import asyncio
+import functools
+import http.client
+import io
+import json
+import logging
+import time
+
+import ObservationLoader as ObLo
+
+
+class AsyncSosSession(ObLo.SosSession):
+    """A SosSession whose post is a coroutine, holding a pool of asyncio keep-alive connections for each SOS endpoint.
+    Every load sharing the session shares the limit of each endpoint, a request over the limit waits on the event loop
+    until one of the endpoint's connections is free.
+
+    Arguments:
+        pool_size:  The maximum number of connections held open to, and requests in flight to, any one endpoint
+        timeout:  The seconds a request may take, from opening or reusing its connection to reading the whole response
+        retry_policy:  The RetryPolicy for requests sent through the session, a default RetryPolicy if not given
+        metrics:  The LoaderMetrics that the requests and loads using the session are recorded in, new LoaderMetrics if
+            not given
+        compression:  The Content-Encoding to compress request bodies with, as for SosSession
+        limits:  An optional dictionary of endpoint URIs to the number of requests in flight to each, for endpoints
+            allowed more or fewer than pool_size
+
+    Note:
+        A request cancelled while it waits on the SOS closes its connection, as the response would otherwise be left
+        unread on it.  The session belongs to the event loop it is first used on.
+    """
+
+    def __init__(self, pool_size=ObLo.DEFAULT_POOL_SIZE, timeout=ObLo.DEFAULT_TIMEOUT, retry_policy=None, metrics=None,
+                 compression=None, limits=None):
+        super(AsyncSosSession, self).__init__(pool_size, timeout, retry_policy, metrics, compression)
+        self.limits = {}
+        for endpoint, limit in (limits or {}).items():
+            if limit < 1:
+                raise ValueError('The limit of an endpoint must be at least one request.')
+            self.limits[self._split_endpoint(endpoint)[0]] = limit
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    async def post(self, endpoint, body, headers):
+        """POST the body to the endpoint over a pooled connection, waiting for one of the endpoint's connections to be
+        free, and read the full response so that the connection can be returned to the pool.
+
+        Arguments:
+            endpoint:  The URI of the SOS server to send the request to
+            body:  The encoded bytes to send
+            headers:  A dictionary of the request headers
+
+        Raises:
+            ValueError:  If the endpoint is not an http or https URI
+            OSError:  If the connection to the endpoint fails or times out
+            http.client.HTTPException:  If the response cannot be read
+
+        Returns:
+            A tuple of (HTTP status code, response charset, response body bytes)
+        """
+        pool_key, path = self._split_endpoint(endpoint)
+        idle, available = self._get_pool(pool_key)
+
+        async with available:
+            # Prefer a connection that is already open, falling back to opening a new one
+            reused = bool(idle)
+            connection = idle.pop() if reused else await self._open_connection(pool_key)
+
+            try:
+                try:
+                    status, message, content, will_close = await self._exchange(connection, pool_key, path, body,
+                                                                                headers, reused)
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                    # The SOS may close an idle keep-alive connection at any time, in which case nothing was processed
+                    #  by the server and the request is sent once more over a fresh connection
+                    connection[1].close()
+                    if not reused:
+                        raise
+                    connection = await self._open_connection(pool_key)
+                    status, message, content, will_close = await self._exchange(connection, pool_key, path, body,
+                                                                                headers, False)
+            except BaseException:
+                # Including a cancelled request, whose response may still arrive on the connection
+                connection[1].close()
+                raise
+
+            if will_close:
+                connection[1].close()
+            else:
+                idle.append(connection)
+
+            return status, message.get_content_charset('utf-8'), content
+
+    def close(self):
+        """Close every idle connection held by the session."""
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools = {}
+
+        for idle, _ in pools:
+            while idle:
+                idle.pop()[1].close()
+
+    async def _exchange(self, connection, pool_key, path, body, headers, reused):
+        reader, writer = connection
+        _, host, port = pool_key
+        lines = ['POST {} HTTP/1.1'.format(path),
+                 'Host: {}'.format(host if port is None else '{}:{}'.format(host, port)),
+                 'Content-Length: {}'.format(len(body))]
+        lines += ['{}: {}'.format(name, value) for name, value in headers.items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        writer.write(body)
+
+        response = await _within(_drain_and_read(reader, writer), self.timeout)
+        with self._lock:
+            self.requests_sent += 1
+            if reused:
+                self.connections_reused += 1
+        return response
+
+    async def _open_connection(self, pool_key):
+        scheme, host, port = pool_key
+        if port is None:
+            port = 443 if scheme == 'https' else 80
+        connection = await _within(asyncio.open_connection(host, port, ssl=True if scheme == 'https' else None),
+                                   self.timeout)
+        with self._lock:
+            self.connections_opened += 1
+        return connection
+
+    def _get_pool(self, pool_key):
+        with self._lock:
+            if pool_key not in self._pools:
+                self._pools[pool_key] = ([], asyncio.Semaphore(self.limits.get(pool_key, self.pool_size)))
+            return self._pools[pool_key]
+
+
+async def _within(awaitable, timeout):
+    """Await within the timeout, raising the builtin TimeoutError, an OSError as a socket timeout would be."""
+
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        raise TimeoutError('The SOS did not answer within {} s.'.format(timeout)) from None
+
+
+async def _drain_and_read(reader, writer):
+    await writer.drain()
+    return await _read_response(reader)
+
+
+async def _read_response(reader):
+    """Read an HTTP/1.1 response from an asyncio StreamReader, with a body of a Content-Length, in chunks, or up to the
+    end of the connection.
+
+    Raises:
+        http.client.HTTPException:  If the response is cut short or is not valid HTTP
+
+    Returns:
+        A tuple of the HTTP status code, the headers as an http.client.HTTPMessage, the body bytes, and whether the
+        server will close the connection
+    """
+
+    try:
+        status_line = await reader.readline()
+        if not status_line:
+            raise http.client.RemoteDisconnected('Remote end closed connection without response')
+        try:
+            version, status = status_line.split(None, 2)[:2]
+            status = int(status)
+        except ValueError:
+            raise http.client.BadStatusLine(status_line.decode('latin-1').strip())
+
+        header_lines = []
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise http.client.IncompleteRead(b''.join(header_lines))
+            header_lines.append(line)
+            if line in (b'\r\n', b'\n'):
+                break
+        message = http.client.parse_headers(io.BytesIO(b''.join(header_lines)))
+
+        connection_header = message.get('Connection', '').lower()
+        will_close = connection_header == 'close' or (version == b'HTTP/1.0' and connection_header != 'keep-alive')
+        if 'chunked' in message.get('Transfer-Encoding', '').lower():
+            parts = []
+            while True:
+                size_line = await reader.readline()
+                try:
+                    size = int(size_line.split(b';', 1)[0], 16)
+                except ValueError:
+                    raise http.client.HTTPException('Invalid chunk size: {!r}'.format(size_line))
+                if size == 0:
+                    break
+                parts.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+
+            # Skip any trailer fields, up to the blank line ending the response
+            while (await reader.readline()).strip():
+                pass
+            content = b''.join(parts)
+        elif message.get('Content-Length') is not None:
+            content = await reader.readexactly(int(message['Content-Length']))
+        elif status in (204, 304) or 100 <= status < 200:
+            content = b''
+        else:
+            content = await reader.read()
+            will_close = True
+    except asyncio.IncompleteReadError as error:
+        raise http.client.IncompleteRead(error.partial, error.expected) from None
+
+    return status, message, content, will_close
+
+
+class AsyncTemplateRegistry(ObLo.TemplateRegistry):
+    """A TemplateRegistry whose resolve and prefill are coroutines, so that loads on an event loop share template
+    lookups.  Two loads needing the same template at once wait for the one looking it up, rather than both trying to
+    create it.
+
+    Arguments:
+        cache_path:  An optional JSON file the templates are kept in between runs
+        max_age:  The number of seconds a template in the cache file is trusted for, after which it is looked up again
+    """
+
+    def __init__(self, cache_path=None, max_age=ObLo.DEFAULT_TEMPLATE_MAX_AGE):
+        super(AsyncTemplateRegistry, self).__init__(cache_path, max_age)
+        self._async_key_locks = {}
+
+    async def resolve(self, procedure, obs_property, offering, template_metadata, endpoint, session=None):
+        """As TemplateRegistry.resolve, as a coroutine.
+
+        Raises:
+            NotImplementedError:  If the template does not exist and cannot be created
+
+        Returns:
+            A tuple of the result template identifier, its result encoding, and whether it was created by this call
+        """
+
+        key = (endpoint, obs_property, offering)
+        key_lock = self._async_key_locks.setdefault(key, asyncio.Lock())
+
+        async with key_lock:
+            template = self._lookup(key)
+            if template is not None:
+                return template[0], template[1], False
+
+            # Attempt to get the URI of the template if it already exists, unless it is known not to
+            if key in self._missing:
+                template_id, result_encoding = False, None
+            else:
+                logging.info("Checking if template already exists.")
+                template_id, result_encoding = await identify_template_encoding(obs_property, offering, endpoint,
+                                                                                session)
+
+            # If the template does not exist, attempt to create one
+            created = template_id is False
+            if created:
+                logging.info("Creating template.")
+                template_id = await create_template(procedure, obs_property, offering, template_metadata, endpoint,
+                                                    session)
+                result_encoding = dict(ObLo.DEFAULT_RESULT_ENCODING)
+
+            self._store(key, template_id, result_encoding)
+            return template_id, result_encoding, created
+
+    async def prefill(self, series, endpoint, session=None):
+        """As TemplateRegistry.prefill, as a coroutine sending every lookup at once, within the limits of the session.
+
+        Arguments:
+            series:  An iterable of (obs_property, offering) tuples
+            endpoint:  The URI of the SOS service that listens for requests
+            session:  An optional AsyncSosSession to send the requests through
+        """
+
+        async def look_up(key):
+            return key, await identify_template_encoding(key[1], key[2], endpoint, session)
+
+        self._store_found(await asyncio.gather(*[look_up(key) for key in self._unknown_keys(series, endpoint)]))
+
+
+async def prepare_observations(observations, procedure, obs_property, offering, template_metadata, endpoint,
+                               session=None, max_in_flight=ObLo.DEFAULT_MAX_IN_FLIGHT, incremental=None,
+                               block_size=None, precision=None, templates=None, chunk_size=ObLo.DEFAULT_CHUNK_SIZE,
+                               journal=False, resume=False, value_dtype=ObLo.VALUE_DTYPES[0], sort_by_time=False,
+                               rollups=(), keep_last=False):
+    """As ObservationLoader.prepare_observations, as a coroutine.  The observations are found a template for, read,
+    checked and sent in the same way, and the outcome is given as the same ResultTypes.
+
+    Arguments:
+        session:  An optional AsyncSosSession to send the requests through, when not given one is created for this
+            call and closed once the observations have been sent
+        templates:  An optional AsyncTemplateRegistry shared between loads, so that a template is only looked up once
+
+        The other arguments are those of ObservationLoader.prepare_observations.
+
+    Note:
+        Cancelling the load cancels the chunks it has in flight.  With a journal, the chunks the SOS answered before
+        then are recorded, so that the load can be resumed.
+    """
+
+    owns_session = session is None
+    if owns_session:
+        session = AsyncSosSession()
+
+    if templates is None:
+        templates = AsyncTemplateRegistry()
+
+    loop = asyncio.get_event_loop()
+    metrics = session.metrics
+    upload_journal = None
+    next_block = None
+    try:
+        ObLo._check_rollup_periods(rollups)
+        if journal or resume:
+            upload_journal = await loop.run_in_executor(None, ObLo.UploadJournal, observations, resume)
+            if upload_journal.committed_rows:
+                logging.info('Resuming the load, {} rows were sent before.'.format(upload_journal.committed_rows))
+
+        # Find the template, creating it if it does not exist, there can be no stored observations for a new template
+        with metrics.phase('template'):
+            template_id, result_encoding, created = await templates.resolve(procedure, obs_property, offering,
+                                                                            template_metadata, endpoint, session)
+        if created:
+            incremental = None
+
+        # The rollups of the periods the series already held observations in are recomputed from the SOS, and the
+        #  stored range is found once, before any block is sent
+        rollup_periods = ObLo._RollupPeriods(rollups) if rollups else None
+        stored_range = None
+        if (incremental is not None or rollup_periods is not None) and not created:
+            with metrics.phase('incremental' if incremental is not None else 'rollup'):
+                stored_range = await get_stored_time_range(procedure, obs_property, offering, endpoint, session)
+
+        # Each block is read in the executor, the next while the one before it is being sent
+        obs_blocks = _observation_blocks(observations, block_size, value_dtype, metrics, sort_by_time, keep_last)
+        next_block = loop.run_in_executor(None, next, obs_blocks, None)
+
+        outcomes = []
+        while True:
+            curr_obs = await next_block
+            if curr_obs is None:
+                break
+            next_block = loop.run_in_executor(None, next, obs_blocks, None)
+
+            read_rows = len(curr_obs)
+            if upload_journal is not None:
+                curr_obs = upload_journal.remove_committed(curr_obs)
+
+            if incremental is not None:
+                logging.info("Drop observations already held by the SOS.")
+                with metrics.phase('incremental'):
+                    curr_obs = await _remove_within_stored_range(curr_obs, stored_range, obs_property, offering,
+                                                                 endpoint, incremental, session, result_encoding)
+            metrics.count('rows_skipped', read_rows - len(curr_obs))
+            if rollup_periods is not None:
+                rollup_periods.add(curr_obs)
+
+            logging.info("Sending observations.")
+            with metrics.phase('send'):
+                outcomes += await save_observations(curr_obs, template_id, endpoint, chunk_size, session,
+                                                    max_in_flight, result_encoding, precision, upload_journal)
+
+        if upload_journal is not None:
+            upload_journal.complete()
+
+        if rollup_periods is not None:
+            logging.info("Sending rollups.")
+            with metrics.phase('rollup'):
+                rollup_outcomes = await _save_rollups(rollup_periods, procedure, obs_property, offering,
+                                                      template_metadata, endpoint, session, templates, stored_range,
+                                                      max_in_flight, chunk_size, result_encoding)
+            logging.info('Rollup observations inserted: {}, rejected: {}.'.format(
+                sum(outcome.inserted for outcome in rollup_outcomes),
+                sum(outcome.rejected for outcome in rollup_outcomes)))
+
+        logging.info('Observations inserted: {}, rejected: {}, using {} requests.'.format(
+            sum(outcome.inserted for outcome in outcomes),
+            sum(outcome.rejected for outcome in outcomes),
+            sum(outcome.requests for outcome in outcomes)))
+        return ObLo.ResultTypes.OBSERVATIONS_OK
+
+    except NotImplementedError:
+        logging.error('The template did not exist and was unable to be registered.')
+        return ObLo.ResultTypes.TEMPLATE_FAILURE
+
+    except ValueError as error:
+        logging.error('The observation CSV column names were not correct, or too many columns, or wrong data type.')
+        logging.error(str(error))
+        return ObLo.ResultTypes.PARSE_FAILURE
+
+    except FileNotFoundError as error:
+        logging.error('The observation file could not be found: {}'.format(error))
+        return ObLo.ResultTypes.PARSE_FAILURE
+
+    except (OSError, http.client.HTTPException, ObLo.SosRequestError) as error:
+        logging.error('The SOS could not be reached: {}'.format(error))
+        return ObLo.ResultTypes.ENDPOINT_FAILURE
+
+    finally:
+        # A block still being read when the load stops is waited for, so that the file is no longer read once the load
+        #  has returned, and any error reading it is retrieved
+        if next_block is not None:
+            await asyncio.gather(next_block, return_exceptions=True)
+        if upload_journal is not None:
+            upload_journal.flush()
+        if owns_session:
+            session.close()
+
+
+def _observation_blocks(observations, block_size, value_dtype, metrics, sort, keep_last=False):
+    """Generate the ObservationArrays of the whole file, or of each block of block_size rows."""
+
+    if block_size is None:
+        yield ObLo.read_observation_arrays(observations, value_dtype, metrics, sort=sort)
+    else:
+        for curr_obs in ObLo.read_observation_blocks(observations, block_size, metrics, sort, keep_last):
+            yield ObLo.ObservationArrays.from_frame(curr_obs, value_dtype)
+
+
+async def identify_template(obs_property, offering, endpoint, session=None):
+    """As ObservationLoader.identify_template, as a coroutine.
+
+    Returns:
+        Either the result template string identifier, or False to indicate not found
+    """
+
+    template_id, _ = await identify_template_encoding(obs_property, offering, endpoint, session)
+    return template_id
+
+
+async def identify_template_encoding(obs_property, offering, endpoint, session=None):
+    """As ObservationLoader.identify_template_encoding, as a coroutine.
+
+    Returns:
+        A tuple of the result template string identifier and its result encoding, or (False, None) if not found
+    """
+
+    result_json = await request_json(ObLo._template_request(obs_property, offering), endpoint, session)
+    return ObLo._found_template(obs_property, offering, result_json)
+
+
+async def create_template(procedure, obs_property, offering, template_metadata, endpoint, session=None):
+    """As ObservationLoader.create_template, as a coroutine.
+
+    Raises:
+        NotImplementedError:  If a template cannot be created/implemented, then this error is raised to indicate it.
+
+    Returns:
+        The result template string identifier
+    """
+
+    template_id, template = ObLo._template_insertion(procedure, obs_property, offering, template_metadata)
+    if await send_request(template, 'acceptedTemplate', True, endpoint, session):
+        return template_id
+    else:
+        raise NotImplementedError("The template could not be created.")
+
+
+async def remove_stored_observations(curr_obs, procedure, obs_property, offering, endpoint, mode, session=None,
+                                     result_encoding=None):
+    """As ObservationLoader.remove_stored_observations, as a coroutine.
+
+    Returns:
+        The observations that are not yet held by the SOS, of the same type as curr_obs
+    """
+
+    stored_range = await get_stored_time_range(procedure, obs_property, offering, endpoint, session)
+    return await _remove_within_stored_range(curr_obs, stored_range, obs_property, offering, endpoint, mode, session,
+                                             result_encoding)
+
+
+async def _remove_within_stored_range(curr_obs, stored_range, obs_property, offering, endpoint, mode, session=None,
+                                      result_encoding=None):
+    """As ObservationLoader._remove_within_stored_range, as a coroutine."""
+
+    if stored_range is None:
+        return curr_obs
+
+    obs_times, within_stored = ObLo._within_stored_range(curr_obs, stored_range)
+    if mode is ObLo.IncrementalModes.TIMESTAMPS and within_stored.any():
+        # Only ask for the stored timestamps where the observations overlap the stored range
+        overlap_times = obs_times[within_stored]
+        stored_times = await get_stored_times(obs_property, offering, endpoint, overlap_times.min(),
+                                              overlap_times.max(), session, result_encoding)
+        within_stored = obs_times.isin(stored_times).values
+
+    logging.info('Skipping {} observations already held by the SOS.'.format(within_stored.sum()))
+    return curr_obs[~within_stored]
+
+
+async def get_stored_time_range(procedure, obs_property, offering, endpoint, session=None):
+    """As ObservationLoader.get_stored_time_range, as a coroutine.
+
+    Returns:
+        A tuple of the first and last stored timestamps, or None if the SOS holds no observations for the series
+    """
+
+    result_json = await request_json(ObLo._availability_request(procedure, obs_property, offering), endpoint, session)
+    return ObLo._stored_time_range(result_json)
+
+
+async def get_stored_times(obs_property, offering, endpoint, start, end, session=None, result_encoding=None):
+    """As ObservationLoader.get_stored_times, as a coroutine.
+
+    Returns:
+        A pandas DatetimeIndex of the stored timestamps, as UTC timestamps without a time zone
+    """
+
+    result_json = await request_json(ObLo._stored_times_request(obs_property, offering, start, end), endpoint,
+                                     session)
+    return ObLo._stored_times(result_json, result_encoding)
+
+
+async def _save_rollups(rollup_periods, procedure, obs_property, offering, template_metadata, endpoint, session,
+                        templates, stored_range, max_in_flight, chunk_size, result_encoding):
+    """As ObservationLoader._save_rollups, as a coroutine fetching the stored observations of every period of a kind
+    that is recomputed at once.
+
+    Returns:
+        A list of ChunkOutcome of the rollups sent
+    """
+
+    outcomes = []
+    for period in rollup_periods.periods:
+        starts, aggregates, runs = rollup_periods.plan(period, stored_range)
+        fetched = await asyncio.gather(*[_fetch_stored_observations(obs_property, offering, endpoint, start, end,
+                                                                    session, result_encoding)
+                                         for start, end in runs])
+        for statistic, rollup_obs in rollup_periods.rollups(period, starts, aggregates, fetched, session).items():
+            rollup_obs_property = ObLo.rollup_property(obs_property, period, statistic)
+            template_id, rollup_encoding, _ = await templates.resolve(
+                procedure, rollup_obs_property, offering,
+                ObLo._rollup_metadata(template_metadata, rollup_obs_property, period, statistic), endpoint, session)
+            outcomes += await save_observations(rollup_obs, template_id, endpoint, chunk_size, session,
+                                                max_in_flight, rollup_encoding)
+    return outcomes
+
+
+async def _fetch_stored_observations(obs_property, offering, endpoint, start, end, session=None, result_encoding=None):
+    """As ObservationLoader._fetch_stored_observations, as a coroutine."""
+
+    request = ObLo._stored_observations_request(obs_property, offering, start, end)
+    status, reply, failure, _ = await _post_body(json.dumps(request).encode('utf-8'), request['request'], endpoint,
+                                                 session)
+    return ObLo._stored_observations(status, reply, failure, start, end, result_encoding)
+
+
+async def save_observations(curr_obs, result_template, endpoint, chunk_size, session=None, max_in_flight=1,
+                            result_encoding=None, precision=None, journal=None):
+    """As ObservationLoader.save_observations, as a coroutine sending up to max_in_flight chunks at once as tasks on
+    the event loop, rather than from a pool of threads.  A chunk is only formatted once a slot is free.
+
+    Note:
+        If a chunk fails, no further chunks are started and those in flight are cancelled before its error is raised,
+        as they are if the save is cancelled.
+
+    Returns:
+        A list of ChunkOutcome, one for each chunk in the order the chunks appear in curr_obs
+    """
+
+    curr_obs = ObLo._as_arrays(curr_obs)
+    result_encoding = result_encoding or ObLo.DEFAULT_RESULT_ENCODING
+    encode = functools.partial(ObLo.encode_result_values,
+                               token_separator=result_encoding['tokenSeparator'],
+                               block_separator=result_encoding['blockSeparator'],
+                               precision=precision)
+    chunk_sizer = chunk_size if isinstance(chunk_size, ObLo.AdaptiveChunkSize) else None
+
+    in_flight = asyncio.Semaphore(max(1, max_in_flight))
+    failed = []
+
+    def release(task):
+        in_flight.release()
+        if not task.cancelled() and task.exception() is not None:
+            failed.append(task)
+
+    tasks = []
+    try:
+        start_offset = 0
+        while start_offset < len(curr_obs):
+            # The slot is taken before the size of the next chunk is chosen, so it reflects the latest responses
+            await in_flight.acquire()
+            if failed:
+                in_flight.release()
+                break
+
+            curr_size = chunk_sizer.next_size() if chunk_sizer is not None else chunk_size
+            task = asyncio.ensure_future(_insert_chunk(curr_obs, start_offset, curr_size, result_template, endpoint,
+                                                       session, encode, chunk_sizer, journal))
+            task.add_done_callback(release)
+            tasks.append(task)
+            start_offset += curr_size
+
+        outcomes = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+    if chunk_sizer is not None and outcomes:
+        logging.info('Adaptive chunk size is now {} observations.'.format(chunk_sizer.size))
+
+    return outcomes
+
+
+async def _insert_chunk(curr_obs, start_offset, chunk_size, result_template, endpoint, session, encode,
+                        chunk_sizer=None, journal=None):
+    """As ObservationLoader._insert_chunk, as a coroutine."""
+
+    curr_results = curr_obs[start_offset:start_offset + chunk_size]
+    stop_offset = start_offset + len(curr_results)
+
+    request_start = time.perf_counter()
+    try:
+        inserted, payload_bytes, retries = await _send_results(curr_results, result_template, endpoint, session,
+                                                               encode)
+    except Exception:
+        if chunk_sizer is not None:
+            chunk_sizer.record(len(curr_results), time.perf_counter() - request_start, 0, failed=True)
+        raise
+
+    if inserted:
+        logging.info('Result observations inserted OK.')
+        if chunk_sizer is not None:
+            chunk_sizer.record(len(curr_results), time.perf_counter() - request_start, payload_bytes,
+                               failed=retries > 0)
+        ObLo._commit_chunk(journal, curr_results)
+        ObLo._count_chunk(session, len(curr_results), 0, 0)
+        return ObLo.ChunkOutcome(start_offset, stop_offset, len(curr_results), 0, 1)
+
+    # The chunk was rejected for holding observations already stored in the SOS, so it is bisected
+    logging.info('Failed batch insert of between: {} and {}.'.format(start_offset, stop_offset))
+    inserted, rejected, requests = await _bisect_results(curr_results, result_template, endpoint, session, encode)
+    logging.info('Isolated {} rejected observations between: {} and {}, using {} requests.'.format(
+        rejected, start_offset, stop_offset, requests))
+
+    ObLo._commit_chunk(journal, curr_results)
+    ObLo._count_chunk(session, inserted, rejected, requests)
+    return ObLo.ChunkOutcome(start_offset, stop_offset, inserted, rejected, 1 + requests)
+
+
+async def _bisect_results(curr_results, result_template, endpoint, session, encode):
+    """As ObservationLoader._bisect_results, as a coroutine.
+
+    Returns:
+        A tuple of the number of observations inserted, the number rejected, and the number of requests sent
+    """
+
+    if len(curr_results) == 1:
+        return 0, 1, 0
+
+    half = len(curr_results) // 2
+    inserted, rejected, requests = 0, 0, 0
+    right_known_rejected = False
+
+    for curr_half in (curr_results[:half], curr_results[half:]):
+        if right_known_rejected:
+            half_inserted, half_rejected, half_requests = await _bisect_results(curr_half, result_template, endpoint,
+                                                                                session, encode)
+        elif (await _send_results(curr_half, result_template, endpoint, session, encode))[0]:
+            half_inserted, half_rejected, half_requests = len(curr_half), 0, 1
+            right_known_rejected = True
+        else:
+            half_inserted, half_rejected, half_requests = await _bisect_results(curr_half, result_template, endpoint,
+                                                                                session, encode)
+            half_requests += 1
+
+        inserted += half_inserted
+        rejected += half_rejected
+        requests += half_requests
+
+    return inserted, rejected, requests
+
+
+async def _send_results(curr_results, result_template, endpoint, session, encode):
+    """As ObservationLoader._send_results, as a coroutine.
+
+    Returns:
+        A tuple of whether the observations were inserted, the length of the request body before any compression,
+        and the number of times the request was sent again
+    """
+
+    with ObLo._metrics_of(session).phase('encode'):
+        body = ObLo._insert_result_body(result_template, encode(curr_results))
+
+    status, reply, failure, retries = await _post_body(body, 'InsertResult', endpoint, session)
+    if failure is ObLo.FailureTypes.FATAL:
+        raise ObLo.SosRequestError('The SOS refused the InsertResult request with status {}: {}'.format(
+            status, reply), failure, status)
+
+    return failure is None, len(body), retries
+
+
+async def send_request(data, target_key, key_status, endpoint, session=None):
+    """As ObservationLoader.send_request, as a coroutine.
+
+    Returns:
+        Boolean value to indicate whether the target_key corresponded to the key_status when analyzing the return from
+        the server.
+    """
+
+    result_json = await request_json(data, endpoint, session)
+    return result_json is not None and (target_key in result_json) is key_status
+
+
+async def request_json(data, endpoint, session=None):
+    """As ObservationLoader.request_json, as a coroutine.
+
+    Raises:
+        SosRequestError:  If the request failed transiently through every retry
+
+    Returns:
+        The object decoded from the JSON response, or None if the server returned an error status
+    """
+
+    status, reply, _, _ = await _post_body(json.dumps(data).encode('utf-8'), data.get('request', 'unknown'),
+                                           endpoint, session)
+    if not 200 <= status < 300:
+        return None
+    return reply
+
+
+async def _post_body(body, operation, endpoint, session=None):
+    """As ObservationLoader._post_body, as a coroutine pausing on the event loop between retries.  Without a session
+    the request is sent through one of its own.
+
+    Returns:
+        A tuple of the HTTP status, the decoded JSON reply or None, the FailureTypes of a failure or None, and the
+        number of times the request was sent again
+    """
+
+    if session is None:
+        async with AsyncSosSession() as session:
+            return await _post_body(body, operation, endpoint, session)
+
+    retry_policy = session.retry_policy
+    metrics = session.metrics
+
+    attempt = 0
+    while True:
+        try:
+            retry_policy.check(endpoint)
+        except ObLo.SosRequestError:
+            metrics.count('breaker_refusals')
+            raise
+
+        # Create the custom header for the JSON content, compressing the body if the endpoint accepts it
+        custom_header = {'Content-Type': 'application/json'}
+        content_encoding = session.content_encoding(endpoint)
+        data = body
+        if content_encoding is not None:
+            custom_header['Content-Encoding'] = content_encoding
+            data = ObLo._compress(body, content_encoding)
+            metrics.count('bytes_before_compression', len(body))
+
+        request_start = time.perf_counter()
+        try:
+            metrics.count('bytes_sent', len(data))
+            status, result_encoding, content = await session.post(endpoint, data, custom_header)
+            metrics.observe_request(operation, time.perf_counter() - request_start)
+            try:
+                reply = json.loads(content.decode(result_encoding))
+            except ValueError:
+                reply = None
+            failure = ObLo.classify_failure(status, reply)
+            reason = 'status {}'.format(status)
+        except (OSError, http.client.HTTPException) as error:
+            # The connection failed or timed out, or the response was cut short
+            status, reply, failure = None, None, ObLo.FailureTypes.TRANSIENT
+            reason = repr(error)
+
+        if content_encoding is not None and failure is not ObLo.FailureTypes.TRANSIENT:
+            if session.compression_answered(endpoint, not ObLo._compression_refused(status, reply, failure)):
+                continue
+
+        retry_policy.record(endpoint, failure)
+        if failure is not ObLo.FailureTypes.TRANSIENT:
+            return status, reply, failure, attempt
+
+        if attempt >= retry_policy.retries:
+            raise ObLo.SosRequestError('The request failed {} times, last with {}.'.format(attempt + 1, reason),
+                                       failure, status)
+
+        metrics.count('retries')
+        delay = retry_policy.delay(attempt)
+        logging.warning('Request to {} failed with {}, sending it again in {:.1f} s.'.format(endpoint, reason, delay))
+        await asyncio.sleep(delay)
+        attempt += 1
@@ -0,0 +1,298 @@
+"""Export the observations a SOS holds for a series to a CSV, Parquet, Arrow or Feather file, in the format the loader
+reads, so an exported series can be loaded again.  The template of the series is found as ObservationLoader finds it,
+from its observed property and offering.  Its time range is split into windows, each fetched with a GetResult
+request, several at once, and written in time order as it arrives, so neither the SOS nor the exporter holds the whole
+series at once.
+
+    python ObservationExporter.py http://www.52north.org/test/procedure/9
+        http://www.52north.org/test/observableProperty/9_3 http://www.52north.org/test/offering/9
+        http://127.0.0.1:8080/observations/service series.parquet --window 7D --max-in-flight 4
+"""
+import argparse
+import collections
+import http.client
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import ObservationLoader as ObLo
+
+
+# The length of time fetched by each GetResult request by default, as a pandas timedelta string
+DEFAULT_WINDOW = '7D'
+# The suffix of the file an export is written to until it is complete
+PARTIAL_SUFFIX = '.part'
+
+
+def export_observations(procedure, obs_property, offering, endpoint, output, session=None, start=None, end=None,
+                        window=DEFAULT_WINDOW, max_in_flight=ObLo.DEFAULT_MAX_IN_FLIGHT,
+                        value_dtype=ObLo.VALUE_DTYPES[0]):
+    """Export the observations of a series between two times to a file, fetching the time range a window at a time
+    with up to max_in_flight GetResult requests in flight.
+
+    Arguments:
+        procedure:  The procedure URI, used to find the stored time range when start or end is not given
+        obs_property:  The property being observed
+        offering:  The offering the procedure and property are under
+        endpoint:  The URI of the SOS service that listens for requests
+        output:  The path of the file to write, a CSV file unless its extension is one of ObLo.COLUMNAR_FORMATS
+        session:  An optional SosSession to send the requests through, when not given one is created for this call
+        start:  The first time to export, by default the first stored observation, taken as UTC without a time zone
+        end:  The last time to export, by default the last stored observation, taken as UTC without a time zone
+        window:  The length of time fetched by each request, as a pandas Timedelta or a string of one
+        max_in_flight:  The number of GetResult requests that may be in flight at once, which is also the most windows
+            held in memory
+        value_dtype:  The type the values are held and written as, one of ObLo.VALUE_DTYPES
+
+    Note:
+        The file is written with a PARTIAL_SUFFIX until every window has been fetched, and only then renamed to output,
+        so a failed export leaves no file that looks complete.  The timestamps are written to the second, as the
+        loader sends them.
+
+    Returns:
+        The ResultTypes of the export
+    """
+
+    owns_session = session is None
+    if owns_session:
+        session = ObLo.SosSession()
+
+    metrics = session.metrics
+    partial = os.fspath(output) + PARTIAL_SUFFIX
+    try:
+        with metrics.phase('template'):
+            template_id, result_encoding = ObLo.identify_template_encoding(obs_property, offering, endpoint, session)
+        if not template_id:
+            logging.error('The SOS holds no result template for {} and {}.'.format(obs_property, offering))
+            return ObLo.ResultTypes.TEMPLATE_FAILURE
+
+        if start is None or end is None:
+            stored_range = ObLo.get_stored_time_range(procedure, obs_property, offering, endpoint, session)
+            if stored_range is None:
+                stored_range = (None, None)
+            start = stored_range[0] if start is None else start
+            end = stored_range[1] if end is None else end
+        windows = time_windows(start, end, window) if start is not None and end is not None else []
+        logging.info('Exporting {} windows of {} from {} to {}.'.format(len(windows), window, start, end))
+
+        writer = _open_writer(partial, os.fspath(output), value_dtype)
+        exported = 0
+        try:
+            for curr_obs in _fetched_windows(windows, obs_property, offering, endpoint, session, result_encoding,
+                                             max_in_flight, value_dtype):
+                with metrics.phase('write'):
+                    writer.write(curr_obs)
+                exported += len(curr_obs)
+        finally:
+            writer.close()
+        os.replace(partial, output)
+
+        metrics.count('rows_exported', exported)
+        logging.info('Observations exported: {}, using {} requests.'.format(exported, len(windows)))
+        return ObLo.ResultTypes.OBSERVATIONS_OK
+
+    except ValueError as error:
+        logging.error('The export could not be written: {}'.format(error))
+        return ObLo.ResultTypes.PARSE_FAILURE
+
+    except (OSError, http.client.HTTPException, ObLo.SosRequestError) as error:
+        logging.error('The SOS could not be reached: {}'.format(error))
+        return ObLo.ResultTypes.ENDPOINT_FAILURE
+
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+        if owns_session:
+            session.close()
+
+
+def time_windows(start, end, window=DEFAULT_WINDOW):
+    """Split the time range from start to end, both included, into consecutive windows.
+
+    Arguments:
+        start:  The first time of the range
+        end:  The last time of the range
+        window:  The length of each window, as a pandas Timedelta or a string of one
+
+    Raises:
+        ValueError:  If the window is not a positive length of time
+
+    Returns:
+        A list of (start, end) pandas Timestamps, as UTC without a time zone, each window including its start and all
+        but the last excluding its end
+    """
+
+    window = pd.Timedelta(window)
+    if window <= pd.Timedelta(0):
+        raise ValueError('The export window must be a positive length of time: {}'.format(window))
+
+    start, end = (ObLo._to_utc_times([time])[0] for time in (start, end))
+    bounds = list(pd.date_range(start, end, freq=window))
+    if len(bounds) == 1 or bounds[-1] < end:
+        bounds.append(end)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def fetch_window(obs_property, offering, endpoint, window_start, window_end, last=False, session=None,
+                 result_encoding=None, value_dtype=ObLo.VALUE_DTYPES[0]):
+    """Fetch the observations of a template within a window of time with a GetResult request.
+
+    Arguments:
+        obs_property:  The property being observed
+        offering:  The offering the procedure and property are under
+        endpoint:  The URI of the SOS service that listens for requests
+        window_start:  The first time of the window
+        window_end:  The end of the window, which is only included if last is true
+        last:  Whether this is the last window of a range, which includes its end
+        session:  An optional SosSession to send the request through
+        result_encoding:  The tokenSeparator and blockSeparator of the template, defaults to DEFAULT_RESULT_ENCODING
+        value_dtype:  The type to hold the values as, one of ObLo.VALUE_DTYPES
+
+    Raises:
+        SosRequestError:  If the SOS answers with an error, or fails transiently through every retry
+
+    Returns:
+        The ObservationArrays of the window in time order
+    """
+
+    metrics = ObLo._metrics_of(session)
+    with metrics.phase('fetch'):
+        status, reply, failure = ObLo._post_json(ObLo._stored_times_request(obs_property, offering, window_start,
+                                                                            window_end), endpoint, session)
+    if not 200 <= status < 300:
+        raise ObLo.SosRequestError('GetResult from {} to {} failed with status {}: {}'.format(
+            window_start, window_end, status, reply), failure, status)
+
+    result_encoding = result_encoding or ObLo.DEFAULT_RESULT_ENCODING
+    with metrics.phase('decode'):
+        curr_obs = ObLo.decode_result_arrays((reply or {}).get('resultValues') or '', result_encoding['tokenSeparator'],
+                                             result_encoding['blockSeparator'], value_dtype)
+
+        # The request reaches a second either side of the window, as the SOS may not include the ends of its filter
+        first, final = np.array([window_start, window_end], dtype='datetime64[s]').view(np.int64)
+        within = (curr_obs.times >= first) & ((curr_obs.times <= final) if last else (curr_obs.times < final))
+        curr_obs = ObLo.remove_duplicate_observations(curr_obs if within.all() else curr_obs[within], sort=True)
+    metrics.count('windows')
+    return curr_obs
+
+
+def _fetched_windows(windows, obs_property, offering, endpoint, session, result_encoding, max_in_flight,
+                     value_dtype):
+    """Fetch the windows up to max_in_flight at a time, generating their ObservationArrays in window order."""
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        pending = collections.deque()
+        try:
+            for number, (window_start, window_end) in enumerate(windows):
+                pending.append(executor.submit(fetch_window, obs_property, offering, endpoint, window_start,
+                                               window_end, number == len(windows) - 1, session, result_encoding,
+                                               value_dtype))
+                if len(pending) >= max_in_flight:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # Windows not yet started are not fetched once the export has failed
+            for future in pending:
+                future.cancel()
+
+
+def _open_writer(path, output, value_dtype):
+    """Open a writer of observations to path, in the format of the output's extension."""
+
+    file_format = ObLo._columnar_format(output)
+    if file_format is None:
+        return _CsvWriter(path)
+    return _ColumnarWriter(path, file_format, output.lower().endswith('.arrows'), value_dtype)
+
+
+class _CsvWriter(object):
+    """Writes observations as an observation CSV file, a block at a time."""
+
+    def __init__(self, path):
+        self._file = open(path, 'w', newline='')
+        self._file.write('datetime,value\n')
+
+    def write(self, curr_obs):
+        if len(curr_obs):
+            self._file.write(ObLo.encode_result_values(curr_obs, ',', '\n') + '\n')
+
+    def close(self):
+        self._file.close()
+
+
+class _ColumnarWriter(object):
+    """Writes observations as a Parquet file with a row group for each block, or as an Arrow file or stream, or a
+    Feather file, with a record batch for each block."""
+
+    def __init__(self, path, file_format, stream, value_dtype):
+        pa = ObLo._import_pyarrow()
+        self._pa = pa
+        self._schema = pa.schema([('datetime', pa.timestamp('s')),
+                                  ('value', pa.from_numpy_dtype(np.dtype(value_dtype)))])
+        if file_format == 'parquet':
+            self._writer = pa.parquet.ParquetWriter(path, self._schema)
+        elif stream:
+            self._writer = pa.ipc.new_stream(path, self._schema)
+        else:
+            self._writer = pa.ipc.new_file(path, self._schema)
+
+    def write(self, curr_obs):
+        if len(curr_obs):
+            self._writer.write_batch(self._pa.record_batch([self._pa.array(curr_obs.datetimes),
+                                                            self._pa.array(curr_obs.values)], schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+
+
+def main(arguments):
+    """Export the series given on the command line.
+
+    Arguments:
+        arguments:  The command line arguments, without the script name
+
+    Returns:
+        The ResultTypes of the export
+    """
+
+    parser = argparse.ArgumentParser(description='Export the observations of a series from a SOS.')
+    parser.add_argument('procedure')
+    parser.add_argument('obs_property')
+    parser.add_argument('offering')
+    parser.add_argument('endpoint')
+    parser.add_argument('output', help='the file to write, CSV unless named .parquet, .arrow or .feather')
+    parser.add_argument('--start', help='the first time to export, by default the first stored observation')
+    parser.add_argument('--end', help='the last time to export, by default the last stored observation')
+    parser.add_argument('--window', default=DEFAULT_WINDOW,
+                        help='the length of time fetched by each request, such as 12h or 7D')
+    parser.add_argument('--max-in-flight', type=int, default=ObLo.DEFAULT_MAX_IN_FLIGHT,
+                        help='the number of requests in flight at once')
+    parser.add_argument('--timeout', type=float, default=ObLo.DEFAULT_TIMEOUT,
+                        help='the seconds to wait for each response')
+    parser.add_argument('--retries', type=int, default=ObLo.DEFAULT_RETRIES,
+                        help='the number of times a request that fails transiently is sent again')
+    parser.add_argument('--value-dtype', choices=ObLo.VALUE_DTYPES, default=ObLo.VALUE_DTYPES[0],
+                        help='write the values as float32 rather than float64, to a columnar file')
+    parser.add_argument('--metrics-json', help='a file to write a JSON summary of the timings and counts of the export')
+    args = parser.parse_args(arguments)
+
+    metrics = ObLo.LoaderMetrics()
+    session = ObLo.SosSession(pool_size=max(args.max_in_flight, ObLo.DEFAULT_POOL_SIZE), timeout=args.timeout,
+                              retry_policy=ObLo.RetryPolicy(args.retries), metrics=metrics)
+    try:
+        return export_observations(args.procedure, args.obs_property, args.offering, args.endpoint, args.output,
+                                   session, args.start, args.end, args.window, args.max_in_flight, args.value_dtype)
+    finally:
+        session.close()
+        if args.metrics_json:
+            metrics.write_json(args.metrics_json)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main(sys.argv[1:]).value)
@@ -1,12 +1,135 @@
+import argparse
+import contextlib
+import cProfile
 from enum import Enum, unique
+import functools
+import gzip
+import hashlib
+import http.client
+import io
 import json
 import logging
+import multiprocessing
+import os
+import queue
+import random
+import re
+import shutil
+import signal
 import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import urllib.parse
 import urllib.request
 from urllib.error import HTTPError
+import zlib
+import numpy as np
 import pandas as pd
 
 
+# The number of keep-alive connections held open to any one SOS endpoint
+DEFAULT_POOL_SIZE = 4
+# The number of seconds to wait on a socket before giving up on the SOS
+DEFAULT_TIMEOUT = 300
+# The number of InsertResult chunks sent concurrently by default.  Each request in flight holds a database connection
+#  within the SOS, and postgresql-node/sos-4-4-1/settings.sql sets max_connections = 10, which is shared with the SOS's
+#  own reads and any other clients, so this is kept well below it
+DEFAULT_MAX_IN_FLIGHT = 4
+# The number of requests in flight from every process of a multi-process load together, by default the max_connections
+#  of postgresql-node/sos-4-4-1/settings.sql, the database that docker-compose.yml builds
+DEFAULT_GLOBAL_IN_FLIGHT = 10
+# The number of observations sent in each InsertResult chunk by default
+DEFAULT_CHUNK_SIZE = 200
+# The number of seconds a template held in a template cache file is used for before it is looked up again
+DEFAULT_TEMPLATE_MAX_AGE = 7 * 24 * 60 * 60
+
+# The suffix of the journal kept beside an observation file while it is loaded
+JOURNAL_SUFFIX = '.journal'
+# The least number of seconds between writes of a journal, so that small chunks do not each wait on the disk
+DEFAULT_JOURNAL_INTERVAL = 1.0
+
+# The suffix of the state kept beside an observation file that is being followed as it grows
+FOLLOW_SUFFIX = '.follow'
+# The number of seconds between polls of the files being followed
+DEFAULT_POLL_INTERVAL = 10.0
+# The most bytes of a followed file read at each poll, so that starting to follow a large file is done a part at a time
+FOLLOW_READ_BYTES = 16 * 2 ** 20
+# The most leading bytes of a followed file whose checksum is kept, to tell a new file that has been given the inode of
+#  the one it replaced
+FOLLOW_FINGERPRINT_BYTES = 4096
+
+# The number of times a request that fails transiently is sent again, and the seconds waited before the first retry,
+#  which doubles with each retry up to MAX_BACKOFF
+DEFAULT_RETRIES = 4
+DEFAULT_BACKOFF = 0.5
+MAX_BACKOFF = 30.0
+# The number of transient failures in a row after which requests to an endpoint are stopped, and the seconds they are
+#  stopped for
+DEFAULT_BREAKER_THRESHOLD = 5
+DEFAULT_BREAKER_RESET = 30.0
+# The HTTP statuses of a server that is overloaded or restarting, and likely to answer if asked again
+TRANSIENT_STATUSES = frozenset([408, 429, 502, 503, 504])
+# The SOS exception text of a request holding observations that are already stored.  The SOS does not include stack
+#  traces in its exception reports (misc.includeStackTraceInExceptionReport), so only the message can be matched.  Its
+#  "Insert result into database failed!" prefix is given for any database error, so only the cause is matched.
+DUPLICATE_EXCEPTION_PATTERN = re.compile(r'already exists|duplicate|unique constraint|constraintviolation',
+                                         re.IGNORECASE)
+# The SOS exception text of a request that failed on a resource within the SOS, such as its database connections
+TRANSIENT_EXCEPTION_PATTERN = re.compile(r'too many clients|connection pool|could not (?:open|get|obtain|acquire)\b.*'
+                                         r'connection|timed out|timeout|deadlock|temporarily unavailable',
+                                         re.IGNORECASE)
+
+# The Content-Encodings request bodies can be compressed with, and the compression level used
+CONTENT_ENCODINGS = ('gzip', 'deflate')
+COMPRESSION_LEVEL = 6
+# The SOS exception text of a request body that could not be read, as when it was compressed and not decompressed
+UNREADABLE_REQUEST_PATTERN = re.compile(r'decod|pars|json|content.?encoding|media type', re.IGNORECASE)
+# The control characters, which like quotes and backslashes cannot appear unescaped within a JSON string
+JSON_CONTROL_CHARACTERS = bytes(range(32))
+
+# The upper bounds in seconds of the buckets of the request latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# The prefix of the metric names written to a Prometheus textfile
+METRICS_PREFIX = 'sos_loader'
+
+# The separators used to encode the result values of the templates this script creates
+DEFAULT_RESULT_ENCODING = {"tokenSeparator": ",", "blockSeparator": "#"}
+# The format of the observation timestamps, both in the observation files and in the result values
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+# The columns of a manifest entry, besides the template metadata
+MANIFEST_KEYS = ('observations', 'procedure', 'obs_property', 'offering')
+
+# The types the observation file columns are parsed to as the file is read
+OBSERVATION_DTYPES = {'datetime': str, 'value': 'float64'}
+# The types observation values can be held as once read, the first being the default
+VALUE_DTYPES = ('float64', 'float32')
+# The number of rows of a whole file parsed at a time, which bounds the memory held by its timestamp strings
+READ_BLOCK_SIZE = 250000
+# The extensions of the columnar observation files, read with pyarrow rather than as CSV, and the format of each
+COLUMNAR_FORMATS = {'.parquet': 'parquet', '.pq': 'parquet', '.arrow': 'arrow', '.arrows': 'arrow', '.ipc': 'arrow',
+                    '.feather': 'feather'}
+# The number of offending rows reported when an observation file does not parse
+MAX_REPORTED_ROWS = 5
+
+# The periods a series can be rolled up over, and the numpy datetime unit the start of each is found with
+ROLLUP_PERIODS = {'daily': 'D', 'monthly': 'M'}
+# The statistics of each period, each sent as a companion series of its own
+ROLLUP_STATISTICS = ('mean', 'min', 'max', 'count')
+# The unit of measure of the count rollups
+ROLLUP_COUNT_UNIT = '{count}'
+# The most periods of stored observations fetched by one GetResult request when rollups are recomputed
+ROLLUP_FETCH_PERIODS = 31
+
+# The result of inserting a chunk of observations, the rows between start (inclusive) and stop (exclusive) of the
+#  chunk, the number of them inserted and rejected, and the number of InsertResult requests it took
+ChunkOutcome = namedtuple('ChunkOutcome', ['start', 'stop', 'inserted', 'rejected', 'requests'])
+
+
 # Define the meaning of the different result values
 @unique
 class ResultTypes(Enum):
@@ -17,334 +140,3696 @@ class ResultTypes(Enum):
     PARSE_FAILURE = 4
 
 
-def prepare_observations(observations, procedure, obs_property, offering, template_metadata, endpoint):
-    """Main entrypoint, takes in all the necessary parameters to save a set of observations.  It
-    identifies a suitable result template at the endpoint if it exists, or creates one where
-    necessary, then attempts to upload the observations as a set of results under the template.  It
-    removes duplicate entries within the provided observations file, and doesn't provide feedback when
-    individual observations cannot be uploaded due to an already saved observation being within the server.
+# Define how observations already held by the SOS are found when loading incrementally
+@unique
+class IncrementalModes(Enum):
+    # Skip every observation within the phenomenon time range the SOS holds for the series, a single request
+    RANGE = 1
+    # Skip only the observations whose timestamps the SOS holds, fetching those within the overlapping time range
+    TIMESTAMPS = 2
+
+
+# Define how a failed request is handled
+@unique
+class FailureTypes(Enum):
+    # Some of the observations sent are already stored, the rest are found by bisection
+    DUPLICATE = 1
+    # The SOS or the network was briefly unable to answer, the request is sent again after a pause
+    TRANSIENT = 2
+    # The request cannot succeed however often it is sent, and the load is stopped
+    FATAL = 3
+
+
+class ObservationParseError(ValueError):
+    """Raised when an observation file does not conform to the expected columns and types.
+
+    Arguments:
+        message:  The description of the problem
+        rows:  The line numbers in the file of the first offending rows, if known
+    """
+
+    def __init__(self, message, rows=()):
+        self.rows = list(rows)
+        if self.rows:
+            message += '  First offending rows: {}.'.format(', '.join(str(row) for row in self.rows))
+        super(ObservationParseError, self).__init__(message)
+
+
+class SosRequestError(Exception):
+    """Raised when a request to the SOS fails in a way that stops the load, either a fatal failure, or a transient
+    failure that continued through every retry.
+
+    Arguments:
+        message:  A description of the failure
+        failure:  The FailureTypes of the failure
+        status:  The HTTP status of the response, or None if there was no response
+    """
+
+    def __init__(self, message, failure, status=None):
+        self.failure = failure
+        self.status = status
+        super(SosRequestError, self).__init__(message)
+
+
+class SosSession(object):
+    """Holds a pool of persistent keep-alive HTTP connections for each SOS endpoint it is used against, so that the
+    template discovery and every InsertResult chunk of a load share TCP connections rather than opening a new one per
+    request.  The session is thread safe, a caller blocks until one of the pool_size connections is free.
+
+    Arguments:
+        pool_size:  The maximum number of connections held open to a single endpoint
+        timeout:  The socket timeout in seconds for each connection
+        retry_policy:  The RetryPolicy for requests sent through the session, a default RetryPolicy if not given
+        metrics:  The LoaderMetrics that the requests and loads using the session are recorded in, new LoaderMetrics if
+            not given
+        compression:  The Content-Encoding to compress request bodies with, one of CONTENT_ENCODINGS, or a dictionary
+            of them by endpoint, by default bodies are sent uncompressed
+        governor:  An optional semaphore shared with the sessions of other processes, such as a multiprocessing
+            BoundedSemaphore, that is held for each request so that together they keep no more requests in flight than
+            its value
+
+    Note:
+        The SOS's servlet container may not accept compressed request bodies, so until an endpoint has answered a
+        compressed request it is on probation.  If it refuses one, with a 415 Unsupported Media Type, a failure without
+        an SOS exception report, or an exception saying the request could not be read, the request is sent again
+        uncompressed and the endpoint is no longer sent compressed bodies.
+
+    Note:
+        The counters connections_opened, connections_reused and requests_sent can be used to check that connections
+        are being reused, on a healthy load connections_opened should stay at or below pool_size.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, retry_policy=None, metrics=None,
+                 compression=None, governor=None):
+        if pool_size < 1:
+            raise ValueError('The pool size must be at least one connection.')
+
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.metrics = metrics or LoaderMetrics()
+        self.compression = compression
+        self.governor = governor
+        for content_encoding in (compression.values() if isinstance(compression, dict) else [compression]):
+            if content_encoding not in CONTENT_ENCODINGS + (None,):
+                raise ValueError('Request bodies can only be compressed with: {}'.format(', '.join(CONTENT_ENCODINGS)))
+
+        # The endpoints that have answered a compressed request, and those that have refused one
+        self._compression_accepted = set()
+        self._compression_refused = set()
+        self.connections_opened = 0
+        self.connections_reused = 0
+        self.requests_sent = 0
+
+        # Each endpoint (scheme, host, port) has a stack of idle connections, and a semaphore limiting open connections
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def post(self, endpoint, body, headers):
+        """POST the body to the endpoint over a pooled connection, and read the full response so that the connection
+        can be returned to the pool.
+
+        Arguments:
+            endpoint:  The URI of the SOS server to send the request to
+            body:  The encoded bytes to send
+            headers:  A dictionary of the request headers
+
+        Raises:
+            ValueError:  If the endpoint is not an http or https URI
+            OSError:  If the connection to the endpoint fails
+
+        Returns:
+            A tuple of (HTTP status code, response charset, response body bytes)
+        """
+        pool_key, path = self._split_endpoint(endpoint)
+        idle, available = self._get_pool(pool_key)
+
+        available.acquire()
+        if self.governor is not None:
+            with self.metrics.phase('governor'):
+                self.governor.acquire()
+        try:
+            # Prefer a connection that is already open, falling back to opening a new one
+            try:
+                connection = idle.get_nowait()
+                reused = True
+            except queue.Empty:
+                connection = self._open_connection(pool_key)
+                reused = False
+
+            try:
+                response = self._send(connection, path, body, headers, reused)
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # The SOS may close an idle keep-alive connection at any time, in which case nothing was processed by
+                #  the server and the request is sent once more over a fresh connection
+                connection.close()
+                if not reused:
+                    raise
+                connection = self._open_connection(pool_key)
+                response = self._send(connection, path, body, headers, False)
+            except Exception:
+                connection.close()
+                raise
+
+            status = response.status
+            charset = response.msg.get_content_charset('utf-8')
+            try:
+                content = response.read()
+            except Exception:
+                connection.close()
+                raise
+
+            if response.will_close:
+                connection.close()
+            else:
+                idle.put(connection)
+
+            return status, charset, content
+        finally:
+            if self.governor is not None:
+                self.governor.release()
+            available.release()
+
+    def content_encoding(self, endpoint):
+        """Return the Content-Encoding to compress request bodies to the endpoint with, or None to send them as they
+        are."""
+
+        content_encoding = self.compression.get(endpoint) if isinstance(self.compression, dict) else self.compression
+        with self._lock:
+            if endpoint in self._compression_refused:
+                return None
+        return content_encoding
+
+    def compression_answered(self, endpoint, accepted):
+        """Record whether the endpoint accepted a compressed request body.
+
+        Returns:
+            True if the endpoint is now known to refuse compressed bodies, and the request should be sent again
+        """
+
+        with self._lock:
+            if accepted:
+                self._compression_accepted.add(endpoint)
+                return False
+            if endpoint in self._compression_accepted:
+                return False
+            self._compression_refused.add(endpoint)
+
+        logging.info('The SOS at {} does not accept compressed requests, they are sent uncompressed.'.format(endpoint))
+        return True
+
+    def close(self):
+        """Close every idle connection held by the session."""
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools = {}
+
+        for idle, _ in pools:
+            while True:
+                try:
+                    idle.get_nowait().close()
+                except queue.Empty:
+                    break
+
+    def _send(self, connection, path, body, headers, reused):
+        connection.request('POST', path, body=body, headers=headers)
+        response = connection.getresponse()
+        with self._lock:
+            self.requests_sent += 1
+            if reused:
+                self.connections_reused += 1
+        return response
+
+    def _open_connection(self, pool_key):
+        scheme, host, port = pool_key
+        if scheme == 'https':
+            connection = http.client.HTTPSConnection(host, port, timeout=self.timeout)
+        else:
+            connection = http.client.HTTPConnection(host, port, timeout=self.timeout)
+        with self._lock:
+            self.connections_opened += 1
+        return connection
+
+    def _get_pool(self, pool_key):
+        with self._lock:
+            if pool_key not in self._pools:
+                self._pools[pool_key] = (queue.LifoQueue(), threading.BoundedSemaphore(self.pool_size))
+            return self._pools[pool_key]
+
+    @staticmethod
+    def _split_endpoint(endpoint):
+        parts = urllib.parse.urlsplit(endpoint)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError('The endpoint must be an http or https URI: {}'.format(endpoint))
+
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        return (parts.scheme, parts.hostname, parts.port), path
+
+
+class RetryPolicy(object):
+    """Decides whether a request that failed transiently is sent again, pausing for a jittered exponential backoff
+    between attempts, and keeps a circuit breaker for each endpoint, so that once breaker_threshold transient failures
+    have happened in a row the requests to that endpoint fail at once for breaker_reset seconds, rather than adding to
+    the load of an SOS that is already struggling.  It is thread safe.
+
+    Arguments:
+        retries:  The number of times a request is sent again before its failure is raised
+        backoff:  The seconds waited before the first retry, doubling with each further retry
+        max_backoff:  The most seconds waited before any retry
+        breaker_threshold:  The number of transient failures in a row that opens the breaker of an endpoint
+        breaker_reset:  The seconds the breaker stays open for
+
+    Note:
+        Once breaker_reset seconds have passed requests are let through again, the first to succeed closes the breaker
+        and the first to fail opens it again.  The counters retried and breaker_trips count the retries made and the
+        times a breaker has been opened.
+    """
+
+    def __init__(self, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, max_backoff=MAX_BACKOFF,
+                 breaker_threshold=DEFAULT_BREAKER_THRESHOLD, breaker_reset=DEFAULT_BREAKER_RESET):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.retried = 0
+        self.breaker_trips = 0
+
+        # The transient failures in a row, and the time the breaker closes, of each endpoint
+        self._failures = {}
+        self._open_until = {}
+        self._lock = threading.Lock()
+
+    def check(self, endpoint):
+        """Raise a SosRequestError if the breaker of the endpoint is open."""
+
+        with self._lock:
+            open_until = self._open_until.get(endpoint, 0)
+        if time.monotonic() < open_until:
+            raise SosRequestError('Requests to {} are stopped for {:.0f} s after repeated failures.'.format(
+                endpoint, open_until - time.monotonic()), FailureTypes.TRANSIENT)
+
+    def record(self, endpoint, failure):
+        """Record the outcome of a request to the endpoint, either None for an answered request or its FailureTypes.
+        Only transient failures count towards opening the breaker, any other outcome shows the SOS is answering."""
+
+        with self._lock:
+            if failure is not FailureTypes.TRANSIENT:
+                self._failures.pop(endpoint, None)
+                return
+
+            self._failures[endpoint] = self._failures.get(endpoint, 0) + 1
+            if self._failures[endpoint] >= self.breaker_threshold:
+                now = time.monotonic()
+                if now >= self._open_until.get(endpoint, 0):
+                    self.breaker_trips += 1
+                    logging.warning('Stopping requests to {} for {:.0f} s after {} failures in a row.'.format(
+                        endpoint, self.breaker_reset, self._failures[endpoint]))
+                self._open_until[endpoint] = now + self.breaker_reset
+
+    def delay(self, attempt):
+        """Return the seconds to wait before retry number attempt, counting from zero, chosen at random between half
+        and all of the backoff so that requests that failed together are not all sent again together."""
+
+        with self._lock:
+            self.retried += 1
+        backoff = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return random.uniform(backoff / 2, backoff)
+
+
+class LoaderMetrics(object):
+    """Collects the timings and counts of loads, the wall-clock seconds spent in each phase, a latency histogram of the
+    requests for each SOS operation, the rows and bytes sent, and the retries and bisection requests made.  It is thread
+    safe, and can be written as a JSON summary or as a Prometheus textfile collector file.
+
+    Arguments:
+        profile:  An optional collection of phase names to run cProfile over, whose statistics are written by
+            write_profiles
+        trace_memory:  Whether to record the peak memory allocated by Python within each phase, using tracemalloc
+
+    Note:
+        Phases run on several threads at once, such as encode while chunks are sent concurrently, add up the time of
+        every thread, so may exceed the elapsed time.  Only one phase is profiled at a time, a phase reached while
+        another is being profiled is timed but not profiled, and memory peaks are only exact when a single thread is
+        loading.  The phases are template, read, parse, deduplicate, incremental, send and, within send, encode,
+        rollup, and governor, the time requests wait for the governor of a multi-process load.  Before Python 3.9 the
+        peak of tracemalloc cannot be reset, so the memory of a phase is the growth in memory allocated over it, which
+        misses memory freed within the phase.
+    """
+
+    def __init__(self, profile=(), trace_memory=False):
+        self.profile = frozenset(profile)
+        self.trace_memory = trace_memory
+        self.started = time.perf_counter()
+
+        # Phase name to [seconds, count], operation to [bucket counts, count, seconds], and counter name to count
+        self.phases = {}
+        self.requests = {}
+        self.counters = {}
+        self.memory_peaks = {}
+        self._profiles = {}
+        self._profiling = threading.Lock()
+        self._lock = threading.Lock()
+
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time the code run within the context as the phase name, profiling it if asked to."""
+
+        profiler = None
+        if name in self.profile and self._profiling.acquire(blocking=False):
+            profiler = self._profiles.setdefault(name, cProfile.Profile())
+        if self.trace_memory:
+            memory_start = tracemalloc.get_traced_memory()[0]
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self._profiling.release()
+            seconds = time.perf_counter() - start
+
+            with self._lock:
+                timing = self.phases.setdefault(name, [0.0, 0])
+                timing[0] += seconds
+                timing[1] += 1
+                if self.trace_memory:
+                    current, peak = tracemalloc.get_traced_memory()
+                    if not hasattr(tracemalloc, 'reset_peak'):
+                        peak = current
+                    peak -= memory_start
+                    self.memory_peaks[name] = max(peak, self.memory_peaks.get(name, 0))
+
+    def observe_request(self, operation, seconds):
+        """Record the latency of a request for the SOS operation."""
+
+        with self._lock:
+            buckets, _, _ = histogram = self.requests.setdefault(operation, [[0] * len(LATENCY_BUCKETS), 0, 0.0])
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    buckets[index] += 1
+                    break
+            histogram[1] += 1
+            histogram[2] += seconds
+
+    def count(self, name, amount=1):
+        """Add amount to the counter name."""
+
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def snapshot(self):
+        """Return the phase timings, request latencies, counters and memory peaks collected so far as plain
+        dictionaries, which can be sent from another process and added to its metrics with merge."""
+
+        with self._lock:
+            return json.loads(json.dumps({'phases': self.phases,
+                                          'requests': self.requests,
+                                          'counters': self.counters,
+                                          'memory_peaks': self.memory_peaks}))
+
+    def merge(self, snapshot):
+        """Add the metrics of a snapshot, such as that of a load in another process, to these metrics."""
+
+        with self._lock:
+            for name, (seconds, count) in snapshot['phases'].items():
+                timing = self.phases.setdefault(name, [0.0, 0])
+                timing[0] += seconds
+                timing[1] += count
+            for operation, (buckets, count, seconds) in snapshot['requests'].items():
+                histogram = self.requests.setdefault(operation, [[0] * len(LATENCY_BUCKETS), 0, 0.0])
+                histogram[0] = [total + added for total, added in zip(histogram[0], buckets)]
+                histogram[1] += count
+                histogram[2] += seconds
+            for name, count in snapshot['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + count
+            for name, peak in snapshot['memory_peaks'].items():
+                self.memory_peaks[name] = max(peak, self.memory_peaks.get(name, 0))
+
+    def summary(self):
+        """Return the metrics collected so far as a dictionary that can be serialized to JSON."""
+
+        with self._lock:
+            elapsed = time.perf_counter() - self.started
+            requests = {}
+            for operation, (buckets, count, seconds) in self.requests.items():
+                cumulative = np.cumsum(buckets).tolist()
+                requests[operation] = {'count': count,
+                                       'seconds': seconds,
+                                       'buckets': dict(zip([str(bound) for bound in LATENCY_BUCKETS], cumulative))}
+
+            return {'elapsed_seconds': elapsed,
+                    'rows_per_second': self.counters.get('rows_inserted', 0) / elapsed if elapsed else 0.0,
+                    'phases': {name: {'seconds': seconds, 'count': count}
+                               for name, (seconds, count) in self.phases.items()},
+                    'requests': requests,
+                    'counters': dict(self.counters),
+                    'memory_peaks': dict(self.memory_peaks)}
+
+    def write_json(self, path):
+        """Write the summary to a JSON file."""
+        _write_atomically(path, json.dumps(self.summary(), indent=2))
+
+    def write_prometheus(self, path):
+        """Write the summary in the Prometheus text exposition format, for the node exporter's textfile collector,
+        which needs the file to be replaced atomically."""
+
+        summary = self.summary()
+        phase_metric = METRICS_PREFIX + '_phase_seconds_total'
+        lines = ['# HELP {} Wall-clock seconds spent in each phase of the loads.'.format(phase_metric),
+                 '# TYPE {} counter'.format(phase_metric)]
+        for name, timing in sorted(summary['phases'].items()):
+            lines.append('{}{{phase="{}"}} {}'.format(phase_metric, name, timing['seconds']))
+
+        request_metric = METRICS_PREFIX + '_request_duration_seconds'
+        lines += ['# HELP {} Latency of the requests to the SOS, by operation.'.format(request_metric),
+                  '# TYPE {} histogram'.format(request_metric)]
+        for operation, histogram in sorted(summary['requests'].items()):
+            buckets = list(histogram['buckets'].items()) + [('+Inf', histogram['count'])]
+            for bound, count in buckets:
+                lines.append('{}_bucket{{operation="{}",le="{}"}} {}'.format(request_metric, operation, bound, count))
+            lines.append('{}_sum{{operation="{}"}} {}'.format(request_metric, operation, histogram['seconds']))
+            lines.append('{}_count{{operation="{}"}} {}'.format(request_metric, operation, histogram['count']))
+
+        for name, count in sorted(summary['counters'].items()):
+            counter_metric = '{}_{}_total'.format(METRICS_PREFIX, name)
+            lines += ['# TYPE {} counter'.format(counter_metric), '{} {}'.format(counter_metric, count)]
+
+        rate_metric = METRICS_PREFIX + '_rows_per_second'
+        lines += ['# TYPE {} gauge'.format(rate_metric), '{} {}'.format(rate_metric, summary['rows_per_second'])]
+        _write_atomically(path, '\n'.join(lines) + '\n')
+
+    def write_profiles(self, folder):
+        """Write the cProfile statistics of each profiled phase to <phase>.prof within the folder, which can be read
+        with pstats or snakeviz."""
+
+        for name, profiler in self._profiles.items():
+            profiler.dump_stats(os.path.join(folder, '{}.prof'.format(name)))
+
+
+def _metrics_of(session):
+    """The LoaderMetrics of a session, or metrics that are discarded when there is no session."""
+    return session.metrics if session is not None else LoaderMetrics()
+
+
+class AdaptiveChunkSize(object):
+    """Chooses the number of observations sent in each InsertResult chunk from the response times and payload sizes of
+    the chunks already sent, so that each request takes about target_latency seconds.  The size grows when the SOS
+    answers quickly, shrinks when it is slow, and halves when a request fails or is only answered once sent again,
+    never more than doubling or halving at a time, and is kept between minimum and maximum.  It is thread safe, so it
+    can be shared by the chunks in flight and by every file loaded against the same endpoint.
+
+    Arguments:
+        seed:  The size of the first chunk
+        minimum:  The smallest chunk size used
+        maximum:  The largest chunk size used
+        target_latency:  The number of seconds each InsertResult request should take
+        max_payload_bytes:  An optional limit on the size of the result values of a chunk
+
+    Note:
+        The size reached is logged after each set of observations is saved, so that a fixed chunk size can be pinned
+        for an endpoint once it is known.
+    """
+
+    def __init__(self, seed=DEFAULT_CHUNK_SIZE, minimum=50, maximum=20000, target_latency=2.0,
+                 max_payload_bytes=None):
+        if not 1 <= minimum <= maximum:
+            raise ValueError('The chunk size bounds must satisfy 1 <= minimum <= maximum.')
+
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.max_payload_bytes = max_payload_bytes
+        self.size = self._bounded(seed)
+
+        # Smoothed estimates of the time and bytes each observation adds to a request
+        self._seconds_per_row = None
+        self._bytes_per_row = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Each process of a multi-process load is given its own copy, which adjusts to the responses it receives
+        state = dict(self.__dict__)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def next_size(self):
+        """Return the size to use for the next chunk."""
+        with self._lock:
+            return self.size
+
+    def record(self, rows, seconds, payload_bytes, failed=False):
+        """Update the chunk size with the outcome of a chunk.
+
+        Arguments:
+            rows:  The number of observations in the chunk
+            seconds:  The time taken for the SOS to answer
+            payload_bytes:  The length of the result values of the chunk
+            failed:  Whether the request failed because of the SOS or the connection to it, or was only answered after
+                being sent again, whose seconds include the pauses between the attempts
+        """
+
+        with self._lock:
+            if failed:
+                self.size = self._bounded(self.size // 2)
+                return
+
+            if rows < 1 or seconds <= 0:
+                return
+
+            self._seconds_per_row = self._smoothed(self._seconds_per_row, seconds / rows)
+            self._bytes_per_row = self._smoothed(self._bytes_per_row, payload_bytes / rows)
+
+            target_size = self.target_latency / self._seconds_per_row
+            if self.max_payload_bytes is not None and self._bytes_per_row > 0:
+                target_size = min(target_size, self.max_payload_bytes / self._bytes_per_row)
+
+            target_size = min(max(target_size, self.size / 2), self.size * 2)
+            self.size = self._bounded(int(target_size))
+
+    def _bounded(self, size):
+        return min(max(size, self.minimum), self.maximum)
+
+    @staticmethod
+    def _smoothed(current, measured, weight=0.3):
+        return measured if current is None else (1 - weight) * current + weight * measured
+
+
+class TemplateRegistry(object):
+    """Remembers the result templates found or created at SOS endpoints, so that loading several files for the same
+    offering and observed property only looks the template up once.  It is thread safe, and two loads needing the same
+    template at once wait for the one looking it up, rather than both trying to create it.
+
+    Arguments:
+        cache_path:  An optional JSON file the templates are kept in between runs, so that known templates are used
+            without any request to the SOS
+        max_age:  The number of seconds a template in the cache file is trusted for, after which it is looked up again
+
+    Note:
+        Templates cannot change once registered, but they are lost if the SOS database is recreated, so after clearing
+        a database the cache should be invalidated.  The hits and misses counters count the templates found in the
+        registry, and those that had to be looked up at the SOS.
+    """
+
+    def __init__(self, cache_path=None, max_age=DEFAULT_TEMPLATE_MAX_AGE):
+        self.cache_path = cache_path
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+
+        self._templates = {}
+        self._missing = set()
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+        if cache_path is not None and os.path.exists(cache_path):
+            self._load()
+
+    def resolve(self, procedure, obs_property, offering, template_metadata, endpoint, session=None):
+        """Find the result template for the offering and observed property, creating it if it does not exist.
+
+        Arguments:
+            procedure:  The procedure URI
+            obs_property:  The property being observed
+            offering:  The offering the procedure and property are under
+            template_metadata:  A set of values necessary for registering an observation template
+            endpoint:  The URI of the SOS service that listens for requests
+            session:  An optional SosSession to send the requests through
+
+        Raises:
+            NotImplementedError:  If the template does not exist and cannot be created
+
+        Returns:
+            A tuple of the result template identifier, its result encoding, and whether it was created by this call
+        """
+
+        key = (endpoint, obs_property, offering)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            template = self._lookup(key)
+            if template is not None:
+                return template[0], template[1], False
+
+            # Attempt to get the URI of the template if it already exists, unless it is known not to
+            if key in self._missing:
+                template_id, result_encoding = False, None
+            else:
+                logging.info("Checking if template already exists.")
+                template_id, result_encoding = identify_template_encoding(obs_property, offering, endpoint, session)
+
+            # If the template does not exist, attempt to create one
+            created = template_id is False
+            if created:
+                logging.info("Creating template.")
+                template_id = create_template(procedure, obs_property, offering, template_metadata, endpoint,
+                                              session)
+                result_encoding = dict(DEFAULT_RESULT_ENCODING)
+
+            self._store(key, template_id, result_encoding)
+            return template_id, result_encoding, created
+
+    def prefill(self, series, endpoint, session=None, workers=DEFAULT_POOL_SIZE):
+        """Look up the templates of many series at once before they are loaded, sending the GetResultTemplate
+        requests for every series not already in the registry concurrently.  Series found not to have a template are
+        remembered, so that loading them goes straight to creating it.
+
+        Arguments:
+            series:  An iterable of (obs_property, offering) tuples
+            endpoint:  The URI of the SOS service that listens for requests
+            session:  An optional SosSession to send the requests through
+            workers:  The number of requests sent at once
+        """
+
+        def look_up(key):
+            return key, identify_template_encoding(key[1], key[2], endpoint, session)
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            found = list(executor.map(look_up, self._unknown_keys(series, endpoint)))
+        self._store_found(found)
+
+    def _unknown_keys(self, series, endpoint):
+        """The keys of the series at the endpoint without a template in the registry, or whose template has expired."""
+
+        keys = {(endpoint, obs_property, offering) for obs_property, offering in series}
+        with self._lock:
+            return [key for key in keys if self._templates.get(key) is None or self._expired(self._templates[key])]
+
+    def _store_found(self, found):
+        """Store the (key, (template identifier, result encoding)) of the templates looked up by prefill, remembering
+        the series found not to have one."""
+
+        with self._lock:
+            for key, (template_id, result_encoding) in found:
+                if template_id is False:
+                    self._missing.add(key)
+                else:
+                    self._templates[key] = (template_id, result_encoding, time.time())
+            self._save()
+
+        logging.info('Looked up {} templates, {} were not found.'.format(
+            len(found), sum(template_id is False for _, (template_id, _) in found)))
+
+    def snapshot(self):
+        """Return the templates in the registry and the series known to have none, which can be sent to another
+        process and added to its registry with merge."""
+
+        with self._lock:
+            return dict(self._templates), set(self._missing)
+
+    def merge(self, snapshot):
+        """Add the templates and the series without one of a snapshot of another registry, keeping any template
+        already in this registry."""
+
+        templates, missing = snapshot
+        with self._lock:
+            for key, template in templates.items():
+                self._templates.setdefault(key, template)
+            self._missing.update(key for key in missing if key not in self._templates)
+
+    def invalidate(self, endpoint=None, obs_property=None, offering=None):
+        """Forget the templates matching the given endpoint, observed property and offering, or every template if
+        none are given, both in the registry and in its cache file.
+
+        Arguments:
+            endpoint:  The endpoint of the templates to forget
+            obs_property:  The observed property of the templates to forget
+            offering:  The offering of the templates to forget
+        """
+
+        pattern = (endpoint, obs_property, offering)
+        with self._lock:
+            for key in list(self._templates) + list(self._missing):
+                if all(part is None or part == key_part for part, key_part in zip(pattern, key)):
+                    self._templates.pop(key, None)
+                    self._missing.discard(key)
+            self._save()
+
+    def _lookup(self, key):
+        with self._lock:
+            template = self._templates.get(key)
+            if template is not None and not self._expired(template):
+                self.hits += 1
+                return template
+            self.misses += 1
+            return None
+
+    def _store(self, key, template_id, result_encoding):
+        with self._lock:
+            self._templates[key] = (template_id, result_encoding, time.time())
+            self._missing.discard(key)
+            self._save()
+
+    def _expired(self, template):
+        return self.cache_path is not None and time.time() - template[2] > self.max_age
+
+    def _load(self):
+        templates = {}
+        try:
+            with open(self.cache_path) as cache_file:
+                for entry in json.load(cache_file):
+                    template = (entry['template_id'], entry['result_encoding'], entry['stored_at'])
+                    if not self._expired(template):
+                        templates[(entry['endpoint'], entry['obs_property'], entry['offering'])] = template
+        except (OSError, ValueError, KeyError, TypeError) as error:
+            logging.warning('The template cache {} could not be read, the templates are looked up again: {}'.format(
+                self.cache_path, error))
+            return
+        self._templates = templates
+
+    def _save(self):
+        if self.cache_path is None:
+            return
+
+        entries = [{'endpoint': endpoint,
+                    'obs_property': obs_property,
+                    'offering': offering,
+                    'template_id': template_id,
+                    'result_encoding': result_encoding,
+                    'stored_at': stored_at}
+                   for (endpoint, obs_property, offering), (template_id, result_encoding, stored_at)
+                   in self._templates.items()]
+        _write_atomically(self.cache_path, json.dumps(entries, indent=2))
+
+
+class UploadJournal(object):
+    """A record, kept in a file beside an observation file, of the rows of the file that have been sent to the SOS, so
+    that a load that is stopped part way through can be resumed without sending the rows already stored again.
+
+    Arguments:
+        observations:  The path of the CSV observation file being loaded
+        resume:  Whether to use an existing journal of the file, when false any existing journal is replaced
+        interval:  The least number of seconds between writes of the journal file
+
+    Note:
+        Rows are identified by their position in the file, which is the index read_observations gives them, and the
+        journal holds ranges of positions whose chunks the SOS has answered.  A journal is only used if the sha256 of
+        the file matches the one it was written for.  The file is written atomically, so a crash while it is written
+        leaves the previous journal, which at worst sends the chunks of the last interval again.  A journal that cannot
+        be read is ignored, and one that cannot be written, for want of permission or disk space, is no longer written,
+        with a warning, rather than failing the load, whose rows sent again are then rejected by the SOS as duplicates.
+    """
+
+    def __init__(self, observations, resume=False, interval=DEFAULT_JOURNAL_INTERVAL):
+        self.path = os.fspath(observations) + JOURNAL_SUFFIX
+        self.source_hash = _hash_file(observations)
+        self.interval = interval
+        self._committed = []
+        self._lock = threading.Lock()
+        self._changed = False
+        self._written_at = time.monotonic()
+        self._writable = True
+
+        if resume and os.path.exists(self.path):
+            self._load()
+
+    @property
+    def committed_rows(self):
+        """The number of row positions covered by the committed ranges."""
+        return sum(stop - start for start, stop in self._committed)
+
+    def remove_committed(self, curr_obs):
+        """Return the observations whose rows are not within a committed range."""
+
+        if not self._committed:
+            return curr_obs
+
+        starts = np.array([start for start, _ in self._committed])
+        stops = np.array([stop for _, stop in self._committed])
+        rows = _file_rows(curr_obs)
+        preceding = np.searchsorted(starts, rows, side='right') - 1
+        committed = (preceding >= 0) & (rows < stops[np.maximum(preceding, 0)])
+        return curr_obs[~committed]
+
+    def commit(self, start, stop):
+        """Record the rows from start up to but not including stop as sent, writing the journal if the interval has
+        passed since it was last written."""
+
+        with self._lock:
+            self._committed = _merge_ranges(self._committed + [(start, stop)])
+            self._changed = True
+            if time.monotonic() - self._written_at >= self.interval:
+                self._save()
+
+    def flush(self):
+        """Write any ranges committed since the journal was last written."""
+
+        with self._lock:
+            if self._changed:
+                self._save()
+
+    def complete(self):
+        """Remove the journal once every row of the file has been sent."""
+
+        with self._lock:
+            self._committed = []
+            self._changed = False
+            try:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+            except OSError as error:
+                logging.warning('The journal {} could not be removed: {}'.format(self.path, error))
+
+    def _load(self):
+        try:
+            with open(self.path) as journal_file:
+                journal = json.load(journal_file)
+        except (OSError, ValueError) as error:
+            logging.warning('The journal {} could not be read, the file is loaded from the start: {}'.format(
+                self.path, error))
+            return
+
+        if journal.get('source_hash') != self.source_hash:
+            logging.warning('The observation file has changed since its journal was written, it is loaded from the '
+                            'start.')
+            return
+
+        self._committed = [tuple(committed) for committed in journal['committed']]
+
+    def _save(self):
+        self._changed = False
+        self._written_at = time.monotonic()
+        if not self._writable:
+            return
+
+        journal = {'source_hash': self.source_hash,
+                   'committed': [list(committed) for committed in self._committed]}
+        try:
+            _write_atomically(self.path, json.dumps(journal))
+        except OSError as error:
+            self._writable = False
+            logging.warning('The journal {} could not be written, the load continues without it: {}'.format(
+                self.path, error))
+
+
+def _merge_ranges(ranges):
+    """Merge a list of (start, stop) ranges into a sorted list of ranges that neither overlap nor touch."""
+
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(stop, merged[-1][1]))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def _hash_file(path, block_size=1 << 20):
+    """Return the hex sha256 of a file, read a block at a time."""
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for block in iter(lambda: source.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _write_atomically(path, content):
+    """Write the content to a file by writing a temporary file beside it and renaming it over the file, so that the
+    file is never left partly written."""
+
+    temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary_path, 'w') as temporary_file:
+        temporary_file.write(content)
+        temporary_file.flush()
+        os.fsync(temporary_file.fileno())
+    os.replace(temporary_path, path)
+
+
+class FollowedFile(object):
+    """Follows an observation file that a logger keeps appending to, giving the complete lines appended since the
+    last commit.  The file is held open between polls, so that when it is rotated, renamed and replaced by a new file,
+    the rest of the old file is read before the new one is started.  A file that shrinks is taken to have been
+    truncated, and is read again from its header.
+
+    Arguments:
+        observations:  The path of the CSV observation file
+        read_bytes:  The most bytes read at a time
+        read_rows:  The most lines read at a time, by default every complete line within read_bytes
+
+    Note:
+        The byte offset committed, the header, the file's device and inode, a checksum of its leading bytes and the
+        last timestamp sent are kept in a state file beside the observation file, so that following can stop and start
+        again where it was.  If the file has been replaced or truncated while it was not followed it is read from its
+        header, and the last timestamp sent is used to skip the rows sent before.  A final line without a line ending
+        is left until it is complete.
+    """
+
+    def __init__(self, observations, read_bytes=FOLLOW_READ_BYTES, read_rows=None):
+        self.path = os.fspath(observations)
+        self.state_path = self.path + FOLLOW_SUFFIX
+        self.read_bytes = read_bytes
+        self.read_rows = read_rows
+        self.offset = 0
+        self.header = None
+        self.identity = None
+        self.fingerprint = None
+        self.last_time = None
+
+        self._file = None
+        self._pending = None
+
+        if os.path.exists(self.state_path):
+            self._load()
+
+    def read_appended(self):
+        """Read the complete lines appended since the last commit, opening the file if it is not open, and moving on
+        to the file now at the path once a rotated file has been read to its end.
+
+        Returns:
+            The header and the lines appended as CSV text, or None if no complete line has been appended
+        """
+
+        while True:
+            if self._file is None and not self._open():
+                return None
+
+            self._file.seek(self.offset)
+            data = self._file.read(self.read_bytes)
+            if self.header is None:
+                header_end = data.find(b'\n') + 1
+                if not header_end:
+                    return None
+                self.header = data[:header_end].decode('utf-8')
+                self.offset += header_end
+                data = data[header_end:]
+
+            lines_end = data.rfind(b'\n') + 1
+            if lines_end and self.read_rows is not None:
+                # The lines after the first read_rows are left for the next read
+                line_ends = [match.end() for match in re.finditer(b'\n', data[:lines_end])]
+                lines_end = line_ends[min(self.read_rows, len(line_ends)) - 1]
+            if lines_end:
+                self._pending = self.offset + lines_end
+                return self.header + data[:lines_end].decode('utf-8')
+
+            if not self._rotated():
+                return None
+
+            if data:
+                logging.warning('The last line of the rotated file {} was not complete and is not sent.'.format(
+                    self.path))
+            logging.info('Following the new file at {}.'.format(self.path))
+            self.close()
+            self._reset()
+
+    @property
+    def more_pending(self):
+        """Whether the last read stopped at read_bytes or read_rows, so that more may already have been appended."""
+        return self._file is not None and os.fstat(self._file.fileno()).st_size > (self._pending or self.offset)
+
+    def commit(self, last_time=None):
+        """Record the lines last read as sent, and the latest timestamp sent in them if any, writing the state file."""
+
+        if self._pending is not None:
+            self.offset = self._pending
+            self._pending = None
+        if last_time is not None:
+            self.last_time = last_time if self.last_time is None else max(self.last_time, last_time)
+        fingerprint_length = min(self.offset, FOLLOW_FINGERPRINT_BYTES)
+        if self._file is not None and (self.fingerprint is None or self.fingerprint[0] < fingerprint_length):
+            self.fingerprint = self._fingerprint(fingerprint_length)
+
+        state = {'offset': self.offset,
+                 'header': self.header,
+                 'identity': self.identity,
+                 'fingerprint': self.fingerprint,
+                 'last_time': self.last_time}
+        _write_atomically(self.state_path, json.dumps(state))
+
+    def close(self):
+        """Close the file, it is opened again by the next read."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _open(self):
+        try:
+            self._file = open(self.path, 'rb')
+        except FileNotFoundError:
+            # Between a rotation and the logger creating the new file
+            return False
+
+        status = os.fstat(self._file.fileno())
+        identity = [status.st_dev, status.st_ino]
+        # A file created after the one it replaced was deleted may be given the same inode
+        if (identity != self.identity or status.st_size < self.offset or
+                self.fingerprint is not None and self._fingerprint(self.fingerprint[0]) != self.fingerprint):
+            if self.identity is not None:
+                logging.info('The file {} was replaced or truncated, it is read from its header.'.format(self.path))
+            self._reset()
+            self.identity = identity
+        return True
+
+    def _rotated(self):
+        """Whether the path now names another file, or the open file has been truncated."""
+
+        status = os.fstat(self._file.fileno())
+        if status.st_size < self.offset:
+            return True
+        try:
+            current = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        return [current.st_dev, current.st_ino] != self.identity
+
+    def _fingerprint(self, length):
+        """The [length, CRC-32] of the first length bytes of the open file."""
+        self._file.seek(0)
+        return [length, zlib.crc32(self._file.read(length))]
+
+    def _reset(self):
+        self.offset = 0
+        self.header = None
+        self.identity = None
+        self.fingerprint = None
+        self._pending = None
+
+    def _load(self):
+        with open(self.state_path) as state_file:
+            state = json.load(state_file)
+        self.offset = state['offset']
+        self.header = state['header']
+        self.identity = state['identity']
+        self.fingerprint = state.get('fingerprint')
+        self.last_time = state['last_time']
+
+
+class ObservationArrays(object):
+    """The observations of a series held as contiguous arrays, the representation the loader uses between reading a
+    file and sending it.  It takes 24 bytes an observation, or 20 with float32 values, and slicing it for a chunk
+    gives views of the arrays rather than copies of the rows of a dataframe.
+
+    Arguments:
+        times:  The phenomenon times as int64 seconds since the epoch, UTC if the file has no time zone
+        values:  The values as float64, or float32 to halve their size where a sensor has no more precision than that
+        rows:  The int64 positions of the observations in the file, for the journal, by default 0 up to their number
+
+    Note:
+        Indexing with a slice returns a view, and with a boolean mask or positions a copy, as for numpy arrays.
+    """
+
+    __slots__ = ('times', 'values', 'rows')
+
+    def __init__(self, times, values, rows=None):
+        self.times = np.asarray(times, dtype=np.int64)
+        self.values = np.asarray(values)
+        if self.values.dtype.name not in VALUE_DTYPES:
+            self.values = self.values.astype(VALUE_DTYPES[0])
+        self.rows = np.arange(self.times.shape[0], dtype=np.int64) if rows is None else np.asarray(rows, np.int64)
+
+    @classmethod
+    def from_frame(cls, curr_obs, value_dtype=VALUE_DTYPES[0]):
+        """Convert a dataframe of observations, parsing its columns if they are not yet of their types, keeping its
+        index as the row positions."""
+
+        curr_obs = check_observation_parse(curr_obs)
+        times = curr_obs['datetime'].to_numpy().astype('datetime64[s]').view(np.int64)
+        return cls(times, curr_obs['value'].to_numpy(dtype=value_dtype), curr_obs.index.to_numpy(dtype=np.int64))
+
+    @classmethod
+    def concatenate(cls, parts, value_dtype=VALUE_DTYPES[0]):
+        """Join a list of ObservationArrays into one, in order."""
+
+        if not parts:
+            return cls(np.empty(0, np.int64), np.empty(0, value_dtype))
+        if len(parts) == 1:
+            return parts[0]
+        return cls(np.concatenate([part.times for part in parts]),
+                   np.concatenate([part.values for part in parts]),
+                   np.concatenate([part.rows for part in parts]))
+
+    def __len__(self):
+        return self.times.shape[0]
+
+    def __getitem__(self, key):
+        return ObservationArrays(self.times[key], self.values[key], self.rows[key])
+
+    @property
+    def datetimes(self):
+        """A datetime64[s] view of the times."""
+        return self.times.view('datetime64[s]')
+
+    @property
+    def nbytes(self):
+        return self.times.nbytes + self.values.nbytes + self.rows.nbytes
+
+    def to_frame(self):
+        """Return the observations as a dataframe of datetime64 timestamps and values, indexed by row position."""
+        return pd.DataFrame({'datetime': self.datetimes.astype('datetime64[ns]'), 'value': self.values},
+                            index=self.rows)
+
+
+def _as_arrays(curr_obs):
+    return curr_obs if isinstance(curr_obs, ObservationArrays) else ObservationArrays.from_frame(curr_obs)
+
+
+def _file_rows(curr_obs):
+    """The positions in the file of a dataframe or ObservationArrays of observations."""
+    return curr_obs.rows if isinstance(curr_obs, ObservationArrays) else curr_obs.index.to_numpy()
+
+
+def prepare_observations(observations, procedure, obs_property, offering, template_metadata, endpoint, session=None,
+                         max_in_flight=DEFAULT_MAX_IN_FLIGHT, incremental=None, block_size=None, precision=None,
+                         templates=None, chunk_size=DEFAULT_CHUNK_SIZE, journal=False, resume=False,
+                         value_dtype=VALUE_DTYPES[0], sort_by_time=False, rollups=(), keep_last=False):
+    """Main entrypoint, takes in all the necessary parameters to save a set of observations.  It
+    identifies a suitable result template at the endpoint if it exists, or creates one where
+    necessary, then attempts to upload the observations as a set of results under the template.  It
+    removes duplicate entries within the provided observations file, and doesn't provide feedback when
+    individual observations cannot be uploaded due to an already saved observation being within the server.
+
+    Note:
+        Templates are assumed to be of the format: "ObservedPropertyValue-OfferingValue".  If they are not of this
+        format the script needs updating, it is required that they be standardized in some way, using the parameters
+        provided to this script.
+
+    observations -- CSV file containing two columns in the following order: (datetime, value), where datetime is in
+        the format %Y-%m-%dT%H:%M:%S, and value is numeric.  A Parquet, Arrow or Feather file, named by one of the
+        extensions of COLUMNAR_FORMATS, with the same two columns is read through pyarrow instead.
+    procedure -- The procedure URI
+    obs_property -- The property being observed
+    offering -- The offering the procedure and property are under
+    template_metadata -- A set of values necessary for registering an observation template (and an observation)
+    endpoint -- The URI of the SOS service that listens for requests
+    session -- An optional SosSession to send the requests through, when not given one is created for this call and
+        closed once the observations have been sent
+    max_in_flight -- The number of InsertResult chunks that may be sent concurrently
+    incremental -- An optional IncrementalModes value, when given the observations the SOS already holds for the series
+        are found and skipped before any are sent
+    block_size -- An optional number of rows, when given the file is read, checked and sent as a stream of blocks of
+        this many rows, so that the memory used is set by the block size rather than the size of the file.  A block
+        that fails to parse stops the load, but the blocks before it will already have been sent.  Duplicates in
+        different blocks of a file out of time order are left to the SOS, which keeps the first, unless keep_last.
+    precision -- An optional number of decimal places to round the values of this series to when they are sent
+    templates -- An optional TemplateRegistry shared between loads, so that a template is only looked up once
+    chunk_size -- The number of observations sent in each InsertResult request, or an AdaptiveChunkSize to adjust it
+        to the response times of the SOS
+    journal -- Whether to keep an UploadJournal beside the observation file, recording the rows sent so far, which is
+        removed once the whole file has been sent.  It needs observations to be a path.
+    resume -- Whether to use the journal left by an earlier load of the same file that did not finish, skipping the
+        rows it records as sent.  It implies journal.
+    value_dtype -- The type the values are held as while they are sent, float64, or float32 for a series whose values
+        have no more than 7 significant digits
+    sort_by_time -- Whether to send the observations in time order, so that each InsertResult chunk covers a
+        contiguous window of time, rather than in the order of the file.  A file read in blocks is sorted within each
+        block.
+    rollups -- The periods of ROLLUP_PERIODS to roll the series up over once it has been sent.  Each statistic of
+        ROLLUP_STATISTICS over each period is sent to a companion series, under the observed property rollup_property
+        names, with a template of its own.  Only the periods touched by the rows sent are recomputed, and a period is
+        only sent once the series has an observation in a later one.
+    keep_last -- Whether a file read in blocks has the timestamps of the whole file read first, so that duplicates in
+        different blocks keep the last observation as they do for a file read whole.  It holds 24 to 33 bytes a row of
+        the file, and the first block is only sent once the file has been read through.
+    """
+
+    # Every request made while saving the observations shares the same pool of keep-alive connections
+    owns_session = session is None
+    if owns_session:
+        session = SosSession()
+
+    if templates is None:
+        templates = TemplateRegistry()
+
+    metrics = session.metrics
+    upload_journal = None
+    try:
+        _check_rollup_periods(rollups)
+        if journal or resume:
+            upload_journal = UploadJournal(observations, resume)
+            if upload_journal.committed_rows:
+                logging.info('Resuming the load, {} rows were sent before.'.format(upload_journal.committed_rows))
+
+        # Find the template, creating it if it does not exist, there can be no stored observations for a new template
+        with metrics.phase('template'):
+            template_id, result_encoding, created = templates.resolve(procedure, obs_property, offering,
+                                                                      template_metadata, endpoint, session)
+        if created:
+            incremental = None
+
+        # The rollups of the periods the series already held observations in are recomputed from the SOS.  The stored
+        #  range is found once, before any block is sent, so that the rows of a later block are not taken to be stored
+        #  for falling within the rows this load has already sent.
+        rollup_periods = _RollupPeriods(rollups) if rollups else None
+        stored_range = None
+        if (incremental is not None or rollup_periods is not None) and not created:
+            with metrics.phase('incremental' if incremental is not None else 'rollup'):
+                stored_range = get_stored_time_range(procedure, obs_property, offering, endpoint, session)
+
+        # Load the observations from the file, either whole or as a stream of blocks, the first row should be the
+        #  header.  While a block is being sent the next one is read and checked in the background.  Each is held as
+        #  ObservationArrays from then on.
+        if block_size is None:
+            obs_blocks = [read_observation_arrays(observations, value_dtype, metrics, sort=sort_by_time)]
+        else:
+            obs_blocks = (ObservationArrays.from_frame(curr_obs, value_dtype) for curr_obs in
+                          _prefetch(read_observation_blocks(observations, block_size, metrics, sort_by_time,
+                                                            keep_last)))
+
+        outcomes = []
+        for curr_obs in obs_blocks:
+            read_rows = len(curr_obs)
+            if upload_journal is not None:
+                curr_obs = upload_journal.remove_committed(curr_obs)
+
+            if incremental is not None:
+                logging.info("Drop observations already held by the SOS.")
+                with metrics.phase('incremental'):
+                    curr_obs = _remove_within_stored_range(curr_obs, stored_range, obs_property, offering, endpoint,
+                                                           incremental, session, result_encoding)
+            metrics.count('rows_skipped', read_rows - len(curr_obs))
+            if rollup_periods is not None:
+                rollup_periods.add(curr_obs)
+
+            # Send the observations to the function that inserts them using a ResultTemplate to batch in chunks.
+            logging.info("Sending observations.")
+            with metrics.phase('send'):
+                outcomes += save_observations(curr_obs, template_id, endpoint, chunk_size, session, max_in_flight,
+                                              result_encoding, precision, upload_journal)
+
+        if upload_journal is not None:
+            upload_journal.complete()
+
+        if rollup_periods is not None:
+            logging.info("Sending rollups.")
+            with metrics.phase('rollup'):
+                rollup_outcomes = _save_rollups(rollup_periods, procedure, obs_property, offering, template_metadata,
+                                                endpoint, session, templates, stored_range, max_in_flight, chunk_size,
+                                                result_encoding)
+            logging.info('Rollup observations inserted: {}, rejected: {}.'.format(
+                sum(outcome.inserted for outcome in rollup_outcomes),
+                sum(outcome.rejected for outcome in rollup_outcomes)))
+
+        logging.info('Observations inserted: {}, rejected: {}, using {} requests.'.format(
+            sum(outcome.inserted for outcome in outcomes),
+            sum(outcome.rejected for outcome in outcomes),
+            sum(outcome.requests for outcome in outcomes)))
+        logging.info('Connections opened: {}, reused: {}, requests retried: {}.'.format(
+            session.connections_opened, session.connections_reused, session.retry_policy.retried))
+        return ResultTypes.OBSERVATIONS_OK
+
+    except NotImplementedError:
+        logging.error('The template did not exist and was unable to be registered.')
+        return ResultTypes.TEMPLATE_FAILURE
+
+    except ValueError as error:
+        logging.error('The observation CSV column names were not correct, or too many columns, or wrong data type.')
+        logging.error(str(error))
+        return ResultTypes.PARSE_FAILURE
+
+    except FileNotFoundError as error:
+        logging.error('The observation file could not be found: {}'.format(error))
+        return ResultTypes.PARSE_FAILURE
+
+    except (OSError, http.client.HTTPException, SosRequestError) as error:
+        logging.error('The SOS could not be reached: {}'.format(error))
+        return ResultTypes.ENDPOINT_FAILURE
+
+    finally:
+        if upload_journal is not None:
+            upload_journal.flush()
+        if owns_session:
+            session.close()
+
+
+def read_observations(observations, metrics=None, sort=False):
+    """Read a whole observation file, parsing the timestamps and values to their types as it is read, and remove the
+    duplicate observations.
+
+    Arguments:
+        observations:  The path of the CSV, Parquet, Arrow or Feather observation file, or a file-like object of CSV
+        metrics:  Optional LoaderMetrics to record the read, parse and deduplicate phases in
+        sort:  Whether to order the observations by time rather than as they are in the file
+
+    Raises:
+        ObservationParseError:  If the header or a value within the file does not conform to the expected format
+
+    Returns:
+        A pandas dataframe holding the observation data, with datetime64 timestamps and float64 values
+    """
+
+    metrics = metrics or LoaderMetrics()
+    if _columnar_format(observations) is not None:
+        return read_observation_arrays(observations, metrics=metrics, sort=sort).to_frame()
+
+    # Check the header before reading the rest of the file
+    start = _check_observation_header(observations)
+
+    try:
+        with metrics.phase('read'):
+            curr_obs = pd.read_csv(observations,
+                                   header=0,
+                                   dtype=OBSERVATION_DTYPES)
+    except ValueError:
+        raise _locate_unparseable_values(observations, start)
+
+    # Check that the observations conform to the expected format
+    logging.info("Check observations parse OK.")
+    with metrics.phase('parse'):
+        curr_obs = check_observation_parse(curr_obs)
+
+    logging.info("Drop duplicates from observations.")
+    return _deduplicate(curr_obs, metrics, sort)
+
+
+def read_observation_blocks(observations, block_size, metrics=None, sort=False, keep_last=False):
+    """Read an observation file as a stream of blocks of block_size rows, parsing each block to its types and removing
+    the duplicate observations, so that only a block at a time is held in memory.
+
+    Arguments:
+        observations:  The path of the CSV, Parquet, Arrow or Feather observation file, or a file-like object of CSV
+        block_size:  The number of rows read at a time
+        metrics:  Optional LoaderMetrics to record the read, parse and deduplicate phases in
+        sort:  Whether to order the observations of each block by time, the blocks themselves stay in file order
+        keep_last:  Whether to read the timestamps of the whole file before the first block, so that duplicates in
+            different blocks keep the last observation whatever the order of the file, at the cost of memory set by
+            the size of the file rather than the block size
+
+    Note:
+        The final observation of a block is held back and read with the next block, so that for a file in time order,
+        where the duplicates of a timestamp are neighbours, the last of them is kept, as it would be for the whole
+        file.  A block whose times overlap the range of times of the blocks already given may repeat their
+        timestamps, and those duplicates are left to the SOS, which keeps the first observation.  Such blocks are
+        counted as overlapping_blocks and logged.  With keep_last, a first pass holds 24 to 33 bytes a row of the file
+        before the first block is given, and a file-like object is read twice, so one that cannot seek is first copied
+        to a temporary file.
+
+    Raises:
+        ObservationParseError:  If the header or a value within a block does not conform to the expected format
+
+    Returns:
+        A generator of pandas dataframes holding the observation data
+    """
+
+    metrics = metrics or LoaderMetrics()
+    if keep_last:
+        for curr_obs in _keep_last_blocks(observations, block_size, metrics, sort):
+            yield curr_obs
+        return
+
+    held_back = None
+    given_range = None
+    overlapping = 0
+    for curr_obs in _parsed_blocks(observations, block_size, metrics):
+        if held_back is not None:
+            curr_obs = pd.concat([held_back, curr_obs])
+            # The held back observation was counted with the block before
+            metrics.count('rows_read', -1)
+        curr_obs = _deduplicate(curr_obs, metrics, sort)
+
+        # Once deduplicated only the final observation can have its timestamp repeated at the start of the next block
+        held_back = curr_obs.iloc[-1:]
+        curr_obs = curr_obs.iloc[:-1]
+        if curr_obs.shape[0]:
+            given_range, overlaps = _given_range(curr_obs, given_range)
+            overlapping += overlaps
+            yield curr_obs
+
+    if held_back is not None:
+        _, overlaps = _given_range(held_back, given_range)
+        overlapping += overlaps
+        yield held_back
+
+    if overlapping:
+        metrics.count('overlapping_blocks', overlapping)
+        logging.warning('{} blocks of the observation file overlap the times of the blocks before them, duplicates of '
+                        'observations already sent are left to the SOS, which keeps the first.'.format(overlapping))
+
+
+def _given_range(curr_obs, given_range):
+    """Widen the range of the times of the blocks given so far by a block, returning the new range and whether the
+    block overlapped it."""
+
+    obs_times = curr_obs['datetime'].values
+    first, last = obs_times.min(), obs_times.max()
+    if given_range is None:
+        return (first, last), False
+    overlaps = first <= given_range[1] and last >= given_range[0]
+    return (min(first, given_range[0]), max(last, given_range[1])), overlaps
+
+
+def _keep_last_blocks(observations, block_size, metrics, sort):
+    """As read_observation_blocks with keep_last, dropping the observations whose timestamp is repeated later in the
+    file from their blocks."""
+
+    observations = _seekable(observations)
+    with metrics.phase('deduplicate'):
+        superseded = _superseded_rows(observations, block_size)
+
+    for curr_obs in _parsed_blocks(observations, block_size, metrics):
+        kept = ~np.isin(curr_obs.index.to_numpy(dtype=np.int64), superseded)
+        dropped = len(kept) - int(kept.sum())
+        if dropped:
+            curr_obs = curr_obs[kept]
+            metrics.count('rows_read', dropped)
+            metrics.count('duplicates_dropped', dropped)
+        curr_obs = _deduplicate(curr_obs, metrics, sort)
+        if curr_obs.shape[0]:
+            yield curr_obs
+
+
+def _seekable(observations):
+    """A file-like object that cannot return to its start copied to a temporary file that can, or observations as they
+    are."""
+
+    if not hasattr(observations, 'read') or (hasattr(observations, 'seekable') and observations.seekable()):
+        return observations
+    spooled = tempfile.TemporaryFile('w+b' if isinstance(observations.read(0), bytes) else 'w+')
+    shutil.copyfileobj(observations, spooled)
+    spooled.seek(0)
+    return spooled
+
+
+def _superseded_rows(observations, block_size):
+    """The sorted positions in an observation file of the observations whose timestamp is repeated later in the file,
+    from a pass over its timestamps alone.  A file-like object is returned to its start."""
+
+    if _columnar_format(observations) is not None:
+        parts = [curr_obs.times
+                 for curr_obs in _columnar_blocks(observations, block_size, VALUE_DTYPES[0], LoaderMetrics())]
+    else:
+        start = _check_observation_header(observations)
+        parts = []
+        try:
+            for curr_obs in pd.read_csv(observations, header=0, usecols=['datetime'], dtype=str, chunksize=block_size):
+                obs_times = pd.to_datetime(curr_obs['datetime'], errors='coerce', format=DATETIME_FORMAT, exact=True)
+                parts.append(obs_times.to_numpy().astype('datetime64[s]').view(np.int64))
+        except ValueError:
+            raise _locate_unparseable_values(observations, start, block_size)
+        if start is not None:
+            observations.seek(start)
+
+    if not parts:
+        return np.empty(0, dtype=np.int64)
+    times = np.concatenate(parts)
+
+    # A stable sort keeps repeated timestamps in file order, so all but the last of each are superseded.  Timestamps
+    #  that do not parse are reported when their block is, so are not matched with each other
+    order = np.argsort(times, kind='stable')
+    sorted_times = times[order]
+    repeated = (sorted_times[:-1] == sorted_times[1:]) & (sorted_times[:-1] != np.datetime64('NaT').view(np.int64))
+    return np.sort(order[:-1][repeated])
+
+
+def read_observation_arrays(observations, value_dtype=VALUE_DTYPES[0], metrics=None, block_size=READ_BLOCK_SIZE,
+                            sort=False):
+    """Read a whole observation file into ObservationArrays, parsing it block_size rows at a time so that only a block
+    of timestamp strings is held at once, and remove the duplicate observations.
+
+    Arguments:
+        observations:  The path of the CSV, Parquet, Arrow or Feather observation file, or a file-like object of CSV
+        value_dtype:  The type to hold the values as, one of VALUE_DTYPES
+        metrics:  Optional LoaderMetrics to record the read, parse and deduplicate phases in
+        block_size:  The number of rows of a CSV file parsed at a time
+        sort:  Whether to order the observations by time rather than as they are in the file
+
+    Raises:
+        ObservationParseError:  If the header or a value within the file does not conform to the expected format
+
+    Returns:
+        The ObservationArrays of the file, with the positions of the observations in the file as their rows
+    """
+
+    metrics = metrics or LoaderMetrics()
+    if _columnar_format(observations) is not None:
+        # Without timestamp strings to bound, the record batches of the file are kept as they are, so that a file of
+        #  one batch is not copied
+        parts = list(_columnar_blocks(observations, None, value_dtype, metrics))
+    else:
+        parts = [ObservationArrays.from_frame(curr_obs, value_dtype)
+                 for curr_obs in _parsed_blocks(observations, block_size, metrics)]
+    return _deduplicate(ObservationArrays.concatenate(parts, value_dtype), metrics, sort)
+
+
+def _parsed_blocks(observations, block_size, metrics):
+    """Read an observation file block_size rows at a time, generating each block parsed to its types."""
+
+    if _columnar_format(observations) is not None:
+        for curr_obs in _columnar_blocks(observations, block_size, VALUE_DTYPES[0], metrics):
+            yield curr_obs.to_frame()
+        return
+
+    start = _check_observation_header(observations)
+    blocks = pd.read_csv(observations, header=0, dtype=OBSERVATION_DTYPES, chunksize=block_size)
+    while True:
+        try:
+            with metrics.phase('read'):
+                curr_obs = next(blocks)
+        except StopIteration:
+            break
+        except ValueError:
+            raise _locate_unparseable_values(observations, start, block_size)
+
+        with metrics.phase('parse'):
+            curr_obs = check_observation_parse(curr_obs)
+        yield curr_obs
+
+
+def _columnar_format(observations):
+    """The format of a columnar observation file, from the extension of its path, or None for a CSV file or a
+    file-like object."""
+
+    if hasattr(observations, 'read'):
+        return None
+    return COLUMNAR_FORMATS.get(os.path.splitext(os.fspath(observations))[1].lower())
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.feather
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ValueError('pyarrow must be installed to read Parquet, Arrow or Feather observation files.')
+    return pyarrow
+
+
+def _columnar_blocks(observations, block_size, value_dtype, metrics):
+    """Read a Parquet, Arrow or Feather observation file block_size rows at a time, or by the record batches it was
+    written in if block_size is None, generating the ObservationArrays of each block, with the positions of the
+    observations in the file as their rows.
+
+    Note:
+        Arrow and Feather files are memory-mapped, and where they are uncompressed and of one record batch their float64
+        values and timestamps in seconds are held as views of the mapped file rather than copied.  A Parquet file is
+        decompressed a block at a time.
+    """
+
+    pa = _import_pyarrow()
+    with metrics.phase('read'):
+        batches = _columnar_batches(pa, observations, block_size)
+
+    start = 0
+    while True:
+        with metrics.phase('read'):
+            batch = next(batches, None)
+        if batch is None:
+            break
+        with metrics.phase('parse'):
+            curr_obs = _columnar_arrays(pa, batch, start, value_dtype)
+        start += batch.num_rows
+        yield curr_obs
+
+
+def _columnar_batches(pa, observations, block_size):
+    """Open a columnar observation file, checking its columns, and return an iterator of its record batches of at most
+    block_size rows, or those of the file if block_size is None."""
+
+    file_format = _columnar_format(observations)
+    if file_format == 'parquet':
+        parquet_file = pa.parquet.ParquetFile(observations, memory_map=True)
+        _check_observation_columns(parquet_file.schema_arrow.names)
+        return parquet_file.iter_batches(batch_size=block_size or READ_BLOCK_SIZE)
+
+    # A Feather file is an Arrow file, unless it is of version 1, and an Arrow stream has no footer locating its batches
+    source = pa.memory_map(os.fspath(observations))
+    try:
+        table = pa.ipc.open_file(source).read_all()
+    except pa.ArrowInvalid:
+        source.seek(0)
+        if file_format == 'feather':
+            table = pa.feather.read_table(source)
+        else:
+            table = pa.ipc.open_stream(source).read_all()
+    _check_observation_columns(table.column_names)
+    return iter(table.to_batches(max_chunksize=block_size))
+
+
+def _columnar_arrays(pa, batch, start, value_dtype):
+    """Convert a record batch of observations starting at row start of its file to ObservationArrays.  A timestamp
+    column, of any unit or time zone, and a numeric value column are converted as they are, other columns, such as
+    timestamps held as strings, are parsed by check_observation_parse as those of a CSV file are."""
+
+    obs_times = batch.column('datetime')
+    obs_values = batch.column('value')
+    value_type = obs_values.type
+    if not pa.types.is_timestamp(obs_times.type) or not (pa.types.is_floating(value_type) or
+                                                         pa.types.is_integer(value_type) or
+                                                         pa.types.is_decimal(value_type)):
+        curr_obs = batch.to_pandas()
+        curr_obs.index = pd.RangeIndex(start, start + batch.num_rows)
+        return ObservationArrays.from_frame(curr_obs, value_dtype)
+
+    # A missing timestamp is as unparseable as a malformed one, a missing value is held as NaN
+    if obs_times.null_count:
+        _check_converted(pd.RangeIndex(start, start + batch.num_rows),
+                         pd.Series(obs_times.is_null().to_numpy(zero_copy_only=False)), 'datetime')
+    if not pa.types.is_floating(value_type):
+        obs_values = obs_values.cast(pa.float64())
+
+    # The timestamps are truncated to whole seconds, as the result values hold them
+    times = obs_times.to_numpy(zero_copy_only=False).astype('datetime64[s]', copy=False).view(np.int64)
+    values = obs_values.to_numpy(zero_copy_only=False).astype(value_dtype, copy=False)
+    return ObservationArrays(times, values, np.arange(start, start + batch.num_rows, dtype=np.int64))
+
+
+def _deduplicate(curr_obs, metrics, sort=False):
+    """Remove the duplicate observations, counting the rows read and the duplicates dropped."""
+
+    rows = len(curr_obs)
+    with metrics.phase('deduplicate'):
+        curr_obs = remove_duplicate_observations(curr_obs, sort)
+    metrics.count('rows_read', rows)
+    metrics.count('duplicates_dropped', rows - len(curr_obs))
+    return curr_obs
+
+
+def _check_observation_header(observations):
+    """Check the header of an observation file names the expected columns, before the rest of it is read.
+
+    Raises:
+        ObservationParseError:  If the columns are not datetime and value
+
+    Returns:
+        The position of the start of a file-like object, which it is returned to, or None for a path
+    """
+
+    start = observations.tell() if hasattr(observations, 'seek') else None
+    columns = pd.read_csv(observations, header=0, nrows=0).columns
+    if start is not None:
+        observations.seek(start)
+
+    _check_observation_columns(columns)
+    return start
+
+
+def _check_observation_columns(columns):
+    if set(columns) != {'datetime', 'value'} or len(columns) != 2:
+        raise ObservationParseError('The observation file has the wrong column names, or wrong columns, expects: '
+                                    'datetime, value.')
+
+
+def _locate_unparseable_values(observations, start, block_size=None):
+    """Read an observation file that failed to parse again with the values as text, to find the rows whose values are
+    not numeric.
+
+    Returns:
+        An ObservationParseError naming the first offending rows
+    """
+
+    if start is not None:
+        observations.seek(start)
+    elif hasattr(observations, 'read'):
+        return ObservationParseError('Values within the observation file do not conform to their expected type.')
+
+    for curr_obs in pd.read_csv(observations, header=0, dtype=str, chunksize=block_size or 1000000):
+        try:
+            check_observation_parse(curr_obs)
+        except ObservationParseError as error:
+            return error
+
+    return ObservationParseError('Values within the observation file do not conform to their expected type.')
+
+
+def _prefetch(items, depth=1):
+    """Iterate over items from a background thread, keeping up to depth items ready in a bounded queue, so that the
+    next item is produced while the current one is being used.  An exception raised producing an item is raised when
+    that item is reached."""
+
+    ready = queue.Queue(maxsize=depth)
+    finished = object()
+    stopped = threading.Event()
+
+    def produce():
+        try:
+            for item in items:
+                while not stopped.is_set():
+                    try:
+                        ready.put((item, None), timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stopped.is_set():
+                    return
+            ready.put((finished, None))
+        except Exception as error:
+            ready.put((finished, error))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            item, error = ready.get()
+            if error is not None:
+                raise error
+            if item is finished:
+                return
+            yield item
+    finally:
+        # Let the producer stop if the caller gives up part way through
+        stopped.set()
+
+
+def load_manifest(manifest):
+    """Read a manifest of the observation files to load, and the series each belongs to.  A manifest can be a JSON or
+    YAML list of entries, each with the keys: observations, procedure, obs_property, offering and template_metadata,
+    and optionally precision, rollups and incremental, or a CSV file with the columns: observations, procedure,
+    obs_property, offering, and the template_metadata keys feature_identifier, feature_name, feature_lat, feature_lon,
+    result_name, result_definition and result_unit, and optionally precision, rollups as the periods separated by
+    spaces, and incremental.  The incremental mode is the name of one of IncrementalModes, range or timestamps.
+
+    Arguments:
+        manifest:  The path of the manifest, the format is taken from its extension (.json, .yml, .yaml or .csv)
+
+    Note:
+        Relative observation file paths are taken to be relative to the folder holding the manifest.  Reading a YAML
+        manifest needs PyYAML to be installed.
+
+    Raises:
+        ValueError:  If the manifest format is not known, an entry is missing a required key, or names an unknown
+            rollup period or incremental mode
+
+    Returns:
+        A list of dictionaries of the prepare_observations keyword arguments for each file
+    """
+
+    extension = os.path.splitext(manifest)[1].lower()
+    if extension == '.json':
+        with open(manifest) as manifest_file:
+            entries = json.load(manifest_file)
+    elif extension in ('.yml', '.yaml'):
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError('PyYAML must be installed to read a YAML manifest.')
+        with open(manifest) as manifest_file:
+            entries = yaml.safe_load(manifest_file)
+    elif extension == '.csv':
+        entries = []
+        for row in pd.read_csv(manifest, dtype=str, keep_default_na=False).to_dict('records'):
+            entry = {key: row.pop(key, None) for key in MANIFEST_KEYS + ('precision', 'rollups', 'incremental')}
+            entry['template_metadata'] = dict(row)
+            entries.append(entry)
+    else:
+        raise ValueError('The manifest must be a .json, .yml, .yaml or .csv file: {}'.format(manifest))
+
+    manifest_folder = os.path.dirname(os.path.abspath(manifest))
+    loads = []
+    for entry_number, entry in enumerate(entries, 1):
+        missing = [key for key in MANIFEST_KEYS + ('template_metadata',) if not entry.get(key)]
+        if missing:
+            raise ValueError('Manifest entry {} is missing: {}.'.format(entry_number, ', '.join(missing)))
+
+        load = {key: entry[key] for key in MANIFEST_KEYS}
+        load['observations'] = os.path.join(manifest_folder, entry['observations'])
+        load['template_metadata'] = dict(entry['template_metadata'])
+        for coordinate in ('feature_lat', 'feature_lon'):
+            if coordinate in load['template_metadata']:
+                load['template_metadata'][coordinate] = float(load['template_metadata'][coordinate])
+        if entry.get('precision') not in (None, ''):
+            load['precision'] = int(entry['precision'])
+        if entry.get('rollups'):
+            rollups = entry['rollups']
+            load['rollups'] = rollups.split() if isinstance(rollups, str) else list(rollups)
+            try:
+                _check_rollup_periods(load['rollups'])
+            except ValueError as error:
+                raise ValueError('Manifest entry {}: {}'.format(entry_number, error))
+        if entry.get('incremental'):
+            try:
+                load['incremental'] = IncrementalModes[str(entry['incremental']).upper()]
+            except KeyError:
+                raise ValueError('Manifest entry {}: Unknown incremental mode: {}'.format(entry_number,
+                                                                                         entry['incremental']))
+        loads.append(load)
+
+    return loads
+
+
+def run_batch(loads, endpoint, workers=1, session=None, templates=None, **options):
+    """Load many observation files in one process, sharing the connections to the SOS and the template lookups between
+    them.
+
+    Arguments:
+        loads:  A list of dictionaries of the prepare_observations keyword arguments for each file, as returned by
+            load_manifest
+        endpoint:  The URI of the SOS service that listens for requests
+        workers:  The number of files loaded at once
+        session:  An optional SosSession to send the requests through, when not given one is created for the batch
+        templates:  An optional TemplateRegistry to share, when not given one is created for the batch
+        options:  Any further keyword arguments to pass to prepare_observations for every file
+
+    Returns:
+        A list of (observation file, ResultTypes) tuples, in the order of the loads
+    """
+
+    owns_session = session is None
+    if owns_session:
+        session = SosSession()
+    if templates is None:
+        templates = TemplateRegistry()
+
+    def load_file(load):
+        logging.info('Loading observations from: {}'.format(load['observations']))
+        arguments = dict(options)
+        arguments.update(load)
+        return prepare_observations(endpoint=endpoint, session=session, templates=templates, **arguments)
+
+    try:
+        # Look up the templates of every series up front, sending the lookups concurrently.  If the SOS cannot be
+        #  reached each file is left to find its own template, and to report the failure as its result.
+        try:
+            templates.prefill({(load['obs_property'], load['offering']) for load in loads}, endpoint, session)
+        except (OSError, http.client.HTTPException, SosRequestError) as error:
+            logging.warning('The templates could not be looked up in advance: {}'.format(error))
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            results = list(executor.map(load_file, loads))
+    finally:
+        if owns_session:
+            session.close()
+
+    summary = [(load['observations'], result) for load, result in zip(loads, results)]
+    _log_summary(summary)
+    logging.info('Template registry hits: {}, misses: {}.'.format(templates.hits, templates.misses))
+
+    return summary
+
+
+def run_processes(loads, endpoint, processes, max_requests=DEFAULT_GLOBAL_IN_FLIGHT, session=None, templates=None,
+                  **options):
+    """Load many observation files across a pool of processes, so that reading, parsing and encoding them is spread
+    over several cores.  Each process loads one file at a time over its own connections to the SOS, and a governor
+    shared by every process keeps no more than max_requests requests in flight to the SOS at once.
+
+    Arguments:
+        loads:  A list of dictionaries of the prepare_observations keyword arguments for each file, as returned by
+            load_manifest
+        endpoint:  The URI of the SOS service that listens for requests
+        processes:  The number of processes loading files
+        max_requests:  The number of requests in flight from every process together
+        session:  An optional SosSession the templates are found through, whose settings are copied to the sessions of
+            the processes and whose metrics their metrics are merged into, when not given one is created
+        templates:  An optional TemplateRegistry, when not given one is created for the batch
+        options:  Any further keyword arguments to pass to prepare_observations for every file
+
+    Note:
+        The template of every series is found, or created, in this process before any file is loaded, so that the
+        processes do not race to create the same template and only this process writes the template cache.  Each
+        process then sends up to max_in_flight chunks at once, within the limit of the governor.
+
+    Returns:
+        A list of (observation file, ResultTypes) tuples, in the order of the loads
+    """
+
+    owns_session = session is None
+    if owns_session:
+        session = SosSession()
+    if templates is None:
+        templates = TemplateRegistry()
+
+    try:
+        _resolve_templates(loads, endpoint, session, templates, min(DEFAULT_POOL_SIZE, max_requests))
+    finally:
+        if owns_session:
+            session.close()
+
+    # Processes are spawned rather than forked, so none inherits the connections or locks of this one
+    context = multiprocessing.get_context('spawn')
+    governor = context.BoundedSemaphore(max(1, max_requests))
+    with ProcessPoolExecutor(max_workers=max(1, processes), mp_context=context, initializer=_start_process,
+                             initargs=(governor, _session_settings(session), templates.snapshot())) as executor:
+        futures = []
+        for load in loads:
+            arguments = dict(options)
+            arguments.update(load)
+            futures.append(executor.submit(_load_in_process, endpoint, arguments))
+
+        results = []
+        for future in futures:
+            result_name, metrics_snapshot = future.result()
+            session.metrics.merge(metrics_snapshot)
+            results.append(ResultTypes[result_name])
+
+    summary = [(load['observations'], result) for load, result in zip(loads, results)]
+    _log_summary(summary)
+
+    return summary
+
+
+def _resolve_templates(loads, endpoint, session, templates, workers):
+    """Find or create the template of every series in the loads, looking up workers at once, and leaving any that
+    fail for the loads of the series to report."""
+
+    try:
+        templates.prefill({(load['obs_property'], load['offering']) for load in loads}, endpoint, session, workers)
+    except (OSError, http.client.HTTPException, SosRequestError) as error:
+        logging.warning('The templates could not be looked up in advance: {}'.format(error))
+        return
+
+    series = {}
+    for load in loads:
+        series.setdefault((load['obs_property'], load['offering']), load)
+    for load in series.values():
+        try:
+            templates.resolve(load['procedure'], load['obs_property'], load['offering'], load['template_metadata'],
+                              endpoint, session)
+        except (NotImplementedError, OSError, http.client.HTTPException, SosRequestError) as error:
+            logging.warning('The template of {} could not be found or created: {}'.format(load['offering'], error))
+
+
+def _session_settings(session):
+    """The settings of a session, which can be sent to another process to create a session like it."""
+
+    retry_policy = session.retry_policy
+    return {'pool_size': session.pool_size,
+            'timeout': session.timeout,
+            'compression': session.compression,
+            'retry_policy': {'retries': retry_policy.retries,
+                             'backoff': retry_policy.backoff,
+                             'max_backoff': retry_policy.max_backoff,
+                             'breaker_threshold': retry_policy.breaker_threshold,
+                             'breaker_reset': retry_policy.breaker_reset}}
+
+
+# The session and template registry of a process of run_processes, kept between the files it loads
+_process_loader = None
+
+
+def _start_process(governor, session_settings, templates_snapshot):
+    """Create the session and template registry of a process of run_processes."""
+
+    global _process_loader
+
+    settings = dict(session_settings)
+    settings['retry_policy'] = RetryPolicy(**settings['retry_policy'])
+    templates = TemplateRegistry()
+    templates.merge(templates_snapshot)
+    _process_loader = (SosSession(governor=governor, **settings), templates)
+
+
+def _load_in_process(endpoint, arguments):
+    """Load one file in a process of run_processes, returning the name of its ResultTypes and a snapshot of its
+    metrics, which are plain values so that they can be read by the process that started the load whatever the
+    module of this one is named."""
+
+    session, templates = _process_loader
+    session.metrics = LoaderMetrics()
+    logging.info('Loading observations from: {}'.format(arguments['observations']))
+    result = prepare_observations(endpoint=endpoint, session=session, templates=templates, **arguments)
+    return result.name, session.metrics.snapshot()
+
+
+def _log_summary(summary):
+    """Log the result of each file of a batch, and the number of files with each result."""
+
+    for observations, result in summary:
+        logging.info('{}: {}'.format(result.name, observations))
+    for result_type in ResultTypes:
+        logging.info('{} files: {}'.format(result_type.name, sum(result is result_type for _, result in summary)))
+
+
+def follow_observations(loads, endpoint, session=None, templates=None, poll_interval=DEFAULT_POLL_INTERVAL, stop=None,
+                        polls=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT, chunk_size=DEFAULT_CHUNK_SIZE,
+                        value_dtype=VALUE_DTYPES[0], block_size=None):
+    """Follow observation files that loggers keep appending to, sending the rows appended to each since the last poll
+    through save_observations.  The session, and so its keep-alive connections, and the templates are kept between
+    polls, so a poll that finds nothing new sends no requests.
+
+    Arguments:
+        loads:  A list of dictionaries of the prepare_observations keyword arguments for each file, as returned by
+            load_manifest
+        endpoint:  The URI of the SOS service that listens for requests
+        session:  An optional SosSession to send the requests through, when not given one is created
+        templates:  An optional TemplateRegistry, when not given one is created
+        poll_interval:  The seconds waited between polls that found nothing new
+        stop:  An optional threading.Event that stops following once it is set
+        polls:  The number of polls to make before returning, by default following continues until stop is set
+        max_in_flight:  The number of InsertResult chunks that may be sent concurrently
+        chunk_size:  The number of observations sent in each InsertResult request, or an AdaptiveChunkSize
+        value_dtype:  The type the values are held as while they are sent, one of VALUE_DTYPES
+        block_size:  An optional number of rows, when given at most this many are read from each file at a time
+
+    Note:
+        Only rows after the last timestamp sent from a file are sent, so a logger writing in time order, which may
+        repeat rows in a new file after a rotation, never has a row sent twice.  Rows appended out of time order are
+        skipped.  A row that fails to parse is logged and skipped, the rest of its lines are sent.  If the SOS cannot be
+        reached the lines are read and sent again at the next poll.
+
+    Returns:
+        ResultTypes.OBSERVATIONS_OK once following stops, or PARSE_FAILURE if a file is not a CSV file
+    """
+
+    owns_session = session is None
+    if owns_session:
+        session = SosSession()
+    if templates is None:
+        templates = TemplateRegistry()
+    stop = stop or threading.Event()
+
+    columnar = [load['observations'] for load in loads if _columnar_format(load['observations']) is not None]
+    if columnar:
+        logging.error('Only CSV files can be followed, not: {}'.format(', '.join(columnar)))
+        return ResultTypes.PARSE_FAILURE
+
+    followed = [(load, FollowedFile(load['observations'], read_rows=block_size)) for load in loads]
+    options = {'max_in_flight': max_in_flight, 'chunk_size': chunk_size, 'value_dtype': value_dtype}
+    logging.info('Following {} files, polling every {} s.'.format(len(followed), poll_interval))
+    try:
+        poll = 0
+        while not stop.is_set() and (polls is None or poll < polls):
+            more_pending = False
+            for load, followed_file in followed:
+                more_pending |= _send_appended(load, followed_file, endpoint, session, templates, **options)
+
+            poll += 1
+            if not more_pending and (polls is None or poll < polls):
+                stop.wait(poll_interval)
+    finally:
+        for _, followed_file in followed:
+            followed_file.close()
+        if owns_session:
+            session.close()
+
+    return ResultTypes.OBSERVATIONS_OK
+
+
+def _send_appended(load, followed_file, endpoint, session, templates, max_in_flight, chunk_size, value_dtype):
+    """Send the rows appended to a followed file since its last commit, committing them once they are sent.
+
+    Returns:
+        Whether more of the file may already be waiting to be read
+    """
+
+    metrics = session.metrics
+    try:
+        appended = followed_file.read_appended()
+        if appended is None:
+            return False
+
+        curr_obs = _parse_appended(appended, value_dtype, metrics)
+        read_rows = len(curr_obs)
+        if followed_file.last_time is not None:
+            curr_obs = curr_obs[curr_obs.times > followed_file.last_time]
+        metrics.count('rows_skipped', read_rows - len(curr_obs))
+
+        if len(curr_obs):
+            with metrics.phase('template'):
+                template_id, result_encoding, _ = templates.resolve(load['procedure'], load['obs_property'],
+                                                                    load['offering'], load['template_metadata'],
+                                                                    endpoint, session)
+            with metrics.phase('send'):
+                outcomes = save_observations(curr_obs, template_id, endpoint, chunk_size, session, max_in_flight,
+                                             result_encoding, load.get('precision'))
+            logging.info('Sent {} rows appended to {}, {} inserted.'.format(
+                len(curr_obs), load['observations'], sum(outcome.inserted for outcome in outcomes)))
+
+        followed_file.commit(int(curr_obs.times.max()) if len(curr_obs) else None)
+        return followed_file.more_pending
+
+    except NotImplementedError:
+        logging.error('The template of {} did not exist and was unable to be registered.'.format(load['offering']))
+    except ValueError as error:
+        logging.error('The rows appended to {} could not be read: {}'.format(load['observations'], error))
+    except (OSError, http.client.HTTPException, SosRequestError) as error:
+        logging.warning('The rows appended to {} will be sent again, the SOS could not be reached: {}'.format(
+            load['observations'], error))
+    return False
+
+
+def _parse_appended(appended, value_dtype, metrics):
+    """Parse the CSV text of a header and appended lines into ObservationArrays.  If any line fails to parse each is
+    parsed alone, and those that fail are logged and left out."""
+
+    try:
+        return read_observation_arrays(io.StringIO(appended), value_dtype, metrics)
+    except ObservationParseError:
+        header, lines = appended.split('\n', 1)
+        _check_observation_header(io.StringIO(header + '\n'))
+
+    parsed, unparseable = [], []
+    for line in lines.splitlines():
+        try:
+            parsed.append(ObservationArrays.from_frame(check_observation_parse(pd.read_csv(
+                io.StringIO(header + '\n' + line + '\n'), header=0, dtype=OBSERVATION_DTYPES)), value_dtype))
+        except ValueError:
+            unparseable.append(line)
+
+    logging.error('Skipping {} appended rows that could not be parsed, the first: {}'.format(
+        len(unparseable), unparseable[:MAX_REPORTED_ROWS]))
+    metrics.count('rows_unparseable', len(unparseable))
+    return remove_duplicate_observations(ObservationArrays.concatenate(parsed, value_dtype))
+
+
+def identify_template(obs_property, offering, endpoint, session=None):
+    """Use the offering and obs_property parameters to identify whether a result template already
+    exists for this observation stream.  If it does, return its identifier, if not, return False.
+
+    Arguments:
+        obs_property: The property being observed
+        offering:  The offering under which the observations have been entered
+        endpoint:  The URI of the SOS service that listens for requests
+        session:  An optional SosSession to send the request through
+
+    Note:
+        This assumes that a template has a single observed property, and that the columns
+        have been registered as: (phenomenonTime, observation), so that the observation in
+        the 'resultStructure' is the second entry.
+
+    Returns:
+        Either the result template string identifier, or False to indicate not found
+    """
+
+    template_id, _ = identify_template_encoding(obs_property, offering, endpoint, session)
+    return template_id
+
+
+def identify_template_encoding(obs_property, offering, endpoint, session=None):
+    """As identify_template, but also return the result encoding of the template, so that result values can be
+    encoded with the separators the template was registered with.
+
+    Arguments:
+        obs_property: The property being observed
+        offering:  The offering under which the observations have been entered
+        endpoint:  The URI of the SOS service that listens for requests
+        session:  An optional SosSession to send the request through
+
+    Returns:
+        A tuple of the result template string identifier and its tokenSeparator and blockSeparator, or (False, None)
+        to indicate not found
+    """
+
+    result_json = request_json(_template_request(obs_property, offering), endpoint, session)
+    return _found_template(obs_property, offering, result_json)
+
+
+def _template_request(obs_property, offering):
+    """The GetResultTemplate request for the template of the observed property and offering."""
+
+    return {'request': 'GetResultTemplate',
+            'service': 'SOS',
+            'version': '2.0.0',
+            'offering': offering,
+            'observedProperty': obs_property}
+
+
+def _found_template(obs_property, offering, result_json):
+    """The template identifier and result encoding found by a GetResultTemplate request, or (False, None)."""
+
+    if result_json is None or 'exceptions' in result_json:
+        return False, None
+
+    result_encoding = dict(DEFAULT_RESULT_ENCODING)
+    result_encoding.update(result_json.get('resultEncoding', {}))
+    return obs_property + "-" + offering, result_encoding
+
+
+def create_template(procedure, obs_property, offering, template_metadata, endpoint, session=None):
+    """If a template does not already exist within the SOS server, there is an attempt to create it
+    in this function.  The template is encoded, sent, and if successful its ID value is returned,
+    else an error is raised, as without a template this script cannot work.
+
+    Arguments:
+        procedure:  The procedure URI
+        obs_property:  The property being observed
+        offering:  The offering the procedure and property are under
+        template_metadata:  A set of values necessary for registering an observation template (and an observation)
+        endpoint:  The URI of the SOS service that listens for requests
+        session:  An optional SosSession to send the request through
+
+    Raises:
+        NotImplementedError:  If a template cannot be created/implemented, then this error is raised to indicate it.
+
+    Returns:
+        The result template string identifier
+    """
+
+    template_id, template = _template_insertion(procedure, obs_property, offering, template_metadata)
+    if send_request(template, 'acceptedTemplate', True, endpoint, session):
+        return template_id
+    else:
+        raise NotImplementedError("The template could not be created.")
+
+
+def _template_insertion(procedure, obs_property, offering, template_metadata):
+    """The identifier of the template of the series, and the InsertResultTemplate request that creates it."""
+
+    # Create a unique template ID - as observations can only be added through the interface, this naming convention
+    #  should be OK.  It needs to involve the obs_property and offering, as these uniquely identify a template
+    template_id = obs_property + "-" + offering
+
+    template = {
+        "request": "InsertResultTemplate",
+        "service": "SOS",
+        "version": "2.0.0",
+        "identifier": template_id,
+        "offering": offering,
+        "observationTemplate": {
+            "type": "http://www.opengis.net/def/observationType/OGC-OM/2.0/OM_Measurement",
+            "procedure": procedure,
+            "observedProperty": obs_property,
+            "featureOfInterest": {
+                "identifier": {
+                    "value": template_metadata['feature_identifier'],
+                    "codespace": "http://www.opengis.net/def/nil/OGC/0/unknown"
+                },
+                "name": [
+                    {
+                        "value": template_metadata['feature_name'],
+                        "codespace": "http://www.opengis.net/def/nil/OGC/0/unknown"
+                    }
+                ],
+                "sampledFeature": [
+                    "http://www.52north.org/test/featureOfInterest/world"
+                ],
+                "geometry": {
+                    "type": "Point",
+                    "coordinates": [
+                        template_metadata['feature_lat'],
+                        template_metadata['feature_lon']
+                    ],
+                    "crs": {
+                        "type": "name",
+                        "properties": {
+                            "name": "EPSG:4326"
+                        }
+                    }
+                }
+            },
+            "phenomenonTime": "template",
+            "resultTime": "template",
+            "result": ""
+        },
+        "resultStructure": {
+            "fields": [
+                {
+                    "type": "time",
+                    "name": "phenomenonTime",
+                    "definition": "http://www.opengis.net/def/property/OGC/0/PhenomenonTime",
+                    "uom": "http://www.opengis.net/def/uom/ISO-8601/0/Gregorian"
+                },
+                {
+                    "type": "quantity",
+                    "name": template_metadata['result_name'],
+                    "definition": template_metadata['result_definition'],
+                    "uom": template_metadata['result_unit']
+                }
+            ]
+        },
+        "resultEncoding": dict(DEFAULT_RESULT_ENCODING)
+    }
+
+    return template_id, template
+
+
+def check_observation_parse(curr_obs):
+    """Checks that the datetime values are OK and in the correct format, and check that all the
+    observations are either numeric or null, converting the columns that are not yet of those types.
+
+    Arguments:
+        curr_obs:  A pandas dataframe holding the observation data
+
+    Raises:
+        ObservationParseError:  If a value within the file does not conform to the expected types, a ValueError is
+            raised, naming the line numbers in the file of the first offending rows (the header being line 1)
+
+    Returns:
+        A dataframe of the observations, with datetime64 timestamps and float64 values
+    """
+
+    # The column names are checked first, as they are cheap to check
+    _check_observation_columns(curr_obs.columns)
+
+    obs_times = curr_obs['datetime']
+    if not pd.api.types.is_datetime64_any_dtype(obs_times):
+        obs_times = pd.to_datetime(obs_times, errors='coerce', format=DATETIME_FORMAT, exact=True)
+        _check_converted(curr_obs.index, obs_times.isna(), 'datetime')
+
+    obs_values = curr_obs['value']
+    if not pd.api.types.is_float_dtype(obs_values):
+        obs_values = pd.to_numeric(obs_values, errors='coerce')
+        _check_converted(curr_obs.index, obs_values.isna() & curr_obs['value'].notna(), 'value')
+
+    return pd.DataFrame({'datetime': obs_times, 'value': obs_values.astype('float64')}, index=curr_obs.index)
+
+
+def _check_converted(index, unparsed, column):
+    if unparsed.any():
+        rows = index[unparsed.values][:MAX_REPORTED_ROWS]
+        raise ObservationParseError('Values within the observation file do not conform to their expected type, in '
+                                    'the {} column.'.format(column),
+                                    [row + 2 for row in rows])
+
+
+def remove_duplicate_observations(curr_obs, sort=False):
+    """Removes observations that have duplicate timestamps, with the last observation of duplicates being the one that
+    is kept.  Only the timestamp is checked, not the value, as a single sensor cannot have more than one value for the
+    same sensor/property.
+
+    Arguments:
+        curr_obs:  A pandas dataframe holding the observation data, or ObservationArrays of it
+        sort:  Whether to order the observations by time, so that each InsertResult chunk covers a contiguous window
+            of time, rather than keeping them in the order of the file
+
+    Note:
+        A dataframe is changed in place, as it always has been, and should have a unique index.
+
+    Returns:
+        A similar dataframe to that past as curr_obs, with the duplicates removed, or ObservationArrays without them
+    """
+    if isinstance(curr_obs, ObservationArrays):
+        kept = _kept_positions(curr_obs.times, sort)
+        return curr_obs if kept is None else curr_obs[kept]
+
+    times = curr_obs['datetime'].to_numpy()
+    # Timestamps of any unit compare as their integers, the fixed format strings of an unparsed file compare as text
+    times = times.view(np.int64) if np.issubdtype(times.dtype, np.datetime64) else times
+    kept = _kept_positions(times)
+    if kept is not None:
+        dropped = np.ones(times.shape[0], dtype=bool)
+        dropped[kept] = False
+        curr_obs.drop(index=curr_obs.index[dropped], inplace=True)
+    if sort:
+        curr_obs.sort_values('datetime', inplace=True)
+    return curr_obs
+
+
+def _kept_positions(times, sort=False):
+    """Find the observations to keep of those with the same timestamp, the last of each, without hashing them.  Input
+    that is already in order, as logger exports almost always are, is checked in one pass and its duplicates are the
+    runs of equal neighbours.  Otherwise the positions are sorted stably by time, so the last of each run of equal
+    times is the last in the file.
+
+    Arguments:
+        times:  The timestamps, as an array of integers or of strings that sort in time order
+        sort:  Whether to return the positions in time order, rather than in the order of the file
+
+    Returns:
+        An array of the positions of the observations to keep, in the order to keep them, or None if every
+        observation is kept where it is
+    """
+
+    if times.shape[0] < 2:
+        return None
+
+    if (times[1:] >= times[:-1]).all():
+        later_differs = times[1:] != times[:-1]
+        if later_differs.all():
+            return None
+        return np.flatnonzero(np.append(later_differs, True))
+
+    order = np.argsort(times, kind='stable')
+    sorted_times = times[order]
+    last_of_run = np.append(sorted_times[1:] != sorted_times[:-1], True)
+    if last_of_run.all() and not sort:
+        return None
+
+    kept = order[last_of_run]
+    return kept if sort else np.sort(kept)
+
+
+def remove_stored_observations(curr_obs, procedure, obs_property, offering, endpoint, mode, session=None,
+                               result_encoding=None):
+    """Removes the observations that the SOS already holds for the series, so that re-loading a file that overlaps
+    with earlier loads only sends the new observations.  The phenomenon time range held for the series is found with
+    a GetDataAvailability request, and for the TIMESTAMPS mode the timestamps within the part of that range the
+    observations overlap are fetched with a GetResult request.
+
+    Arguments:
+        curr_obs:  The ObservationArrays of the observations, or a pandas dataframe holding them
+        procedure:  The procedure URI
+        obs_property:  The property being observed
+        offering:  The offering the procedure and property are under
+        endpoint:  The URI of the SOS service that listens for requests
+        mode:  The IncrementalModes value deciding how stored observations are found
+        session:  An optional SosSession to send the requests through
+        result_encoding:  The tokenSeparator and blockSeparator of the template, defaults to DEFAULT_RESULT_ENCODING
+
+    Note:
+        Timestamps without a time zone in the observations are compared with the SOS timestamps as UTC.
+
+    Returns:
+        The observations that are not yet held by the SOS, of the same type as curr_obs
+    """
+
+    stored_range = get_stored_time_range(procedure, obs_property, offering, endpoint, session)
+    return _remove_within_stored_range(curr_obs, stored_range, obs_property, offering, endpoint, mode, session,
+                                       result_encoding)
+
+
+def _remove_within_stored_range(curr_obs, stored_range, obs_property, offering, endpoint, mode, session=None,
+                                result_encoding=None):
+    """As remove_stored_observations, given the stored time range of the series as get_stored_time_range found it."""
+
+    if stored_range is None:
+        return curr_obs
+
+    obs_times, within_stored = _within_stored_range(curr_obs, stored_range)
+    if mode is IncrementalModes.TIMESTAMPS and within_stored.any():
+        # Only ask for the stored timestamps where the observations overlap the stored range
+        overlap_times = obs_times[within_stored]
+        stored_times = get_stored_times(obs_property, offering, endpoint, overlap_times.min(), overlap_times.max(),
+                                        session, result_encoding)
+        within_stored = obs_times.isin(stored_times).values
+
+    logging.info('Skipping {} observations already held by the SOS.'.format(within_stored.sum()))
+    return curr_obs[~within_stored]
+
+
+def _within_stored_range(curr_obs, stored_range):
+    """The timestamps of the observations as a pandas Series, and a mask of those within the stored range."""
+
+    if isinstance(curr_obs, ObservationArrays):
+        obs_times = pd.Series(curr_obs.datetimes.astype('datetime64[ns]'))
+    else:
+        obs_times = check_observation_parse(curr_obs)['datetime']
+    first_stored, last_stored = stored_range
+    return obs_times, ((obs_times >= first_stored) & (obs_times <= last_stored)).values
+
+
+def get_stored_time_range(procedure, obs_property, offering, endpoint, session=None):
+    """Find the phenomenon time range of the observations the SOS holds for the series using GetDataAvailability.
+
+    Arguments:
+        procedure:  The procedure URI
+        obs_property:  The property being observed
+        offering:  The offering the procedure and property are under
+        endpoint:  The URI of the SOS service that listens for requests
+        session:  An optional SosSession to send the request through
+
+    Returns:
+        A tuple of the first and last stored timestamps, as UTC timestamps without a time zone, or None if the SOS holds
+        no observations for the series
+    """
+
+    result_json = request_json(_availability_request(procedure, obs_property, offering), endpoint, session)
+    return _stored_time_range(result_json)
+
+
+def _availability_request(procedure, obs_property, offering):
+    """The GetDataAvailability request for the series."""
+
+    return {'request': 'GetDataAvailability',
+            'service': 'SOS',
+            'version': '2.0.0',
+            'procedure': procedure,
+            'observedProperty': obs_property,
+            'offering': offering}
+
+
+def _stored_time_range(result_json):
+    """The first and last stored timestamps of a GetDataAvailability response, or None if there are none."""
+
+    if result_json is None or not result_json.get('dataAvailability'):
+        return None
+
+    # Every feature of interest has its own entry, so take the range covering all of them
+    phenomenon_times = _to_utc_times([time_value
+                                      for availability in result_json['dataAvailability']
+                                      for time_value in availability['phenomenonTime']])
+    return phenomenon_times.min(), phenomenon_times.max()
+
+
+def get_stored_times(obs_property, offering, endpoint, start, end, session=None, result_encoding=None):
+    """Fetch the phenomenon timestamps of the observations the SOS holds for the template between two times, using a
+    GetResult request with a temporal filter.
+
+    Arguments:
+        obs_property:  The property being observed
+        offering:  The offering the procedure and property are under
+        endpoint:  The URI of the SOS service that listens for requests
+        start:  The first timestamp to fetch
+        end:  The last timestamp to fetch
+        session:  An optional SosSession to send the request through
+        result_encoding:  The tokenSeparator and blockSeparator of the template, defaults to DEFAULT_RESULT_ENCODING
+
+    Returns:
+        A pandas DatetimeIndex of the stored timestamps, as UTC timestamps without a time zone
+    """
+
+    result_json = request_json(_stored_times_request(obs_property, offering, start, end), endpoint, session)
+    return _stored_times(result_json, result_encoding)
+
+
+def _stored_times_request(obs_property, offering, start, end):
+    """The GetResult request for the observations of the template between two times."""
+
+    # Widen the filter by a second either side, as the ends of a 'during' filter are not always included
+    return {'request': 'GetResult',
+            'service': 'SOS',
+            'version': '2.0.0',
+            'offering': offering,
+            'observedProperty': obs_property,
+            'temporalFilter': {
+                'during': {
+                    'ref': 'om:phenomenonTime',
+                    'value': [(start - pd.Timedelta(seconds=1)).strftime(DATETIME_FORMAT) + 'Z',
+                              (end + pd.Timedelta(seconds=1)).strftime(DATETIME_FORMAT) + 'Z']
+                }
+            }}
+
+
+def _stored_times(result_json, result_encoding=None):
+    """The stored timestamps of a GetResult response, as a pandas DatetimeIndex."""
+
+    if result_json is None or not result_json.get('resultValues'):
+        return pd.DatetimeIndex([])
+
+    result_encoding = result_encoding or DEFAULT_RESULT_ENCODING
+    stored = decode_result_values(result_json['resultValues'],
+                                  result_encoding['tokenSeparator'],
+                                  result_encoding['blockSeparator'])
+    return pd.DatetimeIndex(stored['datetime'])
+
+
+def rollup_property(obs_property, period, statistic):
+    """The observed property of the companion series holding a statistic of a series over a period, such as
+    <obs_property>_daily_mean, whose template is named from it as any other."""
+    return '{}_{}_{}'.format(obs_property, period, statistic)
+
+
+def compute_rollups(curr_obs, period):
+    """Roll a series up into the mean, min, max and count of its values over each period it covers.
+
+    Arguments:
+        curr_obs:  The ObservationArrays of the observations, or a pandas dataframe holding them
+        period:  The period to roll up over, one of ROLLUP_PERIODS
+
+    Note:
+        Periods start at midnight UTC, and missing values are left out of every statistic, so a period of only missing
+        values has a count of 0 and a missing mean, min and max.
+
+    Returns:
+        A dictionary of each statistic of ROLLUP_STATISTICS to float64 ObservationArrays of its value over each period,
+        in time order, timestamped with the start of the period
+    """
+
+    curr_obs = _as_arrays(curr_obs)
+    starts, aggregates = _period_aggregates(curr_obs, ROLLUP_PERIODS[period])
+    return _rollup_statistics(starts, aggregates)
+
+
+def _save_rollups(rollup_periods, procedure, obs_property, offering, template_metadata, endpoint, session=None,
+                  templates=None, stored_range=None, max_in_flight=1, chunk_size=DEFAULT_CHUNK_SIZE,
+                  result_encoding=None):
+    """Recompute the rollups of the periods touched by the observations a load has sent, and send those of the periods
+    that are complete to the companion series of each statistic, creating their templates where they do not exist.
+
+    Arguments:
+        rollup_periods:  The _RollupPeriods the sent observations were added to
+        procedure:  The procedure URI
+        obs_property:  The property being observed
+        offering:  The offering the procedure and property are under
+        template_metadata:  The template metadata of the series, from which that of each companion series is made
+        endpoint:  The URI of the SOS service that listens for requests
+        session:  An optional SosSession to send the requests through
+        templates:  An optional TemplateRegistry the companion templates are found through
+        stored_range:  The stored time range of the series before the load, as get_stored_time_range found it
+        max_in_flight:  The number of InsertResult chunks that may be sent concurrently
+        chunk_size:  The number of rollup observations sent in each InsertResult request
+        result_encoding:  The tokenSeparator and blockSeparator of the template of the series
+
+    Note:
+        A period is complete once the series has an observation in a later one, so the last period of a series waits
+        for the next load.  Periods the SOS may hold other observations for, those within the stored range or touched
+        by more than one block, are recomputed from the observations fetched back from the SOS.  The rollups of a
+        complete period cannot be replaced, so those recomputed for one a later load adds to are rejected as stored.
+
+    Raises:
+        NotImplementedError:  If a companion template does not exist and cannot be created
+        SosRequestError:  If the stored observations of a period cannot be fetched
+
+    Returns:
+        A list of ChunkOutcome of the rollups sent
+    """
+
+    if templates is None:
+        templates = TemplateRegistry()
+
+    outcomes = []
+    for period in rollup_periods.periods:
+        starts, aggregates, runs = rollup_periods.plan(period, stored_range)
+        fetched = [_fetch_stored_observations(obs_property, offering, endpoint, start, end, session, result_encoding)
+                   for start, end in runs]
+        rollups = rollup_periods.rollups(period, starts, aggregates, fetched, session)
+        for statistic, rollup_obs in rollups.items():
+            rollup_obs_property = rollup_property(obs_property, period, statistic)
+            template_id, rollup_encoding, _ = templates.resolve(
+                procedure, rollup_obs_property, offering,
+                _rollup_metadata(template_metadata, rollup_obs_property, period, statistic), endpoint, session)
+            outcomes += save_observations(rollup_obs, template_id, endpoint, chunk_size, session, max_in_flight,
+                                          rollup_encoding)
+    return outcomes
+
+
+class _RollupPeriods(object):
+    """The sum, count, min and max of the values a load sends over each period they touch, added a block at a time,
+    with the number of blocks that touched each period."""
+
+    def __init__(self, periods):
+        self.periods = tuple(periods)
+        self.last_time = None
+        self._parts = {period: [] for period in self.periods}
+
+    def add(self, curr_obs):
+        if not len(curr_obs):
+            return
+        for period in self.periods:
+            self._parts[period].append(_period_aggregates(curr_obs, ROLLUP_PERIODS[period]))
+        last_time = int(curr_obs.times.max())
+        self.last_time = last_time if self.last_time is None else max(self.last_time, last_time)
+
+    def plan(self, period, stored_range):
+        """Find the complete periods touched by the load, those whose aggregates are known from the observations added,
+        and the (start, end) runs of the others, whose observations are fetched back from the SOS.
+
+        Returns:
+            A tuple of the period starts and aggregates known, and a list of the runs to fetch
+        """
+
+        unit = ROLLUP_PERIODS[period]
+        parts = self._parts[period]
+        if self.last_time is None:
+            return np.empty(0, np.int64), np.empty((5, 0)), []
+
+        starts, aggregates = _grouped_aggregates(np.concatenate([part[0] for part in parts]),
+                                                 np.column_stack([part[1] for part in parts]))
+        refetch = aggregates[4] > 1
+        last_time = self.last_time
+        if stored_range is not None:
+            stored_first, stored_last = np.array(stored_range, dtype='datetime64[s]').view(np.int64)
+            last_time = max(last_time, stored_last)
+            # The period that was still open before the load may now be complete
+            starts, aggregates = _grouped_aggregates(np.append(starts, _period_starts([stored_last], unit)),
+                                                     np.column_stack([aggregates, [0, 0, np.nan, np.nan, 0]]))
+            refetch = (aggregates[4] > 1) | ((starts <= stored_last) & (_period_ends(starts, unit) > stored_first))
+
+        complete = starts < _period_starts([last_time], unit)[0]
+        kept = ~refetch & complete
+        return starts[kept], aggregates[:, kept], _fetch_runs(starts[refetch & complete], unit)
+
+    def rollups(self, period, starts, aggregates, fetched, session=None):
+        """The ObservationArrays of each statistic of the periods planned, from the aggregates known and the
+        ObservationArrays fetched for the others."""
+
+        unit = ROLLUP_PERIODS[period]
+        fetched = [_period_aggregates(stored, unit) for stored in fetched]
+        starts, aggregates = _grouped_aggregates(np.concatenate([starts] + [part[0] for part in fetched]),
+                                                 np.column_stack([aggregates] + [part[1] for part in fetched]))
+        logging.info('Sending the {} rollups of {} periods, {} recomputed from the SOS.'.format(
+            period, len(starts), sum(len(part[0]) for part in fetched)))
+        _metrics_of(session).count('rollup_periods', len(starts))
+        return _rollup_statistics(starts, aggregates)
+
+
+def _check_rollup_periods(rollups):
+    """Raise a ValueError if the rollup periods are a single string rather than a collection of them, or any of them is
+    not one of ROLLUP_PERIODS."""
+
+    if isinstance(rollups, str):
+        raise ValueError('The rollup periods must be a list of periods, not the string: {}'.format(rollups))
+    unknown_periods = set(rollups) - set(ROLLUP_PERIODS)
+    if unknown_periods:
+        raise ValueError('Unknown rollup periods: {}'.format(', '.join(sorted(unknown_periods))))
+
+
+def _period_starts(times, unit):
+    """The int64 epoch seconds of the start of the period of each time, in UTC."""
+    return np.asarray(times, np.int64).view('datetime64[s]').astype('datetime64[' + unit + ']').astype(
+        'datetime64[s]').view(np.int64)
+
+
+def _period_ends(starts, unit):
+    """The int64 epoch seconds of the end of each period, the start of the next."""
+    return (starts.view('datetime64[s]').astype('datetime64[' + unit + ']') + 1).astype('datetime64[s]').view(np.int64)
+
+
+def _period_aggregates(curr_obs, unit):
+    """The starts of the periods the observations touch, and the aggregates of each as the rows of sum, count, min,
+    max and blocks, the values being reduced over the observations sorted by period without a row per observation."""
+
+    starts = _period_starts(curr_obs.times, unit)
+    values = curr_obs.values.astype(np.float64, copy=False)
+    if len(starts) and (starts[1:] < starts[:-1]).any():
+        order = np.argsort(starts, kind='stable')
+        starts, values = starts[order], values[order]
+    if not len(starts):
+        return starts, np.empty((5, 0))
+
+    first = np.flatnonzero(np.r_[True, starts[1:] != starts[:-1]])
+    valid = ~np.isnan(values)
+    return starts[first], np.vstack([np.add.reduceat(np.where(valid, values, 0.0), first),
+                                     np.add.reduceat(valid.astype(np.float64), first),
+                                     np.fmin.reduceat(values, first),
+                                     np.fmax.reduceat(values, first),
+                                     np.ones(len(first))])
+
+
+def _grouped_aggregates(starts, aggregates):
+    """Combine the aggregates of the same period start, given as columns of sum, count, min, max and blocks."""
+
+    if not len(starts):
+        return starts.astype(np.int64), np.empty((5, 0))
+
+    order = np.argsort(starts, kind='stable')
+    starts, aggregates = starts[order], aggregates[:, order]
+    first = np.flatnonzero(np.r_[True, starts[1:] != starts[:-1]])
+    return starts[first], np.vstack([np.add.reduceat(aggregates[0], first),
+                                     np.add.reduceat(aggregates[1], first),
+                                     np.fmin.reduceat(aggregates[2], first),
+                                     np.fmax.reduceat(aggregates[3], first),
+                                     np.add.reduceat(aggregates[4], first)])
+
+
+def _rollup_statistics(starts, aggregates):
+    """The ObservationArrays of each statistic from the aggregates of each period."""
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = aggregates[0] / aggregates[1]
+    statistics = {'mean': means, 'min': aggregates[2], 'max': aggregates[3], 'count': aggregates[1]}
+    return {statistic: ObservationArrays(starts, statistics[statistic]) for statistic in ROLLUP_STATISTICS}
+
+
+def _fetch_runs(starts, unit):
+    """Join the periods into runs of consecutive periods, of up to ROLLUP_FETCH_PERIODS, each fetched with one
+    request, as (start, end) epoch seconds."""
+
+    runs = []
+    for start, end in zip(starts.tolist(), _period_ends(starts, unit).tolist()):
+        if runs and runs[-1][1] == start and runs[-1][2] < ROLLUP_FETCH_PERIODS:
+            runs[-1][1:] = [end, runs[-1][2] + 1]
+        else:
+            runs.append([start, end, 1])
+    return [(start, end) for start, end, _ in runs]
+
+
+def _fetch_stored_observations(obs_property, offering, endpoint, start, end, session=None, result_encoding=None):
+    """The ObservationArrays the SOS holds for the template from start up to end, as epoch seconds, with GetResult."""
+
+    status, reply, failure = _post_json(_stored_observations_request(obs_property, offering, start, end), endpoint,
+                                        session)
+    return _stored_observations(status, reply, failure, start, end, result_encoding)
+
+
+def _stored_observations_request(obs_property, offering, start, end):
+    """The GetResult request for the observations of the template from start up to end, as epoch seconds."""
+    return _stored_times_request(obs_property, offering, pd.Timestamp(start, unit='s'), pd.Timestamp(end, unit='s'))
+
+
+def _stored_observations(status, reply, failure, start, end, result_encoding=None):
+    """The ObservationArrays of a GetResult response from start up to end, as epoch seconds.
+
+    Raises:
+        SosRequestError:  If the SOS answered with an error
+    """
+
+    if not 200 <= status < 300:
+        raise SosRequestError('GetResult from {} to {} failed with status {}: {}'.format(
+            pd.Timestamp(start, unit='s'), pd.Timestamp(end, unit='s'), status, reply), failure, status)
+
+    result_encoding = result_encoding or DEFAULT_RESULT_ENCODING
+    stored = decode_result_arrays((reply or {}).get('resultValues') or '', result_encoding['tokenSeparator'],
+                                  result_encoding['blockSeparator'])
+    return remove_duplicate_observations(stored[(stored.times >= start) & (stored.times < end)])
+
+
+def _rollup_metadata(template_metadata, rollup_obs_property, period, statistic):
+    """The template metadata of the companion series of a statistic, that of the series with its own result."""
+
+    metadata = dict(template_metadata, result_definition=rollup_obs_property)
+    if 'result_name' in metadata:
+        metadata['result_name'] = '{}_{}_{}'.format(metadata['result_name'], period, statistic)
+    if statistic == 'count':
+        metadata['result_unit'] = ROLLUP_COUNT_UNIT
+    return metadata
+
+
+def decode_result_values(result_values, token_separator, block_separator):
+    """Decode a SWE text encoded result values string, as returned by GetResult, into a dataframe of observations.
+
+    Arguments:
+        result_values:  The encoded result values
+        token_separator:  The separator between the fields of an observation
+        block_separator:  The separator between observations
+
+    Note:
+        Blocks whose first field is not a timestamp, such as the block count some servers put first, are dropped.
+
+    Returns:
+        A pandas dataframe with a datetime column of UTC timestamps without a time zone, and a float value column
+    """
+
+    blocks = pd.Series(result_values.split(block_separator))
+    # The separator is escaped, as pandas takes a pattern of more than one character as a regular expression
+    fields = blocks.str.split(re.escape(token_separator), n=1, expand=True).reindex(columns=[0, 1])
+    fields = fields[fields[0].str.match(r'\d{4}-\d{2}-\d{2}T', na=False)]
+
+    return pd.DataFrame({'datetime': _to_utc_times(fields[0]).values,
+                         'value': pd.to_numeric(fields[1], errors='coerce').values})
+
+
+def decode_result_arrays(result_values, token_separator, block_separator, value_dtype=VALUE_DTYPES[0]):
+    """Decode a SWE text encoded result values string, as returned by GetResult, into ObservationArrays, working on the
+    bytes of the string as arrays rather than splitting it into a string per observation.  The timestamps are parsed
+    from their digits where every one has the same layout, as a SOS writes them: %Y-%m-%dT%H:%M:%S, optionally with
+    fractional seconds, and a Z or +HH:MM offset.  Result values that do not fit, or have a value that is not a number,
+    are decoded by decode_result_values instead.
+
+    Arguments:
+        result_values:  The encoded result values
+        token_separator:  The separator between the fields of an observation
+        block_separator:  The separator between observations
+        value_dtype:  The type to hold the values as, one of VALUE_DTYPES
+
+    Note:
+        Blocks without a token separator, such as the block count some servers put first, are dropped.  The
+        timestamps are truncated to whole seconds, as the loader sends them.
+
+    Returns:
+        The ObservationArrays of the result values, in the order they were given, with their positions in it as rows
+    """
+
+    decoded = _decode_fixed_layout(result_values, token_separator, block_separator)
+    if decoded is None:
+        curr_obs = decode_result_values(result_values, token_separator, block_separator)
+        return ObservationArrays(curr_obs['datetime'].to_numpy().astype('datetime64[s]').view(np.int64),
+                                 curr_obs['value'].to_numpy(dtype=value_dtype))
+
+    times, value_fields = decoded
+    try:
+        values = np.array(value_fields).astype(np.float64)
+    except ValueError:
+        values = pd.to_numeric(pd.Series(value_fields).str.decode('utf-8'), errors='coerce').to_numpy(np.float64)
+    return ObservationArrays(times, values.astype(value_dtype, copy=False))
+
+
+def _decode_fixed_layout(result_values, token_separator, block_separator):
+    """Find the timestamps and value fields of result values whose timestamps all have the same layout.
+
+    Returns:
+        A tuple of the int64 epoch seconds and a list of the value fields as bytes, or None if the separators are not
+        single characters, a block has more than two fields, or the timestamps are not all of one known layout
+    """
+
+    if len(token_separator) != 1 or len(block_separator) != 1:
+        return None
+    encoded = result_values.encode('utf-8')
+    data = np.frombuffer(encoded, np.uint8)
+    block_ends = np.flatnonzero(data == ord(block_separator))
+    tokens = np.flatnonzero(data == ord(token_separator))
+
+    # The block of each token is the number of block separators before it
+    token_blocks = np.searchsorted(block_ends, tokens)
+    if (token_blocks[1:] == token_blocks[:-1]).any():
+        return None
+    block_starts = np.concatenate(([0], block_ends + 1))[token_blocks]
+    if not tokens.shape[0]:
+        return np.empty(0, np.int64), []
+
+    width = tokens[0] - block_starts[0]
+    if (tokens - block_starts != width).any() or width < 19:
+        return None
+    # The windows of width bytes starting at each byte, as a view of the data, from which the blocks are taken
+    windows = np.lib.stride_tricks.as_strided(data, (data.shape[0] - width + 1, width), data.strides * 2,
+                                              writeable=False)
+    fields = windows[block_starts]
+
+    def number(first, last):
+        digits = fields[:, first:last] - np.uint8(ord('0'))
+        if (digits > 9).any():
+            raise ValueError
+        return digits.astype(np.int64) @ 10 ** np.arange(last - first - 1, -1, -1, dtype=np.int64)
+
+    def all_are(column, characters):
+        return np.isin(fields[:, column], [ord(character) for character in characters]).all()
+
+    try:
+        if not all(all_are(column, character) for column, character in ((4, '-'), (7, '-'), (10, 'T'), (13, ':'),
+                                                                          (16, ':'))):
+            return None
+        year, month, day = number(0, 4), number(5, 7), number(8, 10)
+        hour, minute, second = number(11, 13), number(14, 16), number(17, 19)
+        if ((hour > 23) | (minute > 59) | (second > 59)).any():
+            return None
+        seconds = hour * 3600 + minute * 60 + second
+
+        # Fractional seconds are truncated, then the offset is taken from the time to give UTC
+        zone = 19
+        if zone < width and all_are(zone, '.'):
+            zone += 1
+            while zone < width and chr(fields[0, zone]).isdigit():
+                number(zone, zone + 1)
+                zone += 1
+        if width - zone == 1 and all_are(zone, 'Z'):
+            pass
+        elif width - zone == 6 and all_are(zone, '+-') and all_are(zone + 3, ':'):
+            sign = np.where(fields[:, zone] == ord('-'), -1, 1)
+            seconds -= sign * (number(zone + 1, zone + 3) * 3600 + number(zone + 4, zone + 6) * 60)
+        elif width != zone:
+            return None
+    except ValueError:
+        return None
+
+    months = (year - 1970) * 12 + month - 1
+    month_starts = months.astype('datetime64[M]').astype('datetime64[D]').view(np.int64)
+    month_days = (months + 1).astype('datetime64[M]').astype('datetime64[D]').view(np.int64) - month_starts
+    if ((month < 1) | (month > 12) | (day < 1) | (day > month_days)).any():
+        return None
+    times = (month_starts + day - 1) * 86400 + seconds
+
+    # Each value runs from its token to the end of its block, the values are kept with the separators after them and
+    #  split apart in one pass
+    value_ends = np.append(block_ends, data.shape[0])[token_blocks]
+    bounds = np.zeros(data.shape[0] + 1, np.int8)
+    bounds[tokens + 1] += 1
+    bounds[value_ends] -= 1
+    kept = np.cumsum(bounds[:-1], dtype=np.int8) > 0
+    kept[value_ends[value_ends < data.shape[0]]] = True
+    return times, data[kept].tobytes().split(block_separator.encode('utf-8'))[:tokens.shape[0]]
+
+
+def _to_utc_times(time_values):
+    """Parse ISO 8601 timestamps with an offset to UTC timestamps without a time zone, which is how timestamps in the
+    observation files are compared."""
+    return pd.to_datetime(pd.Series(time_values), utc=True).dt.tz_convert(None)
+
+
+def save_observations(curr_obs, result_template, endpoint, chunk_size, session=None, max_in_flight=1,
+                      result_encoding=None, precision=None, journal=None):
+    """Takes the observations parameter and opens the CSV file it represents, then inserts
+    these observations against the endpoint.
+
+    Arguments:
+        curr_obs:  The ObservationArrays of the current set of observations to be saved, or a Pandas DataFrame of them
+        result_template:  The template ID value to insert the observations against
+        endpoint:  The endpoint URI to send requests to
+        chunk_size:  The number of observations to be inserted in the same request, or an AdaptiveChunkSize to choose
+            the size of each chunk from the response times of the chunks before it
+        session:  An optional SosSession to send the requests through
+        max_in_flight:  The number of chunks that may be formatted or waiting on the SOS at once, when greater than
+            one the chunks are sent concurrently from a pool of threads
+        result_encoding:  The tokenSeparator and blockSeparator of the template, defaults to DEFAULT_RESULT_ENCODING
+        precision:  An optional number of decimal places to round the values to before they are sent
+        journal:  An optional UploadJournal to commit the rows of each chunk to once the SOS has answered it
+
+    Returns:
+        A list of ChunkOutcome, one for each chunk in the order the chunks appear in curr_obs
+    """
+
+    # Chunks are sliced from the arrays as views, rather than copied from a dataframe
+    curr_obs = _as_arrays(curr_obs)
+    result_encoding = result_encoding or DEFAULT_RESULT_ENCODING
+    encode = functools.partial(encode_result_values,
+                               token_separator=result_encoding['tokenSeparator'],
+                               block_separator=result_encoding['blockSeparator'],
+                               precision=precision)
+    chunk_sizer = chunk_size if isinstance(chunk_size, AdaptiveChunkSize) else None
+
+    # Send each chunk in turn, waiting for the response before formatting the next
+    if max_in_flight <= 1:
+        outcomes = [_insert_chunk(curr_obs, start_offset, curr_size, result_template, endpoint, session, encode,
+                                  chunk_sizer, journal)
+                    for start_offset, curr_size in _chunk_offsets(len(curr_obs), chunk_size)]
+    else:
+        # Only max_in_flight chunks may be formatted and not yet answered, so the next chunk is not formatted until
+        #  a slot is released, which keeps the memory held by pending chunks bounded
+        in_flight = threading.BoundedSemaphore(max_in_flight)
+
+        def insert_and_release(start_offset, curr_size):
+            try:
+                return _insert_chunk(curr_obs, start_offset, curr_size, result_template, endpoint, session, encode,
+                                     chunk_sizer, journal)
+            finally:
+                in_flight.release()
+
+        def acquired_offsets():
+            # The slot is taken before the size of the next chunk is chosen, so it reflects the latest responses
+            for offset in _chunk_offsets(len(curr_obs), chunk_size, in_flight.acquire):
+                yield offset
+
+        futures = []
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            for start_offset, curr_size in acquired_offsets():
+                futures.append(executor.submit(insert_and_release, start_offset, curr_size))
+
+        outcomes = [future.result() for future in futures]
+
+    if chunk_sizer is not None and outcomes:
+        logging.info('Adaptive chunk size is now {} observations.'.format(chunk_sizer.size))
 
-    Note:
-        Templates are assumed to be of the format: "ObservedPropertyValue-OfferingValue".  If they are not of this
-        format the script needs updating, it is required that they be standardized in some way, using the parameters
-        provided to this script.
+    return outcomes
 
-    observations -- CSV file containing two columns in the following order: (datetime, value), where datetime is in
-        the format %Y-%m-%dT%H:%M:%S, and value is numeric.
-    procedure -- The procedure URI
-    obs_property -- The property being observed
-    offering -- The offering the procedure and property are under
-    template_metadata -- A set of values necessary for registering an observation template (and an observation)
-    endpoint -- The URI of the SOS service that listens for requests
+
+def _chunk_offsets(rows, chunk_size, before_chunk=None):
+    """Generate the (start offset, size) of each chunk of rows observations, asking an AdaptiveChunkSize for the size
+    of each chunk as it is reached, calling before_chunk first if given."""
+
+    start_offset = 0
+    while start_offset < rows:
+        if before_chunk is not None:
+            before_chunk()
+        curr_size = chunk_size.next_size() if isinstance(chunk_size, AdaptiveChunkSize) else chunk_size
+        yield start_offset, curr_size
+        start_offset += curr_size
+
+
+def encode_result_values(curr_obs, token_separator=',', block_separator='#', precision=None):
+    """Encode a set of observations as the result values string of an InsertResult request.  The timestamps are
+    formatted a column at a time, while the values are written one by one by repr, which numpy string operations on
+    the column are no faster than.
+
+    Arguments:
+        curr_obs:  The ObservationArrays of the observations, or a pandas dataframe holding them
+        token_separator:  The separator between the timestamp and value of an observation
+        block_separator:  The separator between observations
+        precision:  An optional number of decimal places to round the values to, which shortens the encoding of
+            values from sensors with only a few digits of precision
+
+    Returns:
+        The encoded result values, with the values written as str() would write them
+    """
+
+    if isinstance(curr_obs, ObservationArrays):
+        times = np.datetime_as_string(curr_obs.datetimes)
+        values = curr_obs.values
+    else:
+        times = curr_obs['datetime']
+        if pd.api.types.is_datetime64_any_dtype(times):
+            times = np.datetime_as_string(times.values.astype('datetime64[s]'))
+        else:
+            times = times.to_numpy(dtype=object)
+        values = curr_obs['value'].to_numpy()
+
+    if precision is not None:
+        values = np.round(values, precision)
+
+    if values.dtype == np.float32:
+        # A float32 converted to a Python float would be written with the digits of its float64 widening, numpy
+        #  writes the shortest text that reads back as the same float32
+        values = values.astype(str).tolist()
+    else:
+        # Floats and integers are converted to Python objects in one pass, and repr gives the same text as str
+        values = map(repr, values.tolist())
+    return block_separator.join(map(token_separator.join, zip(times.tolist(), values)))
+
+
+def _insert_chunk(curr_obs, start_offset, chunk_size, result_template, endpoint, session, encode, chunk_sizer=None,
+                  journal=None):
+    """Insert the chunk of observations starting at the start_offset row, isolating the rejected rows by bisection if
+    the chunk is rejected.  The response time and payload size of an inserted chunk are given to the chunk_sizer, and
+    the rows of the chunk are committed to the journal once it has been answered.
+
+    Returns:
+        The ChunkOutcome of the chunk
     """
 
+    # Retrieve the subset of observations to put into the template
+    curr_results = curr_obs[start_offset:start_offset + chunk_size]
+    stop_offset = start_offset + len(curr_results)
+
+    request_start = time.perf_counter()
     try:
-        # Attempt to get the URI of the template if it already exists
-        logging.info("Checking if template already exists.")
-        template_id = identify_template(obs_property, offering, endpoint)
+        inserted, payload_bytes, retries = _send_results(curr_results, result_template, endpoint, session, encode)
+    except Exception:
+        if chunk_sizer is not None:
+            chunk_sizer.record(len(curr_results), time.perf_counter() - request_start, 0, failed=True)
+        raise
 
-        # If the template does not exist, attempt to create one
-        if template_id is False:
-            logging.info("Creating template.")
-            template_id = create_template(procedure, obs_property, offering, template_metadata, endpoint)
+    # If the request is successful, log and then continue iterating over the observations
+    if inserted:
+        logging.info('Result observations inserted OK.')
+        if chunk_sizer is not None:
+            chunk_sizer.record(len(curr_results), time.perf_counter() - request_start, payload_bytes,
+                               failed=retries > 0)
+        _commit_chunk(journal, curr_results)
+        _count_chunk(session, len(curr_results), 0, 0)
+        return ChunkOutcome(start_offset, stop_offset, len(curr_results), 0, 1)
 
-        # Load the observations from the file, then remove any duplicates.  The first row should be the header.
-        curr_obs = pd.read_csv(observations,
-                               header=0)
+    # The chunk was rejected for holding observations already stored in the SOS, so the chunk is split in half and the
+    #  halves sent again, narrowing down into whichever half fails until only the duplicates are left out
+    logging.info('Failed batch insert of between: {} and {}.'.format(start_offset, stop_offset))
+    inserted, rejected, requests = _bisect_results(curr_results, result_template, endpoint, session, encode)
+    logging.info('Isolated {} rejected observations between: {} and {}, using {} requests.'.format(
+        rejected, start_offset, stop_offset, requests))
 
-        # Check that the observations conform to the expected format
-        logging.info("Check observations parse OK.")
-        check_observation_parse(curr_obs)
+    _commit_chunk(journal, curr_results)
+    _count_chunk(session, inserted, rejected, requests)
+    return ChunkOutcome(start_offset, stop_offset, inserted, rejected, 1 + requests)
 
-        logging.info("Drop duplicates from observations.")
-        remove_duplicate_observations(curr_obs)
 
-        # Send the observations to the function that inserts them using a ResultTemplate to batch in chunks.
-        logging.info("Sending observations.")
-        save_observations(curr_obs, template_id, endpoint, 200)
+def _count_chunk(session, inserted, rejected, bisection_requests):
+    """Count a chunk, its rows inserted and rejected, and the requests made bisecting it, in the session's metrics."""
 
-    except NotImplementedError:
-        logging.error('The template did not exist and was unable to be registered.')
-        return ResultTypes.TEMPLATE_FAILURE
+    metrics = _metrics_of(session)
+    metrics.count('chunks')
+    metrics.count('rows_inserted', inserted)
+    metrics.count('rows_rejected', rejected)
+    if bisection_requests:
+        metrics.count('bisected_chunks')
+        metrics.count('bisection_requests', bisection_requests)
 
-    except ValueError:
-        logging.error('The observation CSV column names were not correct, or too many columns, or wrong data type.')
-        return ResultTypes.PARSE_FAILURE
 
+def _commit_chunk(journal, curr_results):
+    """Commit the rows of the file from the first to the last of a chunk to the journal.  Any rows between them
+    missing from the chunk were dropped as duplicates, already sent, or already stored, so need not be sent either.
+    That only holds for a chunk in the order of the file, the rows of a chunk sorted by time are committed as the runs
+    of consecutive rows it holds."""
 
-def identify_template(obs_property, offering, endpoint):
-    """Use the offering and obs_property parameters to identify whether a result template already
-    exists for this observation stream.  If it does, return its identifier, if not, return False.
+    if journal is None or not len(curr_results):
+        return
 
-    Arguments:
-        obs_property: The property being observed
-        offering:  The offering under which the observations have been entered
-        endpoint:  The URI of the SOS service that listens for requests
+    rows = curr_results.rows
+    if (rows[1:] > rows[:-1]).all():
+        journal.commit(int(rows[0]), int(rows[-1]) + 1)
+        return
+
+    rows = np.sort(rows)
+    breaks = np.flatnonzero(rows[1:] != rows[:-1] + 1) + 1
+    for run in np.split(rows, breaks):
+        journal.commit(int(run[0]), int(run[-1]) + 1)
+
+
+def _bisect_results(curr_results, result_template, endpoint, session, encode):
+    """Insert the halves of a set of observations that has been rejected, recursing into any half that is also rejected,
+    so that k rejected observations in a chunk are found with roughly k * log2(chunk size) requests.
 
     Note:
-        This assumes that a template has a single observed property, and that the columns
-        have been registered as: (phenomenonTime, observation), so that the observation in
-        the 'resultStructure' is the second entry.
+        An InsertResult is all or nothing, so if the first half of a rejected set is inserted the rejection must lie
+        within the second half, and the second half is split again without first being sent whole.
 
     Returns:
-        Either the result template string identifier, or False to indicate not found
+        A tuple of the number of observations inserted, the number rejected, and the number of requests sent
     """
 
-    data = {'request': 'GetResultTemplate',
-                       'service': 'SOS',
-                       'version': '2.0.0',
-                       'offering': offering,
-                       'observedProperty': obs_property}
+    # A single observation that has been rejected is a duplicate (or otherwise unsaveable)
+    if len(curr_results) == 1:
+        return 0, 1, 0
 
-    if send_request(data, 'exceptions', False, endpoint):
-        return obs_property + "-" + offering
-    else:
-        return False
+    half = len(curr_results) // 2
+    inserted, rejected, requests = 0, 0, 0
+    right_known_rejected = False
 
+    for curr_half in (curr_results[:half], curr_results[half:]):
+        if right_known_rejected:
+            half_inserted, half_rejected, half_requests = _bisect_results(curr_half, result_template, endpoint,
+                                                                          session, encode)
+        elif _send_results(curr_half, result_template, endpoint, session, encode)[0]:
+            half_inserted, half_rejected, half_requests = len(curr_half), 0, 1
+            right_known_rejected = True
+        else:
+            half_inserted, half_rejected, half_requests = _bisect_results(curr_half, result_template, endpoint,
+                                                                          session, encode)
+            half_requests += 1
 
-def create_template(procedure, obs_property, offering, template_metadata, endpoint):
-    """If a template does not already exist within the SOS server, there is an attempt to create it
-    in this function.  The template is encoded, sent, and if successful its ID value is returned,
-    else an error is raised, as without a template this script cannot work.
+        inserted += half_inserted
+        rejected += half_rejected
+        requests += half_requests
+
+    return inserted, rejected, requests
 
-    Arguments:
-        procedure:  The procedure URI
-        obs_property:  The property being observed
-        offering:  The offering the procedure and property are under
-        template_metadata:  A set of values necessary for registering an observation template (and an observation)
-        endpoint:  The URI of the SOS service that listens for requests
+
+def _send_results(curr_results, result_template, endpoint, session, encode):
+    """Format a set of observations as the result values of an InsertResult request and send it.
 
     Raises:
-        NotImplementedError:  If a template cannot be created/implemented, then this error is raised to indicate it.
+        SosRequestError:  If the request failed other than by holding observations that are already stored
 
     Returns:
-        The result template string identifier
+        A tuple of a boolean value to indicate whether the observations were inserted, the length of the request body
+        before any compression, and the number of times the request was sent again after failing transiently
     """
 
-    # Create a unique template ID - as observations can only be added through the interface, this naming convention
-    #  should be OK.  It needs to involve the obs_property and offering, as these uniquely identify a template
-    template_id = obs_property + "-" + offering
+    with _metrics_of(session).phase('encode'):
+        body = _insert_result_body(result_template, encode(curr_results))
 
-    template = {
-        "request": "InsertResultTemplate",
-        "service": "SOS",
-        "version": "2.0.0",
-        "identifier": template_id,
-        "offering": offering,
-        "observationTemplate": {
-            "type": "http://www.opengis.net/def/observationType/OGC-OM/2.0/OM_Measurement",
-            "procedure": procedure,
-            "observedProperty": obs_property,
-            "featureOfInterest": {
-                "identifier": {
-                    "value": template_metadata['feature_identifier'],
-                    "codespace": "http://www.opengis.net/def/nil/OGC/0/unknown"
-                },
-                "name": [
-                    {
-                        "value": template_metadata['feature_name'],
-                        "codespace": "http://www.opengis.net/def/nil/OGC/0/unknown"
-                    }
-                ],
-                "sampledFeature": [
-                    "http://www.52north.org/test/featureOfInterest/world"
-                ],
-                "geometry": {
-                    "type": "Point",
-                    "coordinates": [
-                        template_metadata['feature_lat'],
-                        template_metadata['feature_lon']
-                    ],
-                    "crs": {
-                        "type": "name",
-                        "properties": {
-                            "name": "EPSG:4326"
-                        }
-                    }
-                }
-            },
-            "phenomenonTime": "template",
-            "resultTime": "template",
-            "result": ""
-        },
-        "resultStructure": {
-            "fields": [
-                {
-                    "type": "time",
-                    "name": "phenomenonTime",
-                    "definition": "http://www.opengis.net/def/property/OGC/0/PhenomenonTime",
-                    "uom": "http://www.opengis.net/def/uom/ISO-8601/0/Gregorian"
-                },
-                {
-                    "type": "quantity",
-                    "name": template_metadata['result_name'],
-                    "definition": template_metadata['result_definition'],
-                    "uom": template_metadata['result_unit']
-                }
-            ]
-        },
-        "resultEncoding": {
-            "tokenSeparator": ",",
-            "blockSeparator": "#"
-        }
-    }
+    status, reply, failure, retries = _post_body(body, 'InsertResult', endpoint, session)
+    if failure is FailureTypes.FATAL:
+        raise SosRequestError('The SOS refused the InsertResult request with status {}: {}'.format(status, reply),
+                              failure, status)
 
-    if send_request(template, 'acceptedTemplate', True, endpoint):
-        return template_id
+    return failure is None, len(body), retries
+
+
+def _insert_result_body(result_template, result_string):
+    """Build the JSON body of an InsertResult request by placing the result values between the bytes of the rest of
+    the request, which are only serialized once for each template.  Result values only need escaping if their
+    separators or timestamps hold quotes, backslashes or control characters, the numbers and ISO 8601 timestamps of
+    the observations never do, so they are checked as bytes and only escaped when needed.
+
+    Returns:
+        The encoded request body
+    """
+
+    result_values = result_string.encode('utf-8')
+    if (b'"' in result_values or b'\\' in result_values or
+            len(result_values.translate(None, JSON_CONTROL_CHARACTERS)) != len(result_values)):
+        result_values = json.dumps(result_string, ensure_ascii=False)[1:-1].encode('utf-8')
+
+    before_values, after_values = _insert_result_envelope(result_template)
+    return b''.join((before_values, result_values, after_values))
+
+
+@functools.lru_cache(maxsize=256)
+def _insert_result_envelope(result_template):
+    """The bytes of an InsertResult request for the template before and after the text of its result values."""
+
+    envelope = json.dumps({"request": "InsertResult",
+                           "service": "SOS",
+                           "version": "2.0.0",
+                           "templateIdentifier": result_template,
+                           "resultValues": ""
+                           }).encode('utf-8')
+    before_values, after_values = envelope.rsplit(b'""', 1)
+    return before_values + b'"', b'"' + after_values
+
+
+def send_request(data, target_key, key_status, endpoint, session=None):
+    """Send the request to the sos endpoint, and check for the key_status of the key
+
+    Arguments:
+        data: an object able to be serialized into a JSON object
+        target_key: the json key to look for in the return object
+        key_status: whether the target_key needs to be present (True), or not (False) for this method to return True
+        endpoint: the URI of the SOS server to send the request to
+        session: an optional SosSession, when given the request is sent over one of its keep-alive connections,
+            otherwise a new connection is opened for this request alone
+
+    Returns:
+        Boolean value to indicate whether the target_key corresponded to the key_status when analyzing the return from
+        the server.
+    """
+
+    result_json = request_json(data, endpoint, session)
+    if result_json is not None and (target_key in result_json) is key_status:
+        return True
     else:
-        raise NotImplementedError("The template could not be created.")
+        return False
 
 
-def check_observation_parse(curr_obs):
-    """Checks that the datetime values are OK and in the correct format, and check that all the
-    observations are either numeric or null.
+def request_json(data, endpoint, session=None):
+    """Send the request to the sos endpoint, and return the decoded JSON response.
 
     Arguments:
-        curr_obs:  A pandas dataframe holding the observation data
+        data: an object able to be serialized into a JSON object
+        endpoint: the URI of the SOS server to send the request to
+        session: an optional SosSession to send the request through
 
     Raises:
-        ValueError:  If a value within the file does not conform to the expected types, a ValueError is raised
+        SosRequestError:  If the request failed transiently through every retry
+
+    Returns:
+        The object decoded from the JSON response, or None if the server returned an error status
     """
-    try:
-        _ = pd.to_numeric(curr_obs['value'], errors='raise')
-        _ = pd.to_datetime(curr_obs['datetime'],
-                           errors='raise',
-                           format='%Y-%m-%dT%H:%M:%S',
-                           exact=True)
-        if set(curr_obs.columns) != {'datetime', 'value'}:
-            raise ValueError('The observation file has the wrong column names, or wrong columns, expects: datetime, value.')
-    except Exception:
-        raise ValueError('Values within the observation file do not conform to their expected type.')
 
+    status, reply, _ = _post_json(data, endpoint, session)
+    if not 200 <= status < 300:
+        return None
+    return reply
 
-def remove_duplicate_observations(curr_obs):
-    """Removes observations that have duplicate timestamps, with the last observation of duplicates being the one that
-    is kept.  Only the timestamp is checked, not the value, as a single sensor cannot have more than one value for the
-    same sensor/property.
+
+def classify_failure(status, reply):
+    """Classify the response to a request as a success, or as one of the FailureTypes from its HTTP status and the
+    exceptions reported by the SOS.
 
     Arguments:
-        curr_obs:  A pandas dataframe holding the observation data
+        status:  The HTTP status of the response
+        reply:  The object decoded from the JSON response, or None if the response was not JSON
 
     Returns:
-        A similar dataframe to that past as curr_obs, with the duplicates removed
+        None if the request succeeded, otherwise the FailureTypes of the failure
     """
-    curr_obs.drop_duplicates('datetime', keep='last', inplace=True)
-    return curr_obs
 
+    exceptions = reply.get('exceptions') if isinstance(reply, dict) else None
+    if exceptions is None:
+        if 200 <= status < 300 and reply is not None:
+            return None
+        # An error without an SOS exception report comes from the servlet container or a proxy in front of the SOS
+        return FailureTypes.TRANSIENT if status in TRANSIENT_STATUSES or status >= 500 else FailureTypes.FATAL
+
+    exception_text = json.dumps(exceptions)
+    if DUPLICATE_EXCEPTION_PATTERN.search(exception_text):
+        return FailureTypes.DUPLICATE
+    if status in TRANSIENT_STATUSES or TRANSIENT_EXCEPTION_PATTERN.search(exception_text):
+        return FailureTypes.TRANSIENT
+    return FailureTypes.FATAL
+
+
+def _post_json(data, endpoint, session=None):
+    """Send a JSON request to the SOS, sending it again after a pause each time it fails transiently, following the
+    RetryPolicy of the session.
+
+    Raises:
+        SosRequestError:  If the request failed transiently through every retry, or the breaker of the endpoint is open
+
+    Returns:
+        A tuple of the HTTP status, the object decoded from the JSON response (None if it was not JSON), and None if the
+        request succeeded or else the FailureTypes of its failure
+    """
+
+    return _post_body(json.dumps(data).encode('utf-8'), data.get('request', 'unknown'), endpoint, session)[:3]
 
-def save_observations(curr_obs, result_template, endpoint, chunk_size):
-    """Takes the observations parameter and opens the CSV file it represents, then inserts
-    these observations against the endpoint.
+
+def _post_body(body, operation, endpoint, session=None):
+    """As _post_json, for a request body that has already been encoded, compressing it if the session compresses the
+    requests to the endpoint.
 
     Arguments:
-        curr_obs:  A Pandas DataFrame of the current set of observations to be saved
-        result_template:  The template ID value to insert the observations against
-        endpoint:  The endpoint URI to send requests to
-        chunk_size:  The number of observations to be inserted in the same request
+        body:  The encoded JSON request
+        operation:  The SOS operation of the request, that its latency is recorded under
+        endpoint:  The URI of the SOS server to send the request to
+        session:  An optional SosSession to send the request through
 
+    Returns:
+        A tuple of the HTTP status, the object decoded from the JSON response (None if it was not JSON), None if the
+        request succeeded or else the FailureTypes of its failure, and the number of times it was sent again after
+        failing transiently
     """
 
-    # Create an iterator over the observations by chunk_size
-    for start_offset in range(0, curr_obs.shape[0], chunk_size):
-        # Retrieve the subset of observations to put into the template, format as expected, and create template
-        # Use -1 for the chunk size as difference in how list slicing and .loc slicing work with the rhs value
-        curr_results = curr_obs.loc[start_offset:start_offset + (chunk_size-1), :]
-        result_string = '#'.join([str(curr_ob[0]) + "," + str(curr_ob[1]) for curr_ob in curr_results.values])
+    retry_policy = session.retry_policy if session is not None else RetryPolicy()
+    metrics = _metrics_of(session)
 
-        curr_template = {"request": "InsertResult",
-                         "service": "SOS",
-                         "version": "2.0.0",
-                         "templateIdentifier": result_template,
-                         "resultValues": result_string
-                         }
+    attempt = 0
+    while True:
+        try:
+            retry_policy.check(endpoint)
+        except SosRequestError:
+            metrics.count('breaker_refusals')
+            raise
 
-        # If the request is successful, log and then continue iterating over the observations
-        if send_request(curr_template, 'exceptions', False, endpoint):
-            logging.info('Result observations inserted OK.')
-        # If the request fails, it is likely due to a duplicate observation within the SOS, so the observations
-        #  are attempted to be sent again but this time in chunks of 1, so only the duplicate observations are missed
-        else:
-            logging.info('Failed batch insert of between: {} and {}.'.format(start_offset, start_offset + chunk_size))
-            # Send as results of size 1, so that any non-duplicates are added OK - only if this hasn't already been done
-            if chunk_size > 1:
-                save_observations(curr_results, result_template, endpoint, 1)
+        # Create the custom header for the JSON content, compressing the body if the endpoint accepts it
+        custom_header = {'Content-Type': 'application/json'}
+        content_encoding = session.content_encoding(endpoint) if session is not None else None
+        data = body
+        if content_encoding is not None:
+            custom_header['Content-Encoding'] = content_encoding
+            data = _compress(body, content_encoding)
+            metrics.count('bytes_before_compression', len(body))
 
+        request_start = time.perf_counter()
+        try:
+            metrics.count('bytes_sent', len(data))
+            status, result_encoding, content = _post(data, endpoint, custom_header, session)
+            metrics.observe_request(operation, time.perf_counter() - request_start)
+            try:
+                reply = json.loads(content.decode(result_encoding))
+            except ValueError:
+                reply = None
+            failure = classify_failure(status, reply)
+            reason = 'status {}'.format(status)
+        except (OSError, http.client.HTTPException) as error:
+            # The connection failed or timed out, or the response was cut short
+            status, reply, failure = None, None, FailureTypes.TRANSIENT
+            reason = repr(error)
 
-def send_request(data, target_key, key_status, endpoint):
-    """Send the request to the sos endpoint, and check for the key_status of the key
+        if content_encoding is not None and failure is not FailureTypes.TRANSIENT:
+            if session.compression_answered(endpoint, not _compression_refused(status, reply, failure)):
+                continue
 
-    Arguments:
-        data: an object able to be serialized into a JSON object
-        target_key: the json key to look for in the return object
-        key_status: whether the target_key needs to be present (True), or not (False) for this method to return True
-        endpoint: the URI of the SOS server to send the request to
+        retry_policy.record(endpoint, failure)
+        if failure is not FailureTypes.TRANSIENT:
+            return status, reply, failure, attempt
+
+        if attempt >= retry_policy.retries:
+            raise SosRequestError('The request failed {} times, last with {}.'.format(attempt + 1, reason),
+                                  failure, status)
+
+        metrics.count('retries')
+        delay = retry_policy.delay(attempt)
+        logging.warning('Request to {} failed with {}, sending it again in {:.1f} s.'.format(endpoint, reason, delay))
+        time.sleep(delay)
+        attempt += 1
+
+
+def _compression_refused(status, reply, failure):
+    """Whether the response to a compressed request shows the body could not be read, either a 415 Unsupported Media
+    Type, a fatal failure without an SOS exception report, or one whose exception says the request was unreadable."""
+
+    if status == 415:
+        return True
+    if failure is not FailureTypes.FATAL:
+        return False
+    if not isinstance(reply, dict) or 'exceptions' not in reply:
+        return True
+    return UNREADABLE_REQUEST_PATTERN.search(json.dumps(reply['exceptions'])) is not None
+
+
+def _compress(body, content_encoding):
+    """Compress a request body with the gzip or deflate (zlib) Content-Encoding.  The gzip header is given no
+    modification time, so the same body is always compressed to the same bytes."""
+
+    if content_encoding == 'gzip':
+        compressed = io.BytesIO()
+        with gzip.GzipFile(fileobj=compressed, mode='wb', compresslevel=COMPRESSION_LEVEL, mtime=0) as gzip_file:
+            gzip_file.write(body)
+        return compressed.getvalue()
+    return zlib.compress(body, COMPRESSION_LEVEL)
+
+
+def _post(data, endpoint, headers, session=None):
+    """POST the encoded data, through the session if given, otherwise over a new connection.
 
     Returns:
-        Boolean value to indicate whether the target_key corresponded to the key_status when analyzing the return from
-        the server.
+        A tuple of (HTTP status code, response charset, response body bytes)
     """
 
-    # Create the custom header for the JSON content, create and encode the JSON payload
-    custom_header = {'Content-Type': 'application/json'}
-    data = json.dumps(data).encode('utf-8')
+    if session is not None:
+        return session.post(endpoint, data, headers)
 
     # Create the request
-    req = urllib.request.Request(url=endpoint, data=data, headers=custom_header, method='POST')
+    req = urllib.request.Request(url=endpoint, data=data, headers=headers, method='POST')
 
     try:
-        # Open the request,
+        # Open the request, urlopen raises an HTTPError for any status other than a success
         with urllib.request.urlopen(req) as url_stream:
             # Retrieve the encoding and use to decode the result
-            result_encoding = url_stream.info().get_content_charset('utf-8')
-            result_json = json.loads(url_stream.read().decode(result_encoding))
-            if (target_key in result_json) is key_status:
-                return True
-            else:
-                return False
-    except HTTPError:
-        return False
+            return 200, url_stream.info().get_content_charset('utf-8'), url_stream.read()
+    except HTTPError as error:
+        result_encoding = error.headers.get_content_charset('utf-8') if error.headers is not None else 'utf-8'
+        return error.code, result_encoding, error.read()
 
 
-if __name__ == '__main__':
-    """An example entrypoint, when using the 52N SOS example InsertSensor would be:
-    python ObservationLoader.py test-data.csv http://www.52north.org/test/procedure/9 
-    http://www.52north.org/test/observableProperty/9_3 http://www.52north.org/test/offering/9 
-    http://www.52north.org/test/featureOfInterest/9 52North 51 7 test_observable_property_9 
-    http://www.52north.org/test/observableProperty/9_3 test_unit_9 
-    http://127.0.0.1:8080/observations/service"""
+def main(arguments):
+    """Load the observations given on the command line, either a single file described by 12 positional arguments, or
+    every file listed in a manifest.
+
+    Arguments:
+        arguments:  The command line arguments, without the script name
+
+    Returns:
+        The ResultTypes of the load, for a batch the first failure if any file failed
+    """
+
+    parser = argparse.ArgumentParser(description='Load observation files into a SOS.')
+    parser.add_argument('single', nargs='*',
+                        help='observation file, procedure, property, offering, feature identifier, feature name, '
+                             'feature lat, feature lon, result name, result definition, result unit, SOS endpoint')
+    parser.add_argument('--manifest', help='a JSON, YAML or CSV manifest of the observation files to load')
+    parser.add_argument('--endpoint', help='the SOS endpoint URI to load the manifest files into')
+    parser.add_argument('--workers', type=int, default=1, help='the number of manifest files loaded at once')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='the number of processes the manifest files are spread across, each loading one at a time')
+    parser.add_argument('--max-in-flight', type=int, default=DEFAULT_MAX_IN_FLIGHT,
+                        help='the number of InsertResult chunks of each file in flight at once')
+    parser.add_argument('--max-requests', type=int, default=DEFAULT_GLOBAL_IN_FLIGHT,
+                        help='the number of requests in flight to the SOS from every process together')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='the number of observations sent in each request, the first size when adaptive')
+    parser.add_argument('--adaptive-chunks', action='store_true',
+                        help='adjust the chunk size to the response times of the SOS')
+    parser.add_argument('--min-chunk-size', type=int, default=50, help='the smallest adaptive chunk size')
+    parser.add_argument('--max-chunk-size', type=int, default=20000, help='the largest adaptive chunk size')
+    parser.add_argument('--target-latency', type=float, default=2.0,
+                        help='the number of seconds each adaptive chunk should take the SOS')
+    parser.add_argument('--template-cache', help='a JSON file to keep the known result templates in between runs')
+    parser.add_argument('--invalidate-templates', action='store_true',
+                        help='forget every template in the template cache before loading')
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES,
+                        help='the number of times a request that fails transiently is sent again')
+    parser.add_argument('--compression', choices=CONTENT_ENCODINGS,
+                        help='compress request bodies, if the SOS refuses them they are sent uncompressed')
+    parser.add_argument('--metrics-json', help='a file to write a JSON summary of the timings and counts of the load')
+    parser.add_argument('--metrics-textfile',
+                        help='a .prom file to write the metrics to, for the node exporter textfile collector')
+    parser.add_argument('--profile', action='append', default=[], metavar='PHASE',
+                        help='run cProfile over a phase of the load, writing <phase>.prof to --profile-dir, may be '
+                             'repeated')
+    parser.add_argument('--profile-dir', default='.', help='the folder the phase profiles are written to')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='record the peak memory allocated in each phase, which slows the load')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip the rows an earlier load of the same file recorded in its journal as sent')
+    parser.add_argument('--no-journal', action='store_true',
+                        help='do not keep a journal of the rows sent beside each observation file')
+    parser.add_argument('--value-dtype', choices=VALUE_DTYPES, default=VALUE_DTYPES[0],
+                        help='hold the values as float32 rather than float64, halving their memory, for series with '
+                             'no more than 7 significant digits')
+    parser.add_argument('--block-size', type=int, help='read the files as a stream of blocks of this many rows')
+    parser.add_argument('--sort-by-time', action='store_true',
+                        help='send the observations in time order rather than file order, so each request covers a '
+                             'contiguous window of time')
+    parser.add_argument('--incremental', choices=[mode.name.lower() for mode in IncrementalModes],
+                        help='skip the observations the SOS already holds for each series, every one within its stored '
+                             'time range, or only those whose timestamps it holds')
+    parser.add_argument('--rollup', action='append', default=[], choices=ROLLUP_PERIODS,
+                        help='send the mean, min, max and count of each period of the series to companion series, '
+                             'may be repeated')
+    parser.add_argument('--follow', action='store_true',
+                        help='keep following the files as loggers append to them, sending only the new rows, until '
+                             'interrupted or terminated')
+    parser.add_argument('--poll-interval', type=float, default=DEFAULT_POLL_INTERVAL,
+                        help='the seconds between polls of the followed files')
+    args = parser.parse_args(arguments)
+
+    templates = TemplateRegistry(args.template_cache)
+    if args.invalidate_templates:
+        templates.invalidate()
+
+    # A single adaptive chunk size is shared by every file, as it depends on the endpoint rather than the file
+    chunk_size = args.chunk_size
+    if args.adaptive_chunks:
+        chunk_size = AdaptiveChunkSize(args.chunk_size, args.min_chunk_size, args.max_chunk_size, args.target_latency)
+
+    metrics = LoaderMetrics(args.profile, args.trace_memory)
+    # Enough connections for the chunks of every file loaded at once to be in flight together
+    pool_size = max(args.max_in_flight * args.workers, DEFAULT_POOL_SIZE)
+    session = SosSession(pool_size=pool_size, retry_policy=RetryPolicy(args.retries), metrics=metrics,
+                         compression=args.compression)
+    try:
+        return _run_loads(args, session, templates, chunk_size)
+    finally:
+        session.close()
+        if args.metrics_json:
+            metrics.write_json(args.metrics_json)
+        if args.metrics_textfile:
+            metrics.write_prometheus(args.metrics_textfile)
+        if args.profile:
+            metrics.write_profiles(args.profile_dir)
+
+
+def _run_loads(args, session, templates, chunk_size):
+    """Load the manifest or the single file given on the command line."""
+
+    if args.follow:
+        return _follow(args, session, templates, chunk_size)
+
+    incremental = IncrementalModes[args.incremental.upper()] if args.incremental else None
+    if args.manifest and args.endpoint:
+        options = {'chunk_size': chunk_size, 'journal': not args.no_journal, 'resume': args.resume,
+                   'value_dtype': args.value_dtype, 'sort_by_time': args.sort_by_time, 'rollups': args.rollup,
+                   'incremental': incremental, 'block_size': args.block_size, 'max_in_flight': args.max_in_flight}
+        if args.processes > 1:
+            summary = run_processes(load_manifest(args.manifest), args.endpoint, args.processes, args.max_requests,
+                                    session, templates, **options)
+        else:
+            summary = run_batch(load_manifest(args.manifest), args.endpoint, args.workers, session, templates,
+                                **options)
+        failures = [result for _, result in summary if result is not ResultTypes.OBSERVATIONS_OK]
+        return failures[0] if failures else ResultTypes.OBSERVATIONS_OK
 
-    logging.basicConfig(level=logging.INFO)
     # It is expected that the same arguments will be provided with every file even when it is
     #  known that a template already exists
-    if len(sys.argv) == 13:
+    if len(args.single) == 12:
         # The file with the observations inside
-        observation_file = sys.argv[1]
+        observation_file = args.single[0]
         # The main metadata about the property and procedure used
-        procedure_uri = sys.argv[2]
-        property_uri = sys.argv[3]
-        offering_uri = sys.argv[4]
+        procedure_uri = args.single[1]
+        property_uri = args.single[2]
+        offering_uri = args.single[3]
         # Template based information
         metadata = {
             # Feature details for adding when a result template must be created
-            "feature_identifier": sys.argv[5],
-            "feature_name": sys.argv[6],
-            "feature_lat": float(sys.argv[7]),
-            "feature_lon": float(sys.argv[8]),
+            "feature_identifier": args.single[4],
+            "feature_name": args.single[5],
+            "feature_lat": float(args.single[6]),
+            "feature_lon": float(args.single[7]),
             # Result details for adding when a result template must be created
-            "result_name": sys.argv[9],
-            "result_definition": sys.argv[10],
-            "result_unit": sys.argv[11]
+            "result_name": args.single[8],
+            "result_definition": args.single[9],
+            "result_unit": args.single[10]
         }
 
-        sos_uri = sys.argv[12]
+        sos_uri = args.single[11]
+
+        return prepare_observations(observation_file,
+                                    procedure_uri,
+                                    property_uri,
+                                    offering_uri,
+                                    metadata,
+                                    sos_uri,
+                                    session,
+                                    max_in_flight=args.max_in_flight,
+                                    templates=templates,
+                                    chunk_size=chunk_size,
+                                    journal=not args.no_journal,
+                                    resume=args.resume,
+                                    value_dtype=args.value_dtype,
+                                    sort_by_time=args.sort_by_time,
+                                    rollups=args.rollup,
+                                    incremental=incremental,
+                                    block_size=args.block_size)
+    else:
+        return ResultTypes.MISSING_PARAMETERS
+
 
-        sys.exit(
-            prepare_observations(observation_file,
-                                 procedure_uri,
-                                 property_uri,
-                                 offering_uri,
-                                 metadata,
-                                 sos_uri)
-        )
+def _follow(args, session, templates, chunk_size):
+    """Follow the manifest files, or the single file given on the command line, until interrupted or terminated."""
+
+    if args.manifest and args.endpoint:
+        loads, endpoint = load_manifest(args.manifest), args.endpoint
+    elif len(args.single) == 12:
+        metadata = dict(zip(('feature_identifier', 'feature_name', 'feature_lat', 'feature_lon', 'result_name',
+                             'result_definition', 'result_unit'), args.single[4:11]))
+        metadata['feature_lat'] = float(metadata['feature_lat'])
+        metadata['feature_lon'] = float(metadata['feature_lon'])
+        loads = [dict(zip(MANIFEST_KEYS, args.single[:4]), template_metadata=metadata)]
+        endpoint = args.single[11]
     else:
-        sys.exit(ResultTypes.MISSING_PARAMETERS)
+        return ResultTypes.MISSING_PARAMETERS
+
+    # Stop after the current poll when terminated, as by a service manager
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signal_number, frame: stop.set())
+    try:
+        return follow_observations(loads, endpoint, session, templates, args.poll_interval, stop,
+                                   max_in_flight=args.max_in_flight, chunk_size=chunk_size,
+                                   value_dtype=args.value_dtype, block_size=args.block_size)
+    except KeyboardInterrupt:
+        return ResultTypes.OBSERVATIONS_OK
+
+
+if __name__ == '__main__':
+    """An example entrypoint, when using the 52N SOS example InsertSensor would be:
+    python ObservationLoader.py test-data.csv http://www.52north.org/test/procedure/9 
+    http://www.52north.org/test/observableProperty/9_3 http://www.52north.org/test/offering/9 
+    http://www.52north.org/test/featureOfInterest/9 52North 51 7 test_observable_property_9 
+    http://www.52north.org/test/observableProperty/9_3 test_unit_9 
+    http://127.0.0.1:8080/observations/service
+
+    Or to load every file in a manifest, sharing connections and template lookups:
+    python ObservationLoader.py --manifest series.json --endpoint http://127.0.0.1:8080/observations/service
+    --workers 4
+
+    Or to spread the files across processes, keeping at most 10 requests in flight to the SOS:
+    python ObservationLoader.py --manifest series.json --endpoint http://127.0.0.1:8080/observations/service
+    --processes 8 --max-requests 10
+
+    Or to keep sending the rows loggers append to the manifest files, polling every 30 seconds:
+    python ObservationLoader.py --manifest series.json --endpoint http://127.0.0.1:8080/observations/service
+    --follow --poll-interval 30"""
+
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main(sys.argv[1:]).value)
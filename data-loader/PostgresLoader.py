@@ -0,0 +1,416 @@
+"""Bulk load observation files straight into the database of a 52N SOS, for one-off back-fills too large to send through
+InsertResult requests.  The series is found, or created along with its procedure, observed property, offering and
+feature of interest, from the same arguments ObservationLoader takes, and the observations are written with COPY into
+the observation, numericvalue and observationhasoffering tables of the schema in postgresql-node/sos-4-4-1/sos.sql.gz.
+
+    python PostgresLoader.py --dsn "host=127.0.0.1 dbname=sos user=postgres password=postgres" test-data.csv
+        http://www.52north.org/test/procedure/9 http://www.52north.org/test/observableProperty/9_3
+        http://www.52north.org/test/offering/9 http://www.52north.org/test/featureOfInterest/9 52North 51 7
+        test_observable_property_9 http://www.52north.org/test/observableProperty/9_3 test_unit_9
+
+The SOS keeps its capabilities in a cache, so a series created here is only offered once the SOS next refreshes it.
+"""
+import argparse
+import io
+import logging
+import sys
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+import ObservationLoader as ObLo
+
+
+# The number of observations written by each COPY, each in a transaction of its own
+DEFAULT_BATCH_SIZE = 100000
+
+# The types the SOS gives to the measurements, features and procedures inserted through its transactional interface
+OBSERVATION_TYPE = 'http://www.opengis.net/def/observationType/OGC-OM/2.0/OM_Measurement'
+FEATURE_TYPE = 'http://www.opengis.net/def/samplingFeatureType/OGC-OM/2.0/SF_SamplingPoint'
+PROCEDURE_DESCRIPTION_FORMAT = 'http://www.opengis.net/sensorml/2.0'
+# The Hibernate discriminator of the procedures, offerings and features inserted through the transactional interface
+TRANSACTIONAL_DISCRIMINATOR = 'T'
+# The series type of a series of numeric observations
+SERIES_TYPE = 'measurement'
+# The spatial reference of the feature of interest coordinates
+FEATURE_SRID = 4326
+
+# The primary key column, its sequence, and the unique column identifying a row, of the tables a series refers to
+ENTITY_KEYS = {'proceduredescriptionformat': ('proceduredescriptionformatid', 'procdescformatid_seq',
+                                              'proceduredescriptionformat'),
+               'observationtype': ('observationtypeid', 'observationtypeid_seq', 'observationtype'),
+               'featureofinteresttype': ('featureofinteresttypeid', 'featureofinteresttypeid_seq',
+                                         'featureofinteresttype'),
+               'unit': ('unitid', 'unitid_seq', 'unit'),
+               'procedure': ('procedureid', 'procedureid_seq', 'identifier'),
+               'observableproperty': ('observablepropertyid', 'observablepropertyid_seq', 'identifier'),
+               'offering': ('offeringid', 'offeringid_seq', 'identifier'),
+               'featureofinterest': ('featureofinterestid', 'featureofinterestid_seq', 'identifier')}
+
+# The errors of a database that could not be reached or written to, none if psycopg2 is not installed
+DATABASE_ERRORS = (psycopg2.Error,) if psycopg2 is not None else ()
+
+# The database identifiers of a series, and of the offering and unit its observations are written with
+SeriesIds = namedtuple('SeriesIds', ['series', 'offering', 'unit'])
+
+
+def bulk_load_observations(observations, procedure, obs_property, offering, template_metadata, dsn='',
+                           connection=None, batch_size=DEFAULT_BATCH_SIZE, block_size=None, metrics=None):
+    """Load an observation file straight into the SOS database, finding or creating its series, then writing the
+    observations in batches, each with COPY in a single transaction that also moves the first and last timestamps of
+    the series.  The observations the series already holds are skipped, so a file can be loaded again after a failure.
+
+    Arguments:
+        observations:  The path of the CSV observation file, or a file-like object, as for prepare_observations
+        procedure:  The procedure URI
+        obs_property:  The property being observed
+        offering:  The offering the procedure and property are under
+        template_metadata:  The feature and result details, as for prepare_observations
+        dsn:  The libpq connection string of the SOS database, by default taken from the PG environment variables
+        connection:  An optional open psycopg2 connection to use instead of connecting to dsn, which is left open
+        batch_size:  The number of observations written by each COPY transaction
+        block_size:  An optional number of rows, when given the file is read as a stream of blocks of this many rows
+        metrics:  Optional LoaderMetrics to record the phases and counts of the load in
+
+    Returns:
+        The ResultTypes of the load
+    """
+
+    metrics = metrics or ObLo.LoaderMetrics()
+    owns_connection = connection is None
+    try:
+        if owns_connection:
+            connection = connect(dsn)
+
+        with metrics.phase('series'):
+            series = resolve_series(connection, procedure, obs_property, offering, template_metadata)
+
+        if block_size is None:
+            obs_blocks = [ObLo.read_observations(observations, metrics)]
+        else:
+            obs_blocks = ObLo.read_observation_blocks(observations, block_size, metrics)
+
+        inserted = 0
+        for curr_obs in obs_blocks:
+            for start in range(0, curr_obs.shape[0], batch_size):
+                with metrics.phase('copy'):
+                    batch_inserted = copy_observations(connection, series, curr_obs.iloc[start:start + batch_size])
+                metrics.count('batches')
+                metrics.count('rows_inserted', batch_inserted)
+                metrics.count('rows_skipped', min(batch_size, curr_obs.shape[0] - start) - batch_inserted)
+                inserted += batch_inserted
+
+        logging.info('Observations inserted into series {}: {}.'.format(series.series, inserted))
+        return ObLo.ResultTypes.OBSERVATIONS_OK
+
+    except ValueError as error:
+        logging.error('The observation CSV column names were not correct, or too many columns, or wrong data type.')
+        logging.error(str(error))
+        return ObLo.ResultTypes.PARSE_FAILURE
+
+    except FileNotFoundError as error:
+        logging.error('The observation file could not be found: {}'.format(error))
+        return ObLo.ResultTypes.PARSE_FAILURE
+
+    except DATABASE_ERRORS as error:
+        logging.error('The database could not be loaded: {}'.format(error))
+        return ObLo.ResultTypes.ENDPOINT_FAILURE
+
+    finally:
+        if owns_connection and connection is not None:
+            connection.close()
+
+
+def connect(dsn=''):
+    """Open a connection to the SOS database.
+
+    Raises:
+        ImportError:  If psycopg2 is not installed
+    """
+
+    if psycopg2 is None:
+        raise ImportError('psycopg2 must be installed to load observations straight into the database.')
+    return psycopg2.connect(dsn)
+
+
+def resolve_series(connection, procedure, obs_property, offering, template_metadata):
+    """Find the series of the procedure, observed property, offering and feature of interest, creating whichever of
+    them does not exist yet, along with the observation constellation the SOS needs to offer the series.  This is all
+    done in one transaction.
+
+    Arguments:
+        connection:  An open psycopg2 connection to the SOS database
+        procedure:  The procedure URI
+        obs_property:  The property being observed
+        offering:  The offering the procedure and property are under
+        template_metadata:  The feature_identifier, feature_name, feature_lat, feature_lon and result_unit of the series
+
+    Returns:
+        The SeriesIds of the series
+    """
+
+    with connection, connection.cursor() as cursor:
+        format_id, _ = _resolve_entity(cursor, 'proceduredescriptionformat', PROCEDURE_DESCRIPTION_FORMAT)
+        observation_type_id, _ = _resolve_entity(cursor, 'observationtype', OBSERVATION_TYPE)
+        feature_type_id, _ = _resolve_entity(cursor, 'featureofinteresttype', FEATURE_TYPE)
+        unit_id, _ = _resolve_entity(cursor, 'unit', template_metadata['result_unit'])
+
+        procedure_id, _ = _resolve_entity(cursor, 'procedure', procedure,
+                                          {'hibernatediscriminator': TRANSACTIONAL_DISCRIMINATOR,
+                                           'proceduredescriptionformatid': format_id})
+        property_id, _ = _resolve_entity(cursor, 'observableproperty', obs_property)
+        offering_id, _ = _resolve_entity(cursor, 'offering', offering,
+                                         {'hibernatediscriminator': TRANSACTIONAL_DISCRIMINATOR})
+        feature_id, created = _resolve_entity(cursor, 'featureofinterest', template_metadata['feature_identifier'],
+                                              {'hibernatediscriminator': TRANSACTIONAL_DISCRIMINATOR,
+                                               'featureofinteresttypeid': feature_type_id,
+                                               'name': template_metadata['feature_name']})
+        if created:
+            cursor.execute('UPDATE featureofinterest SET geom = ST_SetSRID(ST_MakePoint(%s, %s), %s) '
+                           'WHERE featureofinterestid = %s',
+                           (template_metadata['feature_lon'], template_metadata['feature_lat'], FEATURE_SRID,
+                            feature_id))
+
+        # The constellation and the allowed types are what the SOS lists the offering's contents from
+        cursor.execute('INSERT INTO observationconstellation (observationconstellationid, observablepropertyid, '
+                       'procedureid, observationtypeid, offeringid) '
+                       "VALUES (nextval('observationconstellationid_seq'), %s, %s, %s, %s) ON CONFLICT DO NOTHING",
+                       (property_id, procedure_id, observation_type_id, offering_id))
+        cursor.execute('INSERT INTO offeringallowedobservationtype (offeringid, observationtypeid) VALUES (%s, %s) '
+                       'ON CONFLICT DO NOTHING', (offering_id, observation_type_id))
+        cursor.execute('INSERT INTO offeringallowedfeaturetype (offeringid, featureofinteresttypeid) VALUES (%s, %s) '
+                       'ON CONFLICT DO NOTHING', (offering_id, feature_type_id))
+
+        cursor.execute('SELECT seriesid, unitid FROM series WHERE featureofinterestid = %s AND '
+                       'observablepropertyid = %s AND procedureid = %s AND offeringid = %s',
+                       (feature_id, property_id, procedure_id, offering_id))
+        row = cursor.fetchone()
+        if row is None:
+            cursor.execute('INSERT INTO series (seriesid, featureofinterestid, observablepropertyid, procedureid, '
+                           "offeringid, unitid, seriestype) VALUES (nextval('seriesid_seq'), %s, %s, %s, %s, %s, %s) "
+                           'RETURNING seriesid, unitid',
+                           (feature_id, property_id, procedure_id, offering_id, unit_id, SERIES_TYPE))
+            row = cursor.fetchone()
+            logging.info('Created series {}.'.format(row[0]))
+
+    # A series created by the SOS keeps the unit it was created with
+    series_id, series_unit_id = row
+    return SeriesIds(series_id, offering_id, unit_id if series_unit_id is None else series_unit_id)
+
+
+def _resolve_entity(cursor, table, key, columns=None):
+    """Find the row of one of the ENTITY_KEYS tables with the unique key, inserting it with the further columns if it
+    does not exist.
+
+    Returns:
+        A tuple of the primary key of the row, and whether it was created
+    """
+
+    id_column, sequence, key_column = ENTITY_KEYS[table]
+    cursor.execute('SELECT {} FROM {} WHERE {} = %s'.format(id_column, table, key_column), (key,))
+    row = cursor.fetchone()
+    if row is not None:
+        return row[0], False
+
+    columns = columns or {}
+    cursor.execute('INSERT INTO {} ({}) VALUES (nextval(%s), {}) RETURNING {}'.format(
+        table, ', '.join([id_column, key_column] + list(columns)), ', '.join(['%s'] * (len(columns) + 1)), id_column),
+        [sequence, key] + list(columns.values()))
+    return cursor.fetchone()[0], True
+
+
+def copy_observations(connection, series, curr_obs):
+    """Write a batch of observations to a series with COPY, in a single transaction, skipping those whose timestamps
+    the series already holds, and moving the first and last timestamps and values of the series to cover them.
+
+    Arguments:
+        connection:  An open psycopg2 connection to the SOS database
+        series:  The SeriesIds of the series
+        curr_obs:  A pandas dataframe of the parsed observations, without duplicate timestamps
+
+    Note:
+        The row of the series is locked for the transaction, so loads of the same series are written one at a time.
+
+    Returns:
+        The number of observations inserted
+    """
+
+    with connection, connection.cursor() as cursor:
+        cursor.execute('SELECT firsttimestamp, lasttimestamp FROM series WHERE seriesid = %s FOR UPDATE',
+                       (series.series,))
+        first_stored, last_stored = cursor.fetchone()
+        curr_obs = _remove_stored(cursor, series, curr_obs, first_stored, last_stored)
+        rows = curr_obs.shape[0]
+        if not rows:
+            return 0
+
+        # Reserve the observation ids from the sequence the SOS uses, so that they cannot clash with its own inserts
+        cursor.execute("SELECT nextval('observationid_seq') FROM generate_series(1, %s)", (rows,))
+        observation_ids = [str(row[0]) for row in cursor.fetchall()]
+
+        obs_times = curr_obs['datetime'].values.astype('datetime64[s]')
+        times = np.datetime_as_string(obs_times).tolist()
+        unit = '\\N' if series.unit is None else str(series.unit)
+        for table, positions in _observation_tables(cursor, obs_times):
+            table_ids, table_times = observation_ids, times
+            if positions is not None:
+                table_ids = [observation_ids[position] for position in positions]
+                table_times = [times[position] for position in positions]
+            cursor.copy_expert('COPY {} (observationid, seriesid, phenomenontimestart, phenomenontimeend, resulttime, '
+                               'unitid) FROM STDIN'.format(table),
+                               io.StringIO(_copy_text(table_ids, str(series.series), table_times, table_times,
+                                                      table_times, unit)))
+        cursor.copy_expert('COPY numericvalue (observationid, value) FROM STDIN',
+                           io.StringIO(_copy_text(observation_ids, _copy_values(curr_obs['value']))))
+        cursor.copy_expert('COPY observationhasoffering (observationid, offeringid) FROM STDIN',
+                           io.StringIO(_copy_text(observation_ids, str(series.offering))))
+
+        first = curr_obs.loc[curr_obs['datetime'].idxmin()]
+        last = curr_obs.loc[curr_obs['datetime'].idxmax()]
+        cursor.execute('UPDATE series SET firsttimestamp = %s, firstnumericvalue = %s '
+                       'WHERE seriesid = %s AND (firsttimestamp IS NULL OR firsttimestamp > %s)',
+                       (first['datetime'].to_pydatetime(), _database_value(first['value']), series.series,
+                        first['datetime'].to_pydatetime()))
+        cursor.execute('UPDATE series SET lasttimestamp = %s, lastnumericvalue = %s '
+                       'WHERE seriesid = %s AND (lasttimestamp IS NULL OR lasttimestamp < %s)',
+                       (last['datetime'].to_pydatetime(), _database_value(last['value']), series.series,
+                        last['datetime'].to_pydatetime()))
+
+    return rows
+
+
+def _observation_tables(cursor, obs_times):
+    """Split the observations of a batch between the tables they are written to.  Where the observation table is
+    partitioned by postgresql-node/sos-4-4-1/sos-mods-partition-observations.sql, each is written straight into the
+    table of its year, which is created if need be, rather than row by row through the trigger of the observation
+    table.
+
+    Returns:
+        A list of tuples of a table name, and the positions of the observations written to it, or None for all of them
+    """
+
+    cursor.execute("SELECT to_regprocedure('observation_partition(timestamp without time zone)') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        return [('observation', None)]
+
+    years = obs_times.astype('datetime64[Y]')
+    tables = []
+    for year in np.unique(years):
+        cursor.execute('SELECT observation_partition(%s)', (year.astype('datetime64[s]').item(),))
+        tables.append((cursor.fetchone()[0], np.flatnonzero(years == year).tolist()))
+    return [(tables[0][0], None)] if len(tables) == 1 else tables
+
+
+def _remove_stored(cursor, series, curr_obs, first_stored, last_stored):
+    """Remove the observations whose timestamps the series holds, only looking them up where the observations overlap
+    the stored time range.  The schema has no unique constraint on the timestamps of a series to reject them."""
+
+    if first_stored is None or curr_obs.empty:
+        return curr_obs
+
+    obs_times = curr_obs['datetime']
+    within_stored = ((obs_times >= first_stored) & (obs_times <= last_stored)).values
+    if not within_stored.any():
+        return curr_obs
+
+    overlap_times = obs_times[within_stored]
+    cursor.execute("SELECT phenomenontimestart FROM observation WHERE seriesid = %s AND deleted = 'F' AND "
+                   'phenomenontimestart BETWEEN %s AND %s',
+                   (series.series, overlap_times.min().to_pydatetime(), overlap_times.max().to_pydatetime()))
+    stored_times = pd.to_datetime([row[0] for row in cursor.fetchall()])
+    stored = obs_times.isin(stored_times).values
+
+    logging.info('Skipping {} observations already held by the series.'.format(stored.sum()))
+    return curr_obs[~stored]
+
+
+def _copy_text(*columns):
+    """Join columns into the text format COPY reads, each a list of strings, or a single string repeated on every
+    row.  The columns here never hold tabs, newlines or backslashes, so need no escaping."""
+
+    rows = max(len(column) for column in columns if not isinstance(column, str))
+    columns = [[column] * rows if isinstance(column, str) else column for column in columns]
+    return ''.join(line + '\n' for line in map('\t'.join, zip(*columns)))
+
+
+def _copy_values(values):
+    """Write numeric values as COPY text, with missing values as the null marker."""
+
+    values = values.to_numpy()
+    return ['\\N' if value != value else repr(value) for value in values.tolist()]
+
+
+def _database_value(value):
+    return None if pd.isnull(value) else float(value)
+
+
+def main(arguments):
+    """Load the observations given on the command line into the SOS database, either a single file described by 11
+    positional arguments, or every file listed in a manifest.
+
+    Arguments:
+        arguments:  The command line arguments, without the script name
+
+    Returns:
+        The ResultTypes of the load, for a manifest the first failure if any file failed
+    """
+
+    parser = argparse.ArgumentParser(description='Load observation files straight into the database of a SOS.')
+    parser.add_argument('single', nargs='*',
+                        help='observation file, procedure, property, offering, feature identifier, feature name, '
+                             'feature lat, feature lon, result name, result definition, result unit')
+    parser.add_argument('--dsn', default='',
+                        help='the libpq connection string of the SOS database, by default from the PG environment')
+    parser.add_argument('--manifest', help='a JSON, YAML or CSV manifest of the observation files to load')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='the number of observations written in each transaction')
+    parser.add_argument('--block-size', type=int, help='read the files as a stream of blocks of this many rows')
+    parser.add_argument('--metrics-json', help='a file to write a JSON summary of the timings and counts of the load')
+    args = parser.parse_args(arguments)
+
+    if args.manifest:
+        loads = ObLo.load_manifest(args.manifest)
+    elif len(args.single) == 11:
+        loads = [{'observations': args.single[0],
+                  'procedure': args.single[1],
+                  'obs_property': args.single[2],
+                  'offering': args.single[3],
+                  'template_metadata': {'feature_identifier': args.single[4],
+                                        'feature_name': args.single[5],
+                                        'feature_lat': float(args.single[6]),
+                                        'feature_lon': float(args.single[7]),
+                                        'result_name': args.single[8],
+                                        'result_definition': args.single[9],
+                                        'result_unit': args.single[10]}}]
+    else:
+        return ObLo.ResultTypes.MISSING_PARAMETERS
+
+    metrics = ObLo.LoaderMetrics()
+    connection = connect(args.dsn)
+    results = []
+    try:
+        for load in loads:
+            logging.info('Loading observations from: {}'.format(load['observations']))
+            # Values are stored as double precision, so a precision given in the manifest has no use here
+            results.append(bulk_load_observations(load['observations'], load['procedure'], load['obs_property'],
+                                                  load['offering'], load['template_metadata'],
+                                                  connection=connection, batch_size=args.batch_size,
+                                                  block_size=args.block_size, metrics=metrics))
+    finally:
+        connection.close()
+        if args.metrics_json:
+            metrics.write_json(args.metrics_json)
+
+    failures = [result for result in results if result is not ObLo.ResultTypes.OBSERVATIONS_OK]
+    return failures[0] if failures else ObLo.ResultTypes.OBSERVATIONS_OK
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main(sys.argv[1:]).value)
@@ -0,0 +1,321 @@
+"""A stand-in for the SOS JSON binding, answering the requests the loader and exporter make so that loads and exports
+can be run and timed without a SOS and database.  It keeps the templates and the observations inserted under each in
+memory.
+
+    python StandInSos.py --port 8080 --latency 0.02 --duplicate-rate 0.001 --error-rate 0.01
+"""
+import argparse
+import bisect
+import gzip
+import json
+import logging
+import random
+import socketserver
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+# The exception report of an InsertResult holding an observation that is already stored
+DUPLICATE_TEXT = ('Insert result into database failed! ERROR: duplicate key value violates unique constraint '
+                  '"observationidentity"')
+# The result encoding given to templates registered without one
+DEFAULT_RESULT_ENCODING = {"tokenSeparator": ",", "blockSeparator": "#"}
+
+
+class StandInSos(object):
+    """An HTTP/1.1 keep-alive server answering GetResultTemplate, InsertResultTemplate, InsertResult, GetResult and
+    GetDataAvailability requests as the SOS JSON binding does, with a configurable latency, rate of duplicate
+    observations and rate of injected errors.
+
+    Arguments:
+        host:  The address to listen on
+        port:  The port to listen on, zero for any free port
+        latency:  The seconds each request waits before it is answered
+        row_latency:  The further seconds an InsertResult or GetResult waits for each observation it holds
+        duplicate_rate:  The fraction of new observations treated as already stored, chosen from their timestamps, so
+            the same observations are rejected however often they are sent
+        error_rate:  The fraction of requests answered with error_status and no exception report
+        error_status:  The HTTP status of an injected error, by default 503 as from an overloaded Tomcat
+        seed:  The seed of the injected errors, and of the choice of duplicate observations
+        accept_compression:  Whether gzip and deflate request bodies are accepted, when false they are refused with 415
+            Unsupported Media Type, as by a servlet container that does not decompress requests
+
+    Note:
+        The counters are kept in statistics, and are also returned by a request of {"request": "StandInStatistics"},
+        for a server running in another process.  The max_in_flight counter is the most requests answered at once.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, row_latency=0.0, duplicate_rate=0.0, error_rate=0.0,
+                 error_status=503, seed=0, accept_compression=True):
+        self.latency = latency
+        self.row_latency = row_latency
+        self.duplicate_rate = duplicate_rate
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.seed = seed
+        self.accept_compression = accept_compression
+        self.statistics = {'requests': {}, 'errors_injected': 0, 'rows_inserted': 0, 'rows_rejected': 0,
+                           'bytes_received': 0, 'compressed_requests': 0, 'compression_refused': 0,
+                           'max_in_flight': 0}
+
+        # Template identifier to (result encoding, stored timestamp to value, sorted timestamps or None once changed)
+        self._templates = {}
+        self._random = random.Random(seed)
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+        self.server = _Server((host, port), _StandInHandler)
+        self.server.stand_in = self
+
+    @property
+    def endpoint(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}/service'.format(host, port)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        """Serve requests from a background thread."""
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving requests and close the listening socket."""
+        self.server.shutdown()
+        self.server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def decompress(self, body, content_encoding):
+        """Return the decompressed request body, or None if its Content-Encoding is refused."""
+
+        if content_encoding in ('', 'identity'):
+            return body
+
+        with self._lock:
+            accepted = self.accept_compression and content_encoding in ('gzip', 'deflate')
+            self.statistics['compressed_requests' if accepted else 'compression_refused'] += 1
+        if not accepted:
+            return None
+        return gzip.decompress(body) if content_encoding == 'gzip' else zlib.decompress(body)
+
+    def answer(self, request, body_bytes):
+        """Return the (HTTP status, reply) of a request."""
+
+        operation = request.get('request', 'unknown')
+        with self._lock:
+            requests = self.statistics['requests']
+            requests[operation] = requests.get(operation, 0) + 1
+            self.statistics['bytes_received'] += body_bytes
+            inject_error = operation != 'StandInStatistics' and self._random.random() < self.error_rate
+            if inject_error:
+                self.statistics['errors_injected'] += 1
+
+        if operation == 'StandInStatistics':
+            with self._lock:
+                return 200, json.loads(json.dumps(self.statistics))
+
+        with self._lock:
+            self._in_flight += 1
+            self.statistics['max_in_flight'] = max(self.statistics['max_in_flight'], self._in_flight)
+        try:
+            return self._answer_operation(operation, request, inject_error)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def _answer_operation(self, operation, request, inject_error):
+        time.sleep(self.latency)
+        if inject_error:
+            return self.error_status, None
+
+        if operation == 'GetResultTemplate':
+            return self._get_result_template(request)
+        if operation == 'InsertResultTemplate':
+            return self._insert_result_template(request)
+        if operation == 'InsertResult':
+            return self._insert_result(request)
+        if operation == 'GetResult':
+            return self._get_result(request)
+        if operation == 'GetDataAvailability':
+            return self._get_data_availability(request)
+        return 400, _exception_report('OperationNotSupported', 'request',
+                                      'The requested operation is not supported: {}'.format(operation))
+
+    def _get_result_template(self, request):
+        template_id = '{}-{}'.format(request.get('observedProperty'), request.get('offering'))
+        with self._lock:
+            template = self._templates.get(template_id)
+        if template is None:
+            return 400, _exception_report('InvalidParameterValue', 'offering',
+                                          'No result template for the observed property and offering.')
+
+        return 200, {'request': 'GetResultTemplate', 'version': '2.0.0', 'service': 'SOS',
+                     'resultStructure': {}, 'resultEncoding': template[0]}
+
+    def _insert_result_template(self, request):
+        template_id = request['identifier']
+        result_encoding = dict(DEFAULT_RESULT_ENCODING)
+        result_encoding.update(request.get('resultEncoding') or {})
+        with self._lock:
+            self._templates.setdefault(template_id, [result_encoding, {}, None])
+
+        return 200, {'request': 'InsertResultTemplate', 'version': '2.0.0', 'service': 'SOS',
+                     'acceptedTemplate': template_id}
+
+    def _insert_result(self, request):
+        with self._lock:
+            template = self._templates.get(request.get('templateIdentifier'))
+        if template is None:
+            return 400, _exception_report('InvalidParameterValue', 'templateIdentifier',
+                                          'The requested template identifier is not supported!')
+
+        result_encoding, stored, _ = template
+        blocks = request.get('resultValues', '').split(result_encoding['blockSeparator'])
+        observations = dict((block.split(result_encoding['tokenSeparator'], 1) + [''])[:2] for block in blocks if block)
+        time.sleep(self.row_latency * len(observations))
+
+        # An InsertResult is all or nothing, so a single stored observation rejects the whole request
+        with self._lock:
+            if any(curr_time in stored or self._is_duplicate(curr_time) for curr_time in observations):
+                self.statistics['rows_rejected'] += len(observations)
+                return 400, _exception_report('NoApplicableCode', None, DUPLICATE_TEXT)
+            stored.update(observations)
+            template[2] = None
+            self.statistics['rows_inserted'] += len(observations)
+
+        return 200, {'request': 'InsertResult', 'version': '2.0.0', 'service': 'SOS'}
+
+    def _get_result(self, request):
+        template_id = '{}-{}'.format(request.get('observedProperty'), request.get('offering'))
+        with self._lock:
+            template = self._templates.get(template_id)
+            if template is None:
+                return 400, _exception_report('InvalidParameterValue', 'offering',
+                                              'No result template for the observed property and offering.')
+            result_encoding, stored, ordered = template
+            if ordered is None:
+                ordered = template[2] = sorted(stored)
+
+            # The stored timestamps are in the loader's format, which sorts as text, and the filter's ends are cut to it
+            found = ordered
+            during = (request.get('temporalFilter') or {}).get('during')
+            if during is not None:
+                start, end = (value[:19] for value in during['value'])
+                found = ordered[bisect.bisect_left(ordered, start):bisect.bisect_right(ordered, end)]
+            token_separator = result_encoding['tokenSeparator']
+            blocks = [str(len(found))] + [curr_time + '.000Z' + token_separator + stored[curr_time]
+                                          for curr_time in found]
+        time.sleep(self.row_latency * len(found))
+
+        return 200, {'request': 'GetResult', 'version': '2.0.0', 'service': 'SOS',
+                     'resultValues': result_encoding['blockSeparator'].join(blocks)}
+
+    def _get_data_availability(self, request):
+        template_id = '{}-{}'.format(request.get('observedProperty'), request.get('offering'))
+        with self._lock:
+            template = self._templates.get(template_id)
+            stored = template[1] if template is not None else {}
+            first, last = (min(stored), max(stored)) if stored else (None, None)
+        if first is None:
+            return 200, {'request': 'GetDataAvailability', 'version': '2.0.0', 'service': 'SOS', 'dataAvailability': []}
+
+        return 200, {'request': 'GetDataAvailability', 'version': '2.0.0', 'service': 'SOS',
+                     'dataAvailability': [{'procedure': request.get('procedure'),
+                                           'observedProperty': request.get('observedProperty'),
+                                           'featureOfInterest': 'stand-in',
+                                           'phenomenonTime': [first + '.000Z', last + '.000Z']}]}
+
+    def _is_duplicate(self, curr_time):
+        if not self.duplicate_rate:
+            return False
+        return zlib.crc32('{}{}'.format(self.seed, curr_time).encode('utf-8')) < self.duplicate_rate * 2 ** 32
+
+
+def _exception_report(code, locator, text):
+    exception = {'code': code, 'text': text}
+    if locator is not None:
+        exception['locator'] = locator
+    return {'version': '2.0.0', 'exceptions': [exception]}
+
+
+class _Server(socketserver.ThreadingMixIn, HTTPServer):
+    """An HTTP server answering each connection from its own thread, as http.server.ThreadingHTTPServer does from
+    Python 3.7."""
+
+    daemon_threads = True
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    # Keep connections alive between requests, as the SOS's Tomcat does
+    protocol_version = 'HTTP/1.1'
+    # The headers and body are written separately, which would otherwise wait on the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        stand_in = self.server.stand_in
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            decompressed = stand_in.decompress(body, self.headers.get('Content-Encoding', '').strip().lower())
+            request = json.loads(decompressed.decode('utf-8')) if decompressed is not None else None
+        except (ValueError, OSError, zlib.error):
+            status, reply = 400, _exception_report('InvalidRequest', None, 'The request is not valid JSON.')
+        else:
+            if request is None:
+                status, reply = 415, None
+            else:
+                status, reply = stand_in.answer(request, len(body))
+
+        content = b'' if reply is None else json.dumps(reply).encode('utf-8')
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=UTF-8' if reply is not None else 'text/plain')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away without waiting for the answer, as a cancelled request does
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+
+def serve(ready=None, **options):
+    """Serve until interrupted, sending the endpoint to the ready connection once listening, for a server started in
+    another process."""
+
+    stand_in = StandInSos(**options)
+    if ready is not None:
+        ready.send(stand_in.endpoint)
+    try:
+        stand_in.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stand_in.server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a stand-in SOS for benchmarking the loader.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--row-latency', type=float, default=0.0)
+    parser.add_argument('--duplicate-rate', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--refuse-compression', dest='accept_compression', action='store_false')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    serve(**vars(args))
@@ -0,0 +1,54 @@
+"""Micro-benchmark of the result values encoding, comparing the row by row list comprehension the loader used to build
+InsertResult result values with encode_result_values, with and without a precision.
+
+    python benchmark-encoder.py --rows 1000000 --chunk-size 200 --precision 3
+"""
+import argparse
+import timeit
+
+import numpy as np
+import pandas as pd
+
+import ObservationLoader as ObLo
+
+
+def row_encoding(curr_results):
+    """The encoding used before encode_result_values, kept here as the baseline."""
+    return '#'.join([str(curr_ob[0]) + "," + str(curr_ob[1]) for curr_ob in curr_results.values])
+
+
+def synthetic_observations(rows):
+    """A series like test-data.csv, one reading every second with a full float64 value."""
+    times = pd.date_range('2017-01-01', periods=rows, freq='s')
+    return pd.DataFrame({'datetime': times.strftime(ObLo.DATETIME_FORMAT),
+                         'value': np.random.default_rng(0).standard_normal(rows)})
+
+
+def encode_chunks(encode, curr_obs, chunk_size):
+    """Encode every chunk of the observations, as save_observations does, returning the total payload size."""
+    return sum(len(encode(curr_obs.iloc[start:start + chunk_size]))
+               for start in range(0, curr_obs.shape[0], chunk_size))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the encoding of InsertResult result values.')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--chunk-size', type=int, default=200)
+    parser.add_argument('--precision', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    observations = synthetic_observations(args.rows)
+    encoders = [
+        ('list comprehension', row_encoding),
+        ('encode_result_values', ObLo.encode_result_values),
+        ('encode_result_values, precision={}'.format(args.precision),
+         lambda curr_results: ObLo.encode_result_values(curr_results, precision=args.precision)),
+    ]
+
+    print('{} rows in chunks of {}'.format(args.rows, args.chunk_size))
+    for name, encode in encoders:
+        seconds = min(timeit.repeat(lambda: encode_chunks(encode, observations, args.chunk_size),
+                                    number=1, repeat=args.repeat))
+        payload = encode_chunks(encode, observations, args.chunk_size)
+        print('{:<40} {:8.3f} s  {:10.0f} rows/s  {:12d} bytes'.format(name, seconds, args.rows / seconds, payload))
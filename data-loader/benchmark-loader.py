@@ -0,0 +1,234 @@
+"""Benchmark of the loader against a stand-in SOS, timing each stage of the pipeline, and a whole load, over synthetic
+series like test-data.csv of increasing size.  Each stage runs in a fresh process so that its peak RSS is its own, and
+the stand-in SOS runs in another.  The results are written as JSON, to compare across changes.
+
+    python benchmark-loader.py --rows 1000 10000 100000 1000000 --latency 0.005 --output before.json
+
+The batch stage loads one copy of the series in each of --processes processes at once, through run_processes, so that
+its rows per second can be compared across numbers of processes.
+
+    python benchmark-loader.py --rows 1000000 --stages batch --processes 1 2 4 8 12 --latency 0.005
+
+The series is written as CSV, or with --format as Parquet, Arrow or Feather, which needs pyarrow.
+
+    python benchmark-loader.py --rows 1000000 --stages read load --format arrow
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import ObservationLoader as ObLo
+import StandInSos
+
+
+STAGES = ('read', 'encode', 'load', 'batch')
+# The formats the series can be written in, and the extension of each
+FORMATS = {'csv': '.csv', 'parquet': '.parquet', 'arrow': '.arrow', 'feather': '.feather'}
+
+TEMPLATE_METADATA = {'feature_identifier': 'http://www.52north.org/test/featureOfInterest/benchmark',
+                     'feature_name': 'benchmark',
+                     'feature_lat': 51.0,
+                     'feature_lon': 7.0,
+                     'result_name': 'benchmark',
+                     'result_definition': 'http://www.52north.org/test/observableProperty/benchmark',
+                     'result_unit': 'm'}
+
+
+def write_synthetic_series(path, rows, seed=0):
+    """Write a series like test-data.csv, one reading an hour with a full float64 value, in the format of the path's
+    extension.  A columnar file holds the timestamps as timestamp[s], and an Arrow or Feather file is written
+    uncompressed as one record batch."""
+    times = pd.date_range('2017-01-01', periods=rows, freq='h')
+    values = np.random.default_rng(seed).standard_normal(rows)
+    file_format = ObLo.COLUMNAR_FORMATS.get(os.path.splitext(path)[1])
+    if file_format is None:
+        pd.DataFrame({'datetime': times.strftime(ObLo.DATETIME_FORMAT), 'value': values}).to_csv(path, index=False)
+        return
+
+    import pyarrow
+    import pyarrow.parquet
+    table = pyarrow.table({'datetime': times.values.astype('datetime64[s]'), 'value': values})
+    if file_format == 'parquet':
+        pyarrow.parquet.write_table(table, path)
+    else:
+        with pyarrow.ipc.new_file(path, table.schema) as writer:
+            writer.write_table(table)
+
+
+def peak_rss_bytes():
+    # ru_maxrss is kept across exec, so a spawned process would start with the peak of the process that spawned it,
+    #  whereas the VmHWM of Linux is of the process's own address space
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    # ru_maxrss is in kilobytes on Linux, and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def stand_in_statistics(endpoint):
+    return ObLo.request_json({'request': 'StandInStatistics'}, endpoint)
+
+
+def run_stage(stage, path, rows, endpoint, options, results):
+    """Run one stage over the series at path, putting its measurements on the results queue."""
+
+    baseline_rss = peak_rss_bytes()
+    metrics = ObLo.LoaderMetrics()
+    measured = {'stage': stage, 'rows': rows}
+
+    start = time.perf_counter()
+    if stage == 'read':
+        ObLo.read_observation_arrays(path, metrics=metrics)
+    elif stage == 'encode':
+        curr_obs = ObLo.read_observations(path)
+        start = time.perf_counter()
+        measured['bytes'] = sum(len(ObLo.encode_result_values(curr_obs.iloc[offset:offset + options['chunk_size']]))
+                                for offset in range(0, curr_obs.shape[0], options['chunk_size']))
+    elif stage == 'batch':
+        # The time includes starting the processes, as a batch load would
+        session = ObLo.SosSession(retry_policy=ObLo.RetryPolicy(backoff=0.05), metrics=metrics,
+                                  compression=options['compression'])
+        loads = [{'observations': path,
+                  'procedure': 'http://www.52north.org/test/procedure/benchmark',
+                  'obs_property': 'http://www.52north.org/test/observableProperty/benchmark',
+                  'offering': 'http://www.52north.org/test/offering/benchmark-{}-{}-{}'.format(rows, os.getpid(),
+                                                                                                number),
+                  'template_metadata': TEMPLATE_METADATA}
+                 for number in range(options['processes'])]
+        with session:
+            summary = ObLo.run_processes(loads, endpoint, options['processes'], options['max_requests'], session,
+                                         max_in_flight=options['max_in_flight'], block_size=options['block_size'],
+                                         chunk_size=options['chunk_size'])
+        rows *= len(loads)
+        measured.update({'rows': rows,
+                         'processes': options['processes'],
+                         'result': [result.name for _, result in summary]})
+    else:
+        before = stand_in_statistics(endpoint)
+        session = ObLo.SosSession(retry_policy=ObLo.RetryPolicy(backoff=0.05), metrics=metrics,
+                                  compression=options['compression'])
+        with session:
+            # Each load is of a new offering, so it has to create its template and nothing is stored yet
+            result = ObLo.prepare_observations(path, 'http://www.52north.org/test/procedure/benchmark',
+                                               'http://www.52north.org/test/observableProperty/benchmark',
+                                               'http://www.52north.org/test/offering/benchmark-{}-{}'.format(
+                                                   rows, os.getpid()),
+                                               TEMPLATE_METADATA, endpoint, session,
+                                               max_in_flight=options['max_in_flight'],
+                                               block_size=options['block_size'],
+                                               chunk_size=options['chunk_size'])
+        after = stand_in_statistics(endpoint)
+        measured['result'] = result.name
+        measured['requests'] = {operation: count - before['requests'].get(operation, 0)
+                                for operation, count in after['requests'].items()
+                                if operation != 'StandInStatistics'}
+        measured['connections_opened'] = session.connections_opened
+    seconds = time.perf_counter() - start
+
+    measured.update({'seconds': seconds,
+                     'rows_per_second': rows / seconds if seconds else None,
+                     'baseline_rss_bytes': baseline_rss,
+                     'peak_rss_bytes': peak_rss_bytes(),
+                     'metrics': metrics.summary()})
+    results.put(measured)
+
+
+def run_in_process(context, *arguments):
+    results = context.Queue()
+    process = context.Process(target=run_stage, args=arguments + (results,))
+    process.start()
+    measured = results.get()
+    process.join()
+    return measured
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {'commit': commit,
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the loader against a stand-in SOS.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000, 1000000],
+                        help='the sizes of the series loaded, up to 10000000')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+    parser.add_argument('--format', choices=FORMATS, default='csv', help='the format the series is written in')
+    parser.add_argument('--chunk-size', type=int, default=ObLo.DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--max-in-flight', type=int, default=ObLo.DEFAULT_MAX_IN_FLIGHT)
+    parser.add_argument('--block-size', type=int, default=None)
+    parser.add_argument('--processes', type=int, nargs='+', default=[2],
+                        help='the numbers of processes the batch stage is run with')
+    parser.add_argument('--max-requests', type=int, default=ObLo.DEFAULT_GLOBAL_IN_FLIGHT)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the stand-in SOS takes per request')
+    parser.add_argument('--row-latency', type=float, default=0.0, help='further seconds per observation inserted')
+    parser.add_argument('--duplicate-rate', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--compression', choices=ObLo.CONTENT_ENCODINGS)
+    parser.add_argument('--output', help='the JSON file to write the results to, by default they are printed')
+    args = parser.parse_args()
+
+    # Stages run in spawned processes, so they do not inherit the memory of this one
+    context = multiprocessing.get_context('spawn')
+    ready, sent = context.Pipe(duplex=False)
+    server = context.Process(target=StandInSos.serve, kwargs={'ready': sent, 'latency': args.latency,
+                                                               'row_latency': args.row_latency,
+                                                               'duplicate_rate': args.duplicate_rate,
+                                                               'error_rate': args.error_rate},
+                             daemon=True)
+    server.start()
+    endpoint = ready.recv()
+
+    options = {'chunk_size': args.chunk_size, 'max_in_flight': args.max_in_flight, 'block_size': args.block_size,
+               'compression': args.compression, 'max_requests': args.max_requests}
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as folder:
+            for rows in args.rows:
+                path = os.path.join(folder, 'series-{}{}'.format(rows, FORMATS[args.format]))
+                write_synthetic_series(path, rows)
+                for stage in args.stages:
+                    for processes in (args.processes if stage == 'batch' else [1]):
+                        measured = run_in_process(context, stage, path, rows, endpoint,
+                                                  dict(options, processes=processes))
+                        results.append(measured)
+                        print('{:>10} rows  {:<6} {:8.3f} s  {:12.0f} rows/s  {:8.1f} MiB peak RSS'.format(
+                            measured['rows'], stage, measured['seconds'], measured['rows_per_second'] or 0,
+                            measured['peak_rss_bytes'] / 2 ** 20), file=sys.stderr)
+    finally:
+        server.terminate()
+        server.join()
+
+    report = json.dumps({'environment': environment(),
+                         'options': vars(args),
+                         'results': results}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(report)
+    else:
+        print(report)
@@ -0,0 +1,335 @@
+"""Benchmark of observation storage in the SOS database, comparing the stock postgresql-node/sos-4-4-1 schema with the
+same schema partitioned by year, with BRIN time indexes, by sos-mods-partition-observations.sql.  Synthetic series are
+written into a copy of the database of each schema with PostgresLoader, then the insert rate, the size of the table and
+its indexes, and the latency of time-window queries are measured.  The results are written as JSON, to compare across
+changes.
+
+    python benchmark-postgres.py --dsn "host=127.0.0.1 dbname=sos user=postgres password=postgres" --series 10
+        --rows 100000 --output partitioned.json
+
+The database of the DSN is only used as the template of the copies, named after it with _benchmark_stock and
+_benchmark_partitioned appended, so it must have no other connections.  The copies are dropped afterwards unless --keep
+is given.
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import ObservationLoader as ObLo
+import PostgresLoader
+
+
+SCHEMAS = ('stock', 'partitioned')
+# The script that partitions the observation table of a stock database
+PARTITION_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'postgresql-node', 'sos-4-4-1',
+                                'sos-mods-partition-observations.sql')
+# The orders the series are loaded in, each series whole as in a back-fill, or a batch of every series in turn as
+# when they are kept up to date
+LOAD_ORDERS = ('series', 'time')
+
+# The time-window queries, the observations of one series as GetObservation reads them, and the number of
+#  observations of every series
+QUERIES = {'series': "SELECT o.phenomenontimestart, v.value FROM observation o "
+                     "JOIN numericvalue v ON v.observationid = o.observationid "
+                     "WHERE o.seriesid = %(series)s AND o.deleted = 'F' AND o.phenomenontimestart >= %(start)s "
+                     "AND o.phenomenontimestart < %(end)s ORDER BY o.phenomenontimestart",
+           'all': "SELECT count(*) FROM observation WHERE phenomenontimestart >= %(start)s "
+                  "AND phenomenontimestart < %(end)s"}
+
+# The time columns of the observation table, whose indexes are reported together
+TIME_COLUMNS = ('phenomenontimestart', 'phenomenontimeend', 'resulttime')
+
+TEMPLATE_METADATA = {'feature_name': 'benchmark',
+                     'feature_lat': 51.0,
+                     'feature_lon': 7.0,
+                     'result_name': 'benchmark',
+                     'result_definition': 'http://www.52north.org/test/observableProperty/benchmark',
+                     'result_unit': 'm'}
+
+
+def synthetic_series(number, rows, seed=0):
+    """A series like test-data.csv, one reading an hour with a full float64 value."""
+    return pd.DataFrame({'datetime': pd.date_range('2017-01-01', periods=rows, freq='h'),
+                         'value': np.random.default_rng(seed + number).standard_normal(rows)})
+
+
+def create_database(admin, template, schema):
+    """Copy the template database as the database of a schema, partitioning it if need be, returning its name."""
+
+    database = '{}_benchmark_{}'.format(template, schema)
+    with admin.cursor() as cursor:
+        cursor.execute('DROP DATABASE IF EXISTS "{}"'.format(database))
+        cursor.execute('CREATE DATABASE "{}" TEMPLATE "{}"'.format(database, template))
+
+    if schema == 'partitioned':
+        with open(PARTITION_SCRIPT) as script:
+            statements = script.read()
+        connection = PostgresLoader.psycopg2.connect(admin.dsn, dbname=database)
+        try:
+            # The script commits its own transaction
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute(statements)
+        finally:
+            connection.close()
+    return database
+
+
+def load_series(connection, series_count, rows, batch_size, order):
+    """Write the synthetic series into the database with COPY, timing only the COPY transactions.
+
+    Returns:
+        The SeriesIds of the series, and the measurements of the load
+    """
+
+    loads = []
+    for number in range(series_count):
+        series = PostgresLoader.resolve_series(
+            connection, 'http://www.52north.org/test/procedure/benchmark-{}'.format(number),
+            'http://www.52north.org/test/observableProperty/benchmark',
+            'http://www.52north.org/test/offering/benchmark-{}'.format(number),
+            dict(TEMPLATE_METADATA, feature_identifier='http://www.52north.org/test/featureOfInterest/benchmark-{}'
+                 .format(number)))
+        curr_obs = synthetic_series(number, rows)
+        loads.append([(series, curr_obs.iloc[start:start + batch_size]) for start in range(0, rows, batch_size)])
+
+    if order == 'series':
+        batches = [batch for series_batches in loads for batch in series_batches]
+    else:
+        batches = [batch for time_batches in zip(*loads) for batch in time_batches]
+
+    seconds = 0.0
+    inserted = 0
+    for series, curr_obs in batches:
+        start = time.perf_counter()
+        inserted += PostgresLoader.copy_observations(connection, series, curr_obs)
+        seconds += time.perf_counter() - start
+
+    timing = {'rows': inserted,
+              'batches': len(batches),
+              'seconds': seconds,
+              'rows_per_second': inserted / seconds if seconds else None}
+    return [series_batches[0][0] for series_batches in loads], timing
+
+
+def insert_observations(connection, series, count, after, chunk_size):
+    """Insert observations into a series one statement at a time, as the SOS does for an InsertResult request, with a
+    transaction for each chunk of them.  On the partitioned schema each goes through the trigger of the observation
+    table.
+
+    Raises:
+        ValueError:  If an INSERT does not report the row it inserted, which would fail the inserts of the SOS
+
+    Returns:
+        The measurements of the inserts
+    """
+
+    times = [(after + pd.Timedelta(hours=offset)).to_pydatetime() for offset in range(1, count + 1)]
+    values = np.random.default_rng(count).standard_normal(count).tolist()
+    start = time.perf_counter()
+    for first in range(0, count, chunk_size):
+        with connection, connection.cursor() as cursor:
+            for obs_time, value in zip(times[first:first + chunk_size], values[first:first + chunk_size]):
+                cursor.execute("INSERT INTO observation (observationid, seriesid, phenomenontimestart, "
+                               "phenomenontimeend, resulttime, unitid) VALUES (nextval('observationid_seq'), %s, %s, "
+                               "%s, %s, %s) RETURNING observationid",
+                               (series.series, obs_time, obs_time, obs_time, series.unit))
+                if cursor.rowcount != 1:
+                    raise ValueError('An INSERT into observation reported {} rows.'.format(cursor.rowcount))
+                observation_id = cursor.fetchone()[0]
+                cursor.execute('INSERT INTO numericvalue (observationid, value) VALUES (%s, %s)',
+                               (observation_id, value))
+                cursor.execute('INSERT INTO observationhasoffering (observationid, offeringid) VALUES (%s, %s)',
+                               (observation_id, series.offering))
+    seconds = time.perf_counter() - start
+
+    return {'rows': count,
+            'seconds': seconds,
+            'rows_per_second': count / seconds if seconds else None}
+
+
+def storage_sizes(cursor):
+    """Measure the observation table, with its partitions, and its indexes.
+
+    Returns:
+        The bytes of the tables, of all their indexes and of the indexes on the time columns, and the bytes of each
+        index, those of the partitions counted under the index of observation they were copied from
+    """
+
+    cursor.execute("SELECT c.relname, pg_table_size(c.oid), i.relname, pg_relation_size(i.oid), a.attname "
+                   "FROM pg_class c JOIN pg_index x ON x.indrelid = c.oid JOIN pg_class i ON i.oid = x.indexrelid "
+                   "JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum = x.indkey[0] "
+                   "WHERE c.oid = 'observation'::regclass "
+                   "OR c.oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = 'observation'::regclass)")
+    table_bytes = {}
+    sizes = {'index_bytes': 0, 'time_index_bytes': 0, 'indexes': {}}
+    for table, table_size, index, index_size, column in cursor.fetchall():
+        table_bytes[table] = table_size
+        index = re.sub('^{}_'.format(re.escape(table)), '', index) if table != 'observation' else index
+        index = 'observation_pkey' if index == 'pkey' else index
+        sizes['indexes'][index] = sizes['indexes'].get(index, 0) + index_size
+        sizes['index_bytes'] += index_size
+        if column in TIME_COLUMNS:
+            sizes['time_index_bytes'] += index_size
+    sizes.update({'partitions': len(table_bytes) - 1, 'table_bytes': sum(table_bytes.values())})
+    return sizes
+
+
+def time_queries(cursor, series_ids, rows, windows, count, seed=0):
+    """Time each of the QUERIES over count windows of each length, at random starts within the series.
+
+    Returns:
+        A list of the measurements of each query and window length
+    """
+
+    generator = np.random.default_rng(seed)
+    first = pd.Timestamp('2017-01-01')
+    last = first + pd.Timedelta(hours=rows - 1)
+    measured = []
+    for window in windows:
+        window = pd.Timedelta(window)
+        span = max(int((last - first - window).total_seconds()), 1)
+        starts = [first + pd.Timedelta(seconds=int(offset)) for offset in generator.integers(0, span, count)]
+        series = generator.choice(series_ids, count).tolist()
+        for query, statement in QUERIES.items():
+            latencies = []
+            returned = 0
+            for series_id, start in zip(series, starts):
+                began = time.perf_counter()
+                cursor.execute(statement, {'series': series_id, 'start': start.to_pydatetime(),
+                                           'end': (start + window).to_pydatetime()})
+                returned += len(cursor.fetchall()) if query == 'series' else cursor.fetchone()[0]
+                latencies.append(time.perf_counter() - began)
+            latencies = np.array(latencies) * 1000
+            measured.append({'query': query,
+                             'window': str(window),
+                             'count': count,
+                             'mean_rows': returned / count,
+                             'median_ms': float(np.median(latencies)),
+                             'p95_ms': float(np.percentile(latencies, 95)),
+                             'mean_ms': float(latencies.mean())})
+    return measured
+
+
+def run_schema(admin, template, schema, options):
+    """Load and query the database of a schema, dropping it afterwards unless it is to be kept."""
+
+    database = create_database(admin, template, schema)
+    connection = PostgresLoader.psycopg2.connect(admin.dsn, dbname=database)
+    try:
+        series, load = load_series(connection, options['series'], options['rows'], options['batch_size'],
+                                   options['order'])
+        insert = insert_observations(connection, series[0], options['inserts'],
+                                     pd.Timestamp('2017-01-01') + pd.Timedelta(hours=options['rows'] - 1),
+                                     options['chunk_size'])
+
+        # Summarizes the BRIN ranges, as autovacuum would, and gives both schemas fresh statistics
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            start = time.perf_counter()
+            cursor.execute('VACUUM ANALYZE')
+            vacuum_seconds = time.perf_counter() - start
+            cursor.execute('SHOW server_version')
+            server_version = cursor.fetchone()[0]
+            cursor.execute('SHOW server_version_num')
+            if int(cursor.fetchone()[0]) >= 90600:
+                # The queries are planned as on the 9.5 server of postgresql-node, which has no parallel query
+                cursor.execute('SET max_parallel_workers_per_gather = 0')
+            sizes = storage_sizes(cursor)
+            queries = time_queries(cursor, [ids.series for ids in series], options['rows'], options['windows'],
+                                   options['queries'])
+    finally:
+        connection.close()
+        if not options['keep']:
+            with admin.cursor() as cursor:
+                cursor.execute('DROP DATABASE "{}"'.format(database))
+
+    return {'schema': schema,
+            'database': database,
+            'server_version': server_version,
+            'load': load,
+            'insert': insert,
+            'vacuum_seconds': vacuum_seconds,
+            'sizes': sizes,
+            'queries': queries}
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {'commit': commit,
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'psycopg2': PostgresLoader.psycopg2.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the stock and partitioned observation storage.')
+    parser.add_argument('--dsn', default='',
+                        help='the libpq connection string of a stock SOS database, by default from the PG environment')
+    parser.add_argument('--schemas', nargs='+', choices=SCHEMAS, default=list(SCHEMAS))
+    parser.add_argument('--series', type=int, default=10, help='the number of series loaded')
+    parser.add_argument('--rows', type=int, default=100000, help='the hourly observations of each series')
+    parser.add_argument('--batch-size', type=int, default=PostgresLoader.DEFAULT_BATCH_SIZE)
+    parser.add_argument('--order', choices=LOAD_ORDERS, default='series',
+                        help='load each series whole, or a batch of every series in turn')
+    parser.add_argument('--inserts', type=int, default=1000,
+                        help='the observations then inserted one statement at a time, as the SOS inserts them')
+    parser.add_argument('--chunk-size', type=int, default=ObLo.DEFAULT_CHUNK_SIZE,
+                        help='the observations inserted in each transaction')
+    parser.add_argument('--windows', nargs='+', default=['1h', '1D', '30D'],
+                        help='the lengths of the query windows, as pandas timedelta strings')
+    parser.add_argument('--queries', type=int, default=50, help='the queries timed of each kind and window')
+    parser.add_argument('--keep', action='store_true', help='keep the benchmark databases')
+    parser.add_argument('--output', help='the JSON file to write the results to, by default they are printed')
+    args = parser.parse_args()
+
+    # The template cannot be copied while connected to, so the copies are made from the maintenance database
+    admin = PostgresLoader.connect(args.dsn)
+    template = admin.get_dsn_parameters()['dbname']
+    admin.close()
+    admin = PostgresLoader.psycopg2.connect(args.dsn, dbname='postgres')
+    admin.autocommit = True
+
+    options = vars(args)
+    results = []
+    try:
+        for schema in args.schemas:
+            measured = run_schema(admin, template, schema, options)
+            results.append(measured)
+            sizes = measured['sizes']
+            print('{:<12} {:10d} rows  {:10.0f} rows/s COPY  {:8.0f} rows/s INSERT  {:8.1f} MiB table  {:8.1f} MiB '
+                  'indexes  {:8.3f} MiB time indexes'.format(
+                      schema, measured['load']['rows'], measured['load']['rows_per_second'] or 0,
+                      measured['insert']['rows_per_second'] or 0, sizes['table_bytes'] / 2 ** 20,
+                      sizes['index_bytes'] / 2 ** 20, sizes['time_index_bytes'] / 2 ** 20), file=sys.stderr)
+            for query in measured['queries']:
+                print('{:<12} {:<6} {:>16}  {:8.3f} ms median  {:8.3f} ms p95  {:10.1f} rows'.format(
+                    schema, query['query'], query['window'], query['median_ms'], query['p95_ms'],
+                    query['mean_rows']), file=sys.stderr)
+    finally:
+        admin.close()
+
+    report = json.dumps({'environment': environment(),
+                         'options': vars(args),
+                         'results': results}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(report)
+    else:
+        print(report)
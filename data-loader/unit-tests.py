@@ -1,11 +1,81 @@
+import asyncio
+import http.client
+import importlib.util
+import io
 import json
+import os
+import pickle
+import re
+import tempfile
+import threading
+import time
+import tracemalloc
 import unittest
 from unittest.mock import patch
 from unittest.mock import MagicMock
 
+import numpy as np
 import pandas as pd
 
+import AsyncObservationLoader
+import ObservationExporter
 import ObservationLoader as ObLo
+import PostgresLoader
+import StandInSos
+
+
+# The libpq connection string of a throwaway SOS database built from postgresql-node/sos-4-4-1, for the bulk load tests
+TEST_DSN = os.environ.get('SOS_TEST_DSN')
+
+# The exception report of an InsertResult holding an observation that is already stored
+DUPLICATE_REPLY = {"exceptions": [{"code": "NoApplicableCode",
+                                   "text": "Insert result into database failed! Duplicate key value violates unique "
+                                           "constraint \"observationidentity\""}]}
+
+
+class FakeSosSession(object):
+    """Stands in for a SosSession, answering each request with the reply returned by respond for it, or the (status,
+    reply) tuple if it returns one, and recording the requests made and the largest number of them that were in flight
+    at once."""
+
+    def __init__(self, respond=None, delay=0, retry_policy=None):
+        self.respond = respond or (lambda request: {"request": request['request']})
+        self.delay = delay
+        self.retry_policy = retry_policy or ObLo.RetryPolicy(backoff=0)
+        self.metrics = ObLo.LoaderMetrics()
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.connections_opened = 0
+        self.connections_reused = 0
+        self._lock = threading.Lock()
+
+    def content_encoding(self, endpoint):
+        return None
+
+    def post(self, endpoint, body, headers):
+        request = json.loads(body.decode('utf-8'))
+        with self._lock:
+            self.requests.append(request)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.delay)
+        with self._lock:
+            self.in_flight -= 1
+        status, reply = 200, self.respond(request)
+        if isinstance(reply, tuple):
+            status, reply = reply
+        return status, 'utf-8', json.dumps(reply).encode('utf-8')
+
+
+def run_coroutine(coroutine):
+    """Run a coroutine on a new event loop, as asyncio.run does from Python 3.7."""
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
 
 
 class TestIdentifyTemplate(unittest.TestCase):
@@ -330,6 +400,33 @@ class TestObservationDeduplication(unittest.TestCase):
         # Values kept correct
         self.assertTrue(return_obs.loc[:, 'value'].tolist() == [23, 24, 25, 27, 28])
 
+    def test_unsorted_deduplication(self):
+        # Out of order, the last of each timestamp is kept where it is in the file, unless sorted by time
+        unsorted = self.duplicate_values.iloc[[5, 0, 2, 1, 6, 4, 3]].reset_index(drop=True)
+        curr_obs = ObLo.ObservationArrays.from_frame(unsorted)
+
+        return_obs = ObLo.remove_duplicate_observations(unsorted.copy())
+        self.assertTrue(return_obs.loc[:, 'value'].tolist() == [24, 23, 28, 26, 25])
+        self.assertTrue(ObLo.remove_duplicate_observations(curr_obs).values.tolist() == [24, 23, 28, 26, 25])
+
+        return_obs = ObLo.remove_duplicate_observations(unsorted.copy(), sort=True)
+        self.assertTrue(return_obs.loc[:, 'value'].tolist() == [23, 24, 25, 26, 28])
+        sorted_obs = ObLo.remove_duplicate_observations(curr_obs, sort=True)
+        self.assertTrue(sorted_obs.values.tolist() == [23, 24, 25, 26, 28])
+        self.assertTrue(sorted_obs.rows.tolist() == [3, 2, 6, 5, 4])
+
+    def test_sorted_input_kept(self):
+        # Sorted input without duplicates is returned as it is, without being copied
+        curr_obs = ObLo.ObservationArrays.from_frame(self.ok_data)
+        self.assertTrue(ObLo.remove_duplicate_observations(curr_obs) is curr_obs)
+        self.assertTrue(ObLo.remove_duplicate_observations(curr_obs, sort=True) is curr_obs)
+
+    def test_sorted_chunk_journal(self):
+        # A chunk in time order commits only the runs of rows it holds, not the range from its first to last row
+        journal = MagicMock()
+        ObLo._commit_chunk(journal, ObLo.ObservationArrays([0, 60, 120, 180], [1.0] * 4, [7, 2, 3, 5]))
+        self.assertTrue([call.args for call in journal.commit.call_args_list] == [(2, 4), (5, 6), (7, 8)])
+
 
 class TestObservationSaving(unittest.TestCase):
     def setUp(self):
@@ -400,17 +497,10 @@ class TestObservationSaving(unittest.TestCase):
         self.assertTrue(call_dict['templateIdentifier'] == self.insert_command['templateIdentifier'])
         self.assertTrue(call_dict['resultValues'] == self.insert_command['resultValues'])
 
-        # Reset, and set side effects so that first call fails, and then three inserts are made, check all values.
+        # Reset, and set side effects so that first call fails, and the halves are then inserted, check all values.
         self.mock_request.reset_mock()
         self.mock_url_stream_open.reset_mock()
-        bad_result = json.dumps(
-            {
-                "exceptions": "ManyOfThem",
-                "request": "InsertResult",
-                "version": "2.0.0",
-                "service": "SOS"
-            }
-        ).encode('utf-8')
+        bad_result = json.dumps(DUPLICATE_REPLY).encode('utf-8')
 
         ok_result = json.dumps(
             {
@@ -420,15 +510,19 @@ class TestObservationSaving(unittest.TestCase):
             }
         ).encode('utf-8')
 
-        # Set the side effects of the mock url stream, so that the first insert fails, and the rest are OK.
-        self.mock_url_stream_open.read.side_effect = [bad_result, ok_result, ok_result, ok_result, ok_result]
-        ObLo.save_observations(test_dataset, "http://test.template", "127.0.0.1:8080/observations/service", 100)
+        # Set the side effects of the mock url stream, so that the first insert fails, and then the first and second
+        #  observations on their own are OK.
+        self.mock_url_stream_open.read.side_effect = [bad_result, ok_result, ok_result]
+        outcomes = ObLo.save_observations(test_dataset, "http://test.template", "127.0.0.1:8080/observations/service",
+                                          100)
 
-        # Check for four calls, one that failed, and the three individual calls for the three observations
-        self.assertTrue(self.mock_request.call_count == 4)
+        # Check for three calls, the failed chunk, and the first two observations, as the first half was inserted
+        #  the second half is known to be rejected, and once the second observation is inserted the third is known to
+        #  be the rejected one without sending either
+        self.assertTrue(self.mock_request.call_count == 3)
+        self.assertTrue(outcomes == [ObLo.ChunkOutcome(0, 3, 2, 1, 3)])
 
-        # Check all the call args are correct for the first individual observation, then check the value of the second
-        #  and third are correct.
+        # Check all the call args are correct for the first observation, then check the value of the second is correct.
         kall = self.mock_request.call_args_list[1]
         args, kwargs = kall
         call_dict = json.loads(kwargs['data'].decode('utf-8'))
@@ -444,10 +538,1698 @@ class TestObservationSaving(unittest.TestCase):
         call_dict = json.loads(kwargs['data'].decode('utf-8'))
         self.assertTrue(call_dict['resultValues'] == "2017-09-27T09:04:00,22.9")
 
-        kall = self.mock_request.call_args_list[3]
-        args, kwargs = kall
-        call_dict = json.loads(kwargs['data'].decode('utf-8'))
-        self.assertTrue(call_dict['resultValues'] == "2017-09-27T09:08:00,23.5")
+    def test_bisection_request_count(self):
+        # A 200 observation chunk holding a single stored observation should need far fewer than 200 extra requests
+        test_dataset = pd.DataFrame([["2017-09-27T{:02d}:{:02d}:00".format(row // 60, row % 60), float(row)]
+                                     for row in range(200)])
+        test_dataset.columns = ['datetime', 'value']
+        session = FakeSosSession(lambda request: DUPLICATE_REPLY if '01:17:00' in request['resultValues'] else {})
+
+        outcomes = ObLo.save_observations(test_dataset, "http://test.template", "http://127.0.0.1/service", 200,
+                                          session)
+
+        self.assertTrue(outcomes[0].inserted == 199)
+        self.assertTrue(outcomes[0].rejected == 1)
+        self.assertTrue(outcomes[0].requests <= 1 + 2 * 8)
+        self.assertTrue(outcomes[0].requests == len(session.requests))
+        self.assertFalse(any('01:17:00' in request['resultValues'] and request['resultValues'].count('#') == 0
+                             for request in session.requests))
+
+
+class TestSosSession(unittest.TestCase):
+    def setUp(self):
+        # Mock the response object returned by each connection
+        self.mock_response = MagicMock(name='mock-response')
+        self.mock_response.status = 200
+        self.mock_response.will_close = False
+        self.mock_response.msg.get_content_charset.return_value = 'utf-8'
+        self.mock_response.read.return_value = json.dumps(
+            {
+                "request": "InsertResult",
+                "version": "2.0.0",
+                "service": "SOS"
+            }
+        ).encode('utf-8')
+
+        # Patch the connection class, so every connection opened returns the mock response
+        patch_connection = patch('http.client.HTTPConnection')
+        self.mock_connection_class = patch_connection.start()
+        self.mock_connection = self.mock_connection_class.return_value
+        self.mock_connection.getresponse.return_value = self.mock_response
+
+        self.addCleanup(patch_connection.stop)
+
+    def test_connection_reuse(self):
+        session = ObLo.SosSession(pool_size=2)
+        for _ in range(3):
+            self.assertTrue(ObLo.send_request({'request': 'InsertResult'}, 'exceptions', False,
+                                              'http://127.0.0.1:8080/observations/service', session))
+
+        # A single connection should have been opened, and then reused for the remaining requests
+        self.mock_connection_class.assert_called_once_with('127.0.0.1', 8080, timeout=ObLo.DEFAULT_TIMEOUT)
+        self.assertTrue(session.connections_opened == 1)
+        self.assertTrue(session.connections_reused == 2)
+        self.assertTrue(session.requests_sent == 3)
+
+        args, kwargs = self.mock_connection.request.call_args
+        self.assertTrue(args == ('POST', '/observations/service'))
+        self.assertTrue(kwargs['headers'] == {'Content-Type': 'application/json'})
+
+        session.close()
+        self.mock_connection.close.assert_called_once_with()
+
+    def test_stale_connection_reopened(self):
+        session = ObLo.SosSession()
+        session.post('http://127.0.0.1:8080/observations/service', b'{}', {})
+
+        # The server closes the idle connection, so the next request has to be resent on a new connection
+        self.mock_connection.getresponse.side_effect = [http.client.RemoteDisconnected(), self.mock_response]
+        status, charset, content = session.post('http://127.0.0.1:8080/observations/service', b'{}', {})
+
+        self.assertTrue(status == 200)
+        self.assertTrue(session.connections_opened == 2)
+        self.assertTrue(session.requests_sent == 2)
+
+    def test_error_status(self):
+        self.mock_response.status = 400
+        session = ObLo.SosSession()
+        self.assertFalse(ObLo.send_request({'request': 'GetResultTemplate'}, 'exceptions', False,
+                                           'http://127.0.0.1:8080/observations/service', session))
+
+    def test_bad_endpoint(self):
+        with self.assertRaises(ValueError):
+            ObLo.SosSession().post('127.0.0.1:8080/observations/service', b'{}', {})
+
+
+class TestConcurrentSaving(unittest.TestCase):
+    def setUp(self):
+        self.test_dataset = pd.DataFrame([
+            ["2017-09-27T09:0{}:00".format(minute), float(minute)] for minute in range(10)
+        ])
+        self.test_dataset.columns = ['datetime', 'value']
+
+    def test_outcomes_in_order(self):
+        session = FakeSosSession(delay=0.01)
+        outcomes = ObLo.save_observations(self.test_dataset, "http://test.template", "http://127.0.0.1/service", 2,
+                                          session, max_in_flight=3)
+
+        # The outcomes are in chunk order, and no more than three chunks were in flight at once
+        self.assertTrue([(outcome.start, outcome.stop) for outcome in outcomes] ==
+                        [(0, 2), (2, 4), (4, 6), (6, 8), (8, 10)])
+        self.assertTrue(all(outcome.inserted == 2 for outcome in outcomes))
+        self.assertTrue(1 < session.max_in_flight <= 3)
+        self.assertTrue(sorted(request['resultValues'] for request in session.requests)[1] ==
+                        "2017-09-27T09:02:00,2.0#2017-09-27T09:03:00,3.0")
+
+    def test_failed_chunk(self):
+        # Reject any request containing the already stored observation
+        session = FakeSosSession(lambda request: DUPLICATE_REPLY if '09:05' in request['resultValues'] else {})
+        outcomes = ObLo.save_observations(self.test_dataset, "http://test.template", "http://127.0.0.1/service", 4,
+                                          session, max_in_flight=2)
+
+        self.assertTrue(outcomes[1] == ObLo.ChunkOutcome(4, 8, 3, 1, 4))
+        self.assertTrue(sum(outcome.inserted for outcome in outcomes) == 9)
+
+    def test_deduplicated_index(self):
+        # After removing duplicates the index has gaps, every remaining row must still be sent
+        duplicated = pd.concat([self.test_dataset.iloc[:2], self.test_dataset]).reset_index(drop=True)
+        ObLo.remove_duplicate_observations(duplicated)
+
+        session = FakeSosSession()
+        outcomes = ObLo.save_observations(duplicated, "http://test.template", "http://127.0.0.1/service", 4,
+                                          session, max_in_flight=2)
+
+        self.assertTrue(sum(outcome.inserted for outcome in outcomes) == 10)
+        self.assertTrue(len(session.requests) == 3)
+
+
+class TestIncrementalLoading(unittest.TestCase):
+    def setUp(self):
+        self.test_dataset = pd.DataFrame([
+            ["2017-09-27T09:0{}:00".format(minute), float(minute)] for minute in range(10)
+        ])
+        self.test_dataset.columns = ['datetime', 'value']
+
+    def respond(self, request):
+        if request['request'] == 'GetDataAvailability':
+            return {"dataAvailability": [{"phenomenonTime": ["2017-09-27T08:00:00.000Z", "2017-09-27T09:06:00.000Z"]}]}
+        # There is a gap in the stored observations at 09:03:00
+        return {"resultValues": "3#2017-09-27T09:01:00.000Z,1.0#2017-09-27T09:02:00.000Z,2.0#"
+                                "2017-09-27T09:04:00.000Z,4.0#2017-09-27T09:05:00.000Z,5.0"}
+
+    def test_range_mode(self):
+        session = FakeSosSession(self.respond)
+        remaining = ObLo.remove_stored_observations(self.test_dataset, 'test-procedure', 'test-property',
+                                                    'test-offering', 'http://127.0.0.1/service',
+                                                    ObLo.IncrementalModes.RANGE, session)
+
+        self.assertTrue(remaining['datetime'].tolist() == ["2017-09-27T09:07:00", "2017-09-27T09:08:00",
+                                                           "2017-09-27T09:09:00"])
+        self.assertTrue([request['request'] for request in session.requests] == ['GetDataAvailability'])
+
+    def test_timestamps_mode(self):
+        session = FakeSosSession(self.respond)
+        remaining = ObLo.remove_stored_observations(self.test_dataset, 'test-procedure', 'test-property',
+                                                    'test-offering', 'http://127.0.0.1/service',
+                                                    ObLo.IncrementalModes.TIMESTAMPS, session)
+
+        self.assertTrue(remaining['value'].tolist() == [0.0, 3.0, 6.0, 7.0, 8.0, 9.0])
+
+        # The stored timestamps are only asked for where the observations overlap the stored range
+        get_result = session.requests[1]
+        self.assertTrue(get_result['request'] == 'GetResult')
+        self.assertTrue(get_result['temporalFilter']['during']['value'] ==
+                        ["2017-09-27T08:59:59Z", "2017-09-27T09:06:01Z"])
+
+    def test_nothing_stored(self):
+        session = FakeSosSession(lambda request: {"dataAvailability": []})
+        remaining = ObLo.remove_stored_observations(self.test_dataset, 'test-procedure', 'test-property',
+                                                    'test-offering', 'http://127.0.0.1/service',
+                                                    ObLo.IncrementalModes.TIMESTAMPS, session)
+
+        self.assertTrue(remaining.shape[0] == 10)
+        self.assertTrue(len(session.requests) == 1)
+
+    def test_range_mode_in_blocks(self):
+        template_metadata = {'feature_identifier': 'test-feature', 'feature_name': 'test-feature-name',
+                             'feature_lat': 22, 'feature_lon': 22, 'result_name': 'test-result-name',
+                             'result_definition': 'test-result-definition', 'result_unit': 'm'}
+
+        def load(observations, **options):
+            return ObLo.prepare_observations(io.StringIO(observations), 'test-procedure', 'test-property',
+                                             'test-offering', template_metadata, stand_in.endpoint,
+                                             incremental=ObLo.IncrementalModes.RANGE, **options)
+
+        # 09:01:00 is read after the block holding 09:00:00 and 09:02:00 has been sent, but is not stored before it
+        with StandInSos.StandInSos() as stand_in:
+            load("datetime,value\n2017-09-27T08:00:00,0.0\n")
+            result = load("datetime,value\n2017-09-27T09:00:00,1.0\n2017-09-27T09:02:00,2.0\n"
+                          "2017-09-27T09:01:00,3.0\n2017-09-27T09:03:00,4.0\n", block_size=2)
+
+        self.assertTrue(result is ObLo.ResultTypes.OBSERVATIONS_OK)
+        self.assertTrue(stand_in.statistics['rows_inserted'] == 5)
+        self.assertTrue(stand_in.statistics['requests']['GetDataAvailability'] == 1)
+
+
+class TestStreamingLoad(unittest.TestCase):
+    def setUp(self):
+        # The duplicated timestamp 09:02:00 lands either side of the boundary between the first and second blocks
+        self.test_csv = ("datetime,value\n"
+                         "2017-09-27T09:00:00,0.0\n"
+                         "2017-09-27T09:01:00,1.0\n"
+                         "2017-09-27T09:02:00,2.0\n"
+                         "2017-09-27T09:02:00,2.5\n"
+                         "2017-09-27T09:03:00,3.0\n"
+                         "2017-09-27T09:04:00,4.0\n"
+                         "2017-09-27T09:04:00,4.5\n")
+
+        self.template_metadata = {'feature_identifier': 'test-feature',
+                                  'feature_name': 'test-feature-name',
+                                  'feature_lat': 22,
+                                  'feature_lon': 22,
+                                  'result_name': 'test-result-name',
+                                  'result_definition': 'test-result-definition',
+                                  'result_unit': 'm'}
+
+    def test_block_boundary_duplicates(self):
+        blocks = list(ObLo.read_observation_blocks(io.StringIO(self.test_csv), 3))
+
+        self.assertTrue(all(block.shape[0] <= 3 for block in blocks))
+        streamed = pd.concat(blocks)
+        self.assertTrue(streamed['value'].tolist() == [0.0, 1.0, 2.5, 3.0, 4.5])
+
+        # The stream matches reading the whole file at once
+        whole = ObLo.read_observations(io.StringIO(self.test_csv))
+        self.assertTrue(streamed['value'].tolist() == whole['value'].tolist())
+
+    def test_distant_duplicates(self):
+        # 09:01:00 is repeated in the following block, but not next to the boundary
+        test_csv = ("datetime,value\n"
+                    "2017-09-27T09:00:00,0.0\n"
+                    "2017-09-27T09:01:00,1.0\n"
+                    "2017-09-27T09:02:00,2.0\n"
+                    "2017-09-27T09:01:00,10.0\n"
+                    "2017-09-27T09:03:00,3.0\n")
+        # Streamed, the second block overlaps the first, and its duplicate is left to the SOS
+        metrics = ObLo.LoaderMetrics()
+        with self.assertLogs(level='WARNING'):
+            streamed = pd.concat(ObLo.read_observation_blocks(io.StringIO(test_csv), 3, metrics))
+        self.assertTrue(streamed['value'].tolist() == [0.0, 1.0, 2.0, 10.0, 3.0])
+        self.assertTrue(metrics.counters == {'rows_read': 5, 'duplicates_dropped': 0, 'overlapping_blocks': 1})
+
+        # With keep_last the timestamps of the whole file are read first, and the last of the duplicates is kept
+        metrics = ObLo.LoaderMetrics()
+        streamed = pd.concat(ObLo.read_observation_blocks(io.StringIO(test_csv), 3, metrics, keep_last=True))
+        self.assertTrue(streamed['value'].tolist() == [0.0, 2.0, 10.0, 3.0])
+        self.assertTrue(streamed['value'].tolist() == ObLo.read_observations(io.StringIO(test_csv))['value'].tolist())
+        self.assertTrue(metrics.counters == {'rows_read': 5, 'duplicates_dropped': 1})
+
+    def test_block_parse_failure(self):
+        bad_csv = self.test_csv + "27-09-2017T09:05:00,5.0\n"
+        with self.assertRaises(ValueError):
+            list(ObLo._prefetch(ObLo.read_observation_blocks(io.StringIO(bad_csv), 3)))
+
+    def test_streamed_load(self):
+        session = FakeSosSession()
+        result = ObLo.prepare_observations(io.StringIO(self.test_csv), 'test-procedure', 'test-property',
+                                           'test-offering', self.template_metadata, 'http://127.0.0.1/service',
+                                           session, block_size=2)
+
+        self.assertTrue(result is ObLo.ResultTypes.OBSERVATIONS_OK)
+        sent = '#'.join(request['resultValues'] for request in session.requests if request['request'] == 'InsertResult')
+        self.assertTrue(sent == "2017-09-27T09:00:00,0.0#2017-09-27T09:01:00,1.0#2017-09-27T09:02:00,2.5#"
+                                "2017-09-27T09:03:00,3.0#2017-09-27T09:04:00,4.5")
+
+
+class TestResultEncoding(unittest.TestCase):
+    def setUp(self):
+        self.test_dataset = pd.DataFrame([
+            ["2017-09-27T09:00:00", 22.2],
+            ["2017-09-27T09:04:00", -0.8205442255808499],
+            ["2017-09-27T09:08:00", float('nan')],
+            ["2017-09-27T09:12:00", 1e-07]
+        ])
+        self.test_dataset.columns = ['datetime', 'value']
+
+    def test_matches_row_encoding(self):
+        expected = '#'.join([str(curr_ob[0]) + "," + str(curr_ob[1]) for curr_ob in self.test_dataset.values])
+        self.assertTrue(ObLo.encode_result_values(self.test_dataset) == expected)
+
+        integers = pd.DataFrame({'datetime': ["2017-09-27T09:00:00", "2017-09-27T09:04:00"], 'value': [22, 23]})
+        self.assertTrue(ObLo.encode_result_values(integers) == "2017-09-27T09:00:00,22#2017-09-27T09:04:00,23")
+
+    def test_separators_and_precision(self):
+        encoded = ObLo.encode_result_values(self.test_dataset, '#', '@', precision=3)
+        self.assertTrue(encoded == "2017-09-27T09:00:00#22.2@2017-09-27T09:04:00#-0.821@"
+                                   "2017-09-27T09:08:00#nan@2017-09-27T09:12:00#0.0")
+
+    def test_datetime_column(self):
+        self.test_dataset['datetime'] = pd.to_datetime(self.test_dataset['datetime'], format='%Y-%m-%dT%H:%M:%S')
+        encoded = ObLo.encode_result_values(self.test_dataset.iloc[:2])
+        self.assertTrue(encoded == "2017-09-27T09:00:00,22.2#2017-09-27T09:04:00,-0.8205442255808499")
+
+    def test_template_encoding_used(self):
+        def respond(request):
+            if request['request'] == 'GetResultTemplate':
+                return {"resultEncoding": {"tokenSeparator": "#", "blockSeparator": "@"}}
+            return {"request": request['request']}
+
+        session = FakeSosSession(respond)
+        ObLo.prepare_observations(io.StringIO("datetime,value\n2017-09-27T09:00:00,22.25\n2017-09-27T09:04:00,23\n"),
+                                  'test-procedure', 'test-property', 'test-offering', {}, 'http://127.0.0.1/service',
+                                  session, precision=1)
+
+        self.assertTrue(session.requests[-1]['resultValues'] == "2017-09-27T09:00:00#22.2@2017-09-27T09:04:00#23.0")
+
+    def test_decode_result_arrays(self):
+        encoded = ObLo.encode_result_values(self.test_dataset)
+        for result_values in [encoded,
+                              '4#' + encoded,
+                              encoded.replace(',', '.000Z,'),
+                              encoded.replace(',', '.5+00:00,'),
+                              encoded.replace('09:', '11:').replace(',', '+02:00,'),
+                              encoded.replace('1e-07', 'noData')]:
+            curr_obs = ObLo.decode_result_arrays(result_values, ',', '#')
+            expected = ObLo.decode_result_values(result_values, ',', '#')
+            self.assertTrue(np.array_equal(curr_obs.datetimes, expected['datetime'].values.astype('datetime64[s]')))
+            self.assertTrue(np.array_equal(curr_obs.values, expected['value'].values, equal_nan=True))
+            self.assertTrue(list(curr_obs.rows) == [0, 1, 2, 3])
+
+        # Timestamps of differing widths, and longer separators, are decoded without the fixed layout
+        for result_values, token_separator, block_separator in [
+                ('2017-09-27T09:00:00.5Z,22.2#2017-09-27T09:04:00.25Z,23', ',', '#'),
+                ('2017-09-27T09:00:00||22.2;;2017-09-27T09:04:00||23', '||', ';;')]:
+            self.assertTrue(ObLo._decode_fixed_layout(result_values, token_separator, block_separator) is None)
+            curr_obs = ObLo.decode_result_arrays(result_values, token_separator, block_separator, np.float32)
+            self.assertTrue(list(curr_obs.datetimes.astype(str)) == ['2017-09-27T09:00:00', '2017-09-27T09:04:00'])
+            self.assertTrue(list(curr_obs.values) == [np.float32(22.2), 23] and curr_obs.values.dtype == np.float32)
+
+        for result_values in ['', '0', '2017-09-27T09:00:00,22.2#2017-13-27T09:04:00,23',
+                              '2017-09-27T09:00:00,22.2#2017-02-30T09:04:00,23']:
+            if result_values.count(',') > 1:
+                with self.assertRaises(ValueError):
+                    ObLo.decode_result_arrays(result_values, ',', '#')
+            else:
+                self.assertTrue(len(ObLo.decode_result_arrays(result_values, ',', '#')) == 0)
+
+
+class TestTypedParsing(unittest.TestCase):
+    def setUp(self):
+        self.test_csv = ("datetime,value\n"
+                         "2017-09-27T09:00:00,22.2\n"
+                         "2017-09-27T09:04:00,\n"
+                         "2017-09-27T09:08:00,23\n")
+
+    def test_typed_columns(self):
+        curr_obs = ObLo.read_observations(io.StringIO(self.test_csv))
+
+        self.assertTrue(pd.api.types.is_datetime64_any_dtype(curr_obs['datetime']))
+        self.assertTrue(curr_obs['value'].dtype == 'float64')
+        self.assertTrue(ObLo.encode_result_values(curr_obs) ==
+                        "2017-09-27T09:00:00,22.2#2017-09-27T09:04:00,nan#2017-09-27T09:08:00,23.0")
+
+    def test_offending_rows(self):
+        bad_value = self.test_csv + "2017-09-27T09:12:00,bad value\n2017-09-27T09:16:00,1\n2017-09-27T09:20:00,x\n"
+        with self.assertRaises(ObLo.ObservationParseError) as context:
+            ObLo.read_observations(io.StringIO(bad_value))
+        self.assertTrue(context.exception.rows == [5, 7])
+
+        bad_date = self.test_csv + "2017-09-27 09:12:00,1.0\n"
+        with self.assertRaises(ObLo.ObservationParseError) as context:
+            ObLo.read_observations(io.StringIO(bad_date))
+        self.assertTrue(context.exception.rows == [5])
+
+        # The rows are numbered across the whole file when it is read in blocks
+        with self.assertRaises(ObLo.ObservationParseError) as context:
+            list(ObLo.read_observation_blocks(io.StringIO(bad_value), 2))
+        self.assertTrue(context.exception.rows[0] == 5)
+
+    def test_header_checked_first(self):
+        with self.assertRaises(ObLo.ObservationParseError) as context:
+            ObLo.read_observations(io.StringIO("time,value\nnot a time,not a value\n"))
+        self.assertTrue('column names' in str(context.exception))
+
+
+class TestObservationArrays(unittest.TestCase):
+    def setUp(self):
+        self.test_csv = ("datetime,value\n"
+                         "2017-09-27T09:00:00,22.2\n"
+                         "2017-09-27T09:04:00,\n"
+                         "2017-09-27T09:04:00,22.5\n"
+                         "2017-09-27T09:08:00,23\n"
+                         "2017-09-27T09:00:00,21.9\n")
+
+    def test_read_matches_dataframe(self):
+        # Parsed in blocks of two rows, with duplicates in different blocks, the last of which is kept
+        curr_obs = ObLo.read_observation_arrays(io.StringIO(self.test_csv), block_size=2)
+        expected = ObLo.read_observations(io.StringIO(self.test_csv))
+
+        self.assertTrue(curr_obs.times.dtype == 'int64' and curr_obs.values.dtype == 'float64')
+        self.assertTrue(curr_obs.rows.tolist() == expected.index.tolist() == [2, 3, 4])
+        self.assertTrue(curr_obs.to_frame()['datetime'].tolist() == expected['datetime'].tolist())
+        self.assertTrue(curr_obs.to_frame()['value'].tolist() == expected['value'].tolist())
+        self.assertTrue(ObLo.encode_result_values(curr_obs) == ObLo.encode_result_values(expected) ==
+                        "2017-09-27T09:04:00,22.5#2017-09-27T09:08:00,23.0#2017-09-27T09:00:00,21.9")
+
+    def test_slices_are_views(self):
+        curr_obs = ObLo.read_observation_arrays('test-data.csv')
+        chunk = curr_obs[100:300]
+
+        self.assertTrue(len(chunk) == 200 and chunk.rows[0] == 100)
+        for column in ('times', 'values', 'rows'):
+            self.assertTrue(np.shares_memory(getattr(chunk, column), getattr(curr_obs, column)))
+        self.assertTrue(curr_obs.nbytes == 24 * len(curr_obs))
+
+    def test_float32_values(self):
+        curr_obs = ObLo.read_observation_arrays(io.StringIO(self.test_csv), 'float32')
+
+        # The values are written as their shortest float32 text, not that of their float64 widening
+        self.assertTrue(curr_obs.values.dtype == 'float32')
+        self.assertTrue(ObLo.encode_result_values(curr_obs) ==
+                        "2017-09-27T09:04:00,22.5#2017-09-27T09:08:00,23.0#2017-09-27T09:00:00,21.9")
+
+    def test_journal_rows(self):
+        curr_obs = ObLo.ObservationArrays.from_frame(pd.DataFrame({'datetime': ['2017-09-27T09:00:00'] * 3,
+                                                                   'value': [1.0, 2.0, 3.0]}, index=[4, 5, 6]))
+        session = FakeSosSession()
+        journal = MagicMock()
+        ObLo.save_observations(curr_obs, "http://test.template", "http://127.0.0.1/service", 2, session,
+                               journal=journal)
+        self.assertTrue([call.args for call in journal.commit.call_args_list] == [(4, 6), (6, 7)])
+
+
+class TestColumnarInput(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+
+        # Out of order, with a duplicate timestamp, and a value a CSV file could only hold as text
+        self.curr_obs = pd.DataFrame({'datetime': pd.to_datetime(['2017-09-27T09:04:00', '2017-09-27T09:00:00',
+                                                                  '2017-09-27T09:04:00', '2017-09-27T09:08:00']),
+                                      'value': [22.9, 22.2, 22.5, 0.1 + 0.2]})
+        self.template_metadata = {'feature_identifier': 'test-feature',
+                                  'feature_name': 'test-feature-name',
+                                  'feature_lat': 22,
+                                  'feature_lon': 22,
+                                  'result_name': 'test-result-name',
+                                  'result_definition': 'test-result-definition',
+                                  'result_unit': 'm'}
+
+    def write(self, name, curr_obs=None):
+        import pyarrow
+        import pyarrow.feather
+        import pyarrow.parquet
+
+        path = os.path.join(self.folder.name, name)
+        table = pyarrow.Table.from_pandas(self.curr_obs if curr_obs is None else curr_obs, preserve_index=False)
+        if name.endswith('.parquet'):
+            pyarrow.parquet.write_table(table, path)
+        elif name.endswith('.feather'):
+            pyarrow.feather.write_feather(table, path)
+        else:
+            with pyarrow.ipc.new_file(path, table.schema) as writer:
+                writer.write_table(table, max_chunksize=2)
+        return path
+
+    def sent(self, observations, **options):
+        session = FakeSosSession()
+        result = ObLo.prepare_observations(observations, 'test-procedure', 'test-property', 'test-offering',
+                                           self.template_metadata, 'http://127.0.0.1/service', session, **options)
+        self.assertTrue(result is ObLo.ResultTypes.OBSERVATIONS_OK)
+        return '#'.join(request['resultValues'] for request in session.requests if request['request'] == 'InsertResult')
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), 'needs pyarrow')
+    def test_formats(self):
+        expected = "2017-09-27T09:00:00,22.2#2017-09-27T09:04:00,22.5#2017-09-27T09:08:00,0.30000000000000004"
+        for name in ('series.parquet', 'series.feather', 'series.arrow'):
+            path = self.write(name)
+            self.assertTrue(self.sent(path) == expected)
+
+            # Read in blocks, duplicates further apart than a block are left to the SOS as they are for a CSV file,
+            #  unless the whole file's timestamps are read first
+            self.assertTrue(self.sent(path, block_size=2) == "2017-09-27T09:04:00,22.9#2017-09-27T09:00:00,22.2#"
+                                                            "2017-09-27T09:04:00,22.5#2017-09-27T09:08:00,"
+                                                            "0.30000000000000004")
+            self.assertTrue(self.sent(path, block_size=2, keep_last=True) == expected)
+
+            # The rows are the positions in the file, as for a CSV file
+            curr_obs = ObLo.read_observation_arrays(path)
+            self.assertTrue(curr_obs.rows.tolist() == [1, 2, 3])
+            self.assertTrue(ObLo.read_observations(path)['value'].tolist() == [22.2, 22.5, 0.1 + 0.2])
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), 'needs pyarrow')
+    def test_column_types(self):
+        # Time zones are taken as UTC, integer values are widened, and a missing value is kept as NaN
+        path = self.write('typed.parquet', pd.DataFrame({
+            'value': pd.array([1, None], dtype='Int32'),
+            'datetime': pd.to_datetime(['2017-09-27T11:00:00', '2017-09-27T11:01:00']).tz_localize('Europe/Berlin')}))
+        curr_obs = ObLo.read_observation_arrays(path)
+        self.assertTrue(curr_obs.datetimes.astype(str).tolist() == ['2017-09-27T09:00:00', '2017-09-27T09:01:00'])
+        self.assertTrue(curr_obs.values[0] == 1.0 and np.isnan(curr_obs.values[1]))
+
+        # Timestamps held as text are parsed as those of a CSV file are
+        path = self.write('text.parquet', pd.DataFrame({'datetime': ['2017-09-27T09:00:00', '27-09-2017 09:01'],
+                                                        'value': [1.0, 2.0]}))
+        with self.assertRaises(ObLo.ObservationParseError) as raised:
+            ObLo.read_observation_arrays(path)
+        self.assertTrue(raised.exception.rows == [3])
+
+        path = self.write('missing.arrow', pd.DataFrame({'datetime': pd.to_datetime(['2017-09-27T09:00:00', None]),
+                                                         'value': [1.0, 2.0]}))
+        with self.assertRaises(ObLo.ObservationParseError) as raised:
+            ObLo.read_observation_arrays(path)
+        self.assertTrue(raised.exception.rows == [3])
+
+        path = self.write('columns.feather', self.curr_obs.rename(columns={'value': 'reading'}))
+        self.assertTrue(ObLo.prepare_observations(path, 'test-procedure', 'test-property', 'test-offering',
+                                                  self.template_metadata, 'http://127.0.0.1/service',
+                                                  FakeSosSession()) is ObLo.ResultTypes.PARSE_FAILURE)
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), 'needs pyarrow')
+    def test_memory_mapped(self):
+        # The values of an Arrow file of one record batch are a view of the mapped file
+        path = os.path.join(self.folder.name, 'series.arrow')
+        import pyarrow
+        table = pyarrow.Table.from_pandas(self.curr_obs.iloc[1:], preserve_index=False)
+        with pyarrow.ipc.new_file(path, table.schema) as writer:
+            writer.write_table(table)
+        curr_obs = ObLo.read_observation_arrays(path)
+        self.assertTrue(not curr_obs.values.flags.owndata and not curr_obs.values.flags.writeable)
+
+    def test_pyarrow_missing(self):
+        with patch.dict('sys.modules', {'pyarrow': None}):
+            with self.assertRaises(ValueError):
+                ObLo.read_observation_arrays(os.path.join(self.folder.name, 'series.parquet'))
+
+
+class TestBatchLoading(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+
+        for name in ('a.csv', 'b.csv', 'c.csv'):
+            with open(os.path.join(self.folder.name, name), 'w') as observation_file:
+                observation_file.write("datetime,value\n2017-09-27T09:00:00,22.2\n2017-09-27T09:04:00,22.9\n")
+
+        self.template_metadata = {'feature_identifier': 'test-feature',
+                                  'feature_name': 'test-feature-name',
+                                  'feature_lat': 22,
+                                  'feature_lon': 22,
+                                  'result_name': 'test-result-name',
+                                  'result_definition': 'test-result-definition',
+                                  'result_unit': 'm'}
+
+    def write_json_manifest(self):
+        manifest = os.path.join(self.folder.name, 'manifest.json')
+        with open(manifest, 'w') as manifest_file:
+            json.dump([{'observations': name,
+                        'procedure': 'test-procedure',
+                        'obs_property': property_name,
+                        'offering': 'test-offering',
+                        'template_metadata': self.template_metadata}
+                       for name, property_name in (('a.csv', 'test-property-1'),
+                                                   ('b.csv', 'test-property-2'),
+                                                   ('c.csv', 'test-property-1'))], manifest_file)
+        return manifest
+
+    def test_json_manifest(self):
+        loads = ObLo.load_manifest(self.write_json_manifest())
+
+        self.assertTrue(len(loads) == 3)
+        self.assertTrue(loads[0]['observations'] == os.path.join(self.folder.name, 'a.csv'))
+        self.assertTrue(loads[1]['obs_property'] == 'test-property-2')
+        self.assertTrue(loads[2]['template_metadata'] == self.template_metadata)
+
+    def test_csv_manifest(self):
+        manifest = os.path.join(self.folder.name, 'manifest.csv')
+        pd.DataFrame([dict(observations='a.csv', procedure='test-procedure', obs_property='test-property',
+                           offering='test-offering', precision='2', rollups='daily monthly', incremental='timestamps',
+                           **self.template_metadata)]).to_csv(manifest, index=False)
+        loads = ObLo.load_manifest(manifest)
+
+        self.assertTrue(loads[0]['template_metadata']['feature_lat'] == 22.0)
+        self.assertTrue(loads[0]['template_metadata']['result_unit'] == 'm')
+        self.assertTrue(loads[0]['precision'] == 2)
+        self.assertTrue(loads[0]['rollups'] == ['daily', 'monthly'])
+        self.assertTrue(loads[0]['incremental'] is ObLo.IncrementalModes.TIMESTAMPS)
+
+        pd.DataFrame([{'observations': 'a.csv'}]).to_csv(manifest, index=False)
+        with self.assertRaises(ValueError):
+            ObLo.load_manifest(manifest)
+
+        # Unknown rollup periods are found before any file is loaded
+        pd.DataFrame([dict(observations='a.csv', procedure='test-procedure', obs_property='test-property',
+                           offering='test-offering', rollups='daily weekly',
+                           **self.template_metadata)]).to_csv(manifest, index=False)
+        with self.assertRaises(ValueError):
+            ObLo.load_manifest(manifest)
+
+    def test_batch_unknown_rollups(self):
+        # A load given an unknown rollup period fails alone, rather than stopping the batch
+        loads = ObLo.load_manifest(self.write_json_manifest())
+        loads[1]['rollups'] = ['weekly']
+        summary = ObLo.run_batch(loads, 'http://127.0.0.1/service', workers=2, session=FakeSosSession())
+
+        self.assertTrue([result for _, result in summary] == [ObLo.ResultTypes.OBSERVATIONS_OK,
+                                                              ObLo.ResultTypes.PARSE_FAILURE,
+                                                              ObLo.ResultTypes.OBSERVATIONS_OK])
+
+    def test_batch_shares_templates(self):
+        session = FakeSosSession()
+        summary = ObLo.run_batch(ObLo.load_manifest(self.write_json_manifest()), 'http://127.0.0.1/service',
+                                 workers=2, session=session)
+
+        self.assertTrue([result for _, result in summary] == [ObLo.ResultTypes.OBSERVATIONS_OK] * 3)
+        # The two files of the same series share one template lookup
+        self.assertTrue(sum(request['request'] == 'GetResultTemplate' for request in session.requests) == 2)
+        self.assertTrue(sum(request['request'] == 'InsertResult' for request in session.requests) == 3)
+
+    def test_missing_parameters(self):
+        self.assertTrue(ObLo.main(['test-data.csv']) is ObLo.ResultTypes.MISSING_PARAMETERS)
+
+    def test_incremental_options(self):
+        manifest = os.path.join(self.folder.name, 'manifest.json')
+        with open(manifest, 'w') as manifest_file:
+            json.dump([{'observations': 'a.csv', 'procedure': 'test-procedure', 'obs_property': 'test-property',
+                        'offering': 'test-offering', 'template_metadata': self.template_metadata,
+                        'incremental': 'range'}], manifest_file)
+        self.assertTrue(ObLo.load_manifest(manifest)[0]['incremental'] is ObLo.IncrementalModes.RANGE)
+
+        # The command line mode is given to every file, unless its manifest entry names its own
+        with patch.object(ObLo, 'run_batch', return_value=[]) as run_batch:
+            ObLo.main(['--manifest', manifest, '--endpoint', 'http://127.0.0.1/service', '--incremental',
+                       'timestamps', '--no-journal'])
+        self.assertTrue(run_batch.call_args[1]['incremental'] is ObLo.IncrementalModes.TIMESTAMPS)
+
+        with open(manifest, 'w') as manifest_file:
+            json.dump([{'observations': 'a.csv', 'procedure': 'test-procedure', 'obs_property': 'test-property',
+                        'offering': 'test-offering', 'template_metadata': self.template_metadata,
+                        'incremental': 'everything'}], manifest_file)
+        with self.assertRaises(ValueError):
+            ObLo.load_manifest(manifest)
+
+    def test_block_size_option(self):
+        manifest = os.path.join(self.folder.name, 'manifest.json')
+        with open(manifest, 'w') as manifest_file:
+            json.dump([{'observations': 'a.csv', 'procedure': 'test-procedure', 'obs_property': 'test-property',
+                        'offering': 'test-offering', 'template_metadata': self.template_metadata}], manifest_file)
+        arguments = ['--manifest', manifest, '--endpoint', 'http://127.0.0.1/service', '--block-size', '1000']
+
+        with patch.object(ObLo, 'run_batch', return_value=[]) as run_batch:
+            ObLo.main(arguments + ['--no-journal'])
+        self.assertTrue(run_batch.call_args[1]['block_size'] == 1000)
+
+        with patch.object(ObLo, 'follow_observations', return_value=ObLo.ResultTypes.OBSERVATIONS_OK) as follow:
+            ObLo.main(arguments + ['--follow'])
+        self.assertTrue(follow.call_args[1]['block_size'] == 1000)
+
+    def test_max_in_flight_option(self):
+        manifest = os.path.join(self.folder.name, 'manifest.json')
+        with open(manifest, 'w') as manifest_file:
+            json.dump([{'observations': 'a.csv', 'procedure': 'test-procedure', 'obs_property': 'test-property',
+                        'offering': 'test-offering', 'template_metadata': self.template_metadata}], manifest_file)
+
+        # The session holds enough connections for every worker to have its chunks in flight
+        with patch.object(ObLo, 'run_batch', return_value=[]) as run_batch:
+            ObLo.main(['--manifest', manifest, '--endpoint', 'http://127.0.0.1/service', '--workers', '3',
+                       '--max-in-flight', '8', '--no-journal'])
+        self.assertTrue(run_batch.call_args[1]['max_in_flight'] == 8)
+        self.assertTrue(run_batch.call_args[0][3].pool_size == 24)
+
+
+class TestProcessLoading(unittest.TestCase):
+    def setUp(self):
+        self.template_metadata = {'feature_identifier': 'test-feature',
+                                  'feature_name': 'test-feature-name',
+                                  'feature_lat': 22,
+                                  'feature_lon': 22,
+                                  'result_name': 'test-result-name',
+                                  'result_definition': 'test-result-definition',
+                                  'result_unit': 'm'}
+
+    def test_governed_processes(self):
+        loads = [{'observations': 'test-data.csv',
+                  'procedure': 'test-procedure',
+                  'obs_property': 'test-property',
+                  'offering': 'test-offering-{}'.format(number),
+                  'template_metadata': self.template_metadata}
+                 for number in range(3)] + [{'observations': 'missing.csv',
+                                             'procedure': 'test-procedure',
+                                             'obs_property': 'test-property',
+                                             'offering': 'test-offering-0',
+                                             'template_metadata': self.template_metadata}]
+
+        with StandInSos.StandInSos(latency=0.01) as stand_in:
+            session = ObLo.SosSession(retry_policy=ObLo.RetryPolicy(backoff=0.001))
+            with session:
+                summary = ObLo.run_processes(loads, stand_in.endpoint, processes=3, max_requests=2, session=session,
+                                             max_in_flight=4)
+
+        self.assertTrue([result for _, result in summary] == [ObLo.ResultTypes.OBSERVATIONS_OK] * 3 +
+                        [ObLo.ResultTypes.PARSE_FAILURE])
+        # Every template is created before the files are loaded, and the processes never exceed the governor
+        self.assertTrue(stand_in.statistics['requests']['InsertResultTemplate'] == 3)
+        self.assertTrue(stand_in.statistics['max_in_flight'] <= 2)
+        self.assertTrue(stand_in.statistics['rows_inserted'] == 12000)
+
+        # The metrics of every process are merged into those of the session
+        metrics = session.metrics.summary()
+        self.assertTrue(metrics['counters']['rows_inserted'] == 12000)
+        self.assertTrue(metrics['requests']['InsertResult']['count'] ==
+                        stand_in.statistics['requests']['InsertResult'])
+        self.assertTrue('governor' in metrics['phases'])
+
+    @unittest.skipUnless(os.path.exists('../postgresql-node/sos-4-4-1/settings.sql'), 'needs the postgresql-node')
+    def test_default_governor(self):
+        with open('../postgresql-node/sos-4-4-1/settings.sql') as settings:
+            max_connections = re.search(r'max_connections\s*=\s*(\d+)', settings.read()).group(1)
+        self.assertTrue(ObLo.DEFAULT_GLOBAL_IN_FLIGHT == int(max_connections))
+
+    def test_snapshots(self):
+        first, second = ObLo.LoaderMetrics(), ObLo.LoaderMetrics()
+        for metrics, seconds in ((first, 0.002), (second, 0.7)):
+            metrics.observe_request('InsertResult', seconds)
+            metrics.count('rows_inserted', 10)
+            with metrics.phase('send'):
+                pass
+        first.merge(second.snapshot())
+
+        summary = first.summary()
+        self.assertTrue(summary['counters']['rows_inserted'] == 20)
+        self.assertTrue(summary['phases']['send']['count'] == 2)
+        self.assertTrue(summary['requests']['InsertResult']['buckets']['0.005'] == 1)
+        self.assertTrue(summary['requests']['InsertResult']['buckets']['1.0'] == 2)
+
+        templates = ObLo.TemplateRegistry()
+        templates.merge(({('http://127.0.0.1/service', 'test-property', 'test-offering'):
+                          ('test-template', dict(ObLo.DEFAULT_RESULT_ENCODING), time.time())}, set()))
+        self.assertTrue(templates.resolve('test-procedure', 'test-property', 'test-offering', {},
+                                          'http://127.0.0.1/service', FakeSosSession())[0] == 'test-template')
+
+        # An adaptive chunk size is copied to each process without its lock
+        chunk_size = pickle.loads(pickle.dumps(ObLo.AdaptiveChunkSize(seed=300)))
+        chunk_size.record(300, 100.0, 3000)
+        self.assertTrue(chunk_size.next_size() == 150)
+
+
+class TestTemplateRegistry(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        self.cache_path = os.path.join(self.folder.name, 'templates.json')
+
+    def respond(self, request):
+        if request['request'] == 'GetResultTemplate' and request['observedProperty'] == 'missing-property':
+            return {"exceptions": [{"code": "InvalidPropertyOfferingCombination"}]}
+        if request['request'] == 'InsertResultTemplate':
+            return {"acceptedTemplate": request['identifier']}
+        return {"resultEncoding": {"tokenSeparator": "#", "blockSeparator": "@"}}
+
+    def test_cache_file(self):
+        session = FakeSosSession(self.respond)
+        templates = ObLo.TemplateRegistry(self.cache_path)
+        self.assertTrue(templates.resolve('test-procedure', 'test-property', 'test-offering', {},
+                                          'http://127.0.0.1/service', session) ==
+                        ('test-property-test-offering', {"tokenSeparator": "#", "blockSeparator": "@"}, False))
+        self.assertTrue((templates.hits, templates.misses) == (0, 1))
+
+        # A new registry reading the same cache file needs no requests at all
+        session = FakeSosSession(self.respond)
+        templates = ObLo.TemplateRegistry(self.cache_path)
+        template_id, result_encoding, created = templates.resolve('test-procedure', 'test-property', 'test-offering',
+                                                                  {}, 'http://127.0.0.1/service', session)
+        self.assertTrue(template_id == 'test-property-test-offering')
+        self.assertTrue(result_encoding['blockSeparator'] == '@')
+        self.assertTrue(len(session.requests) == 0)
+        self.assertTrue((templates.hits, templates.misses) == (1, 0))
+
+    def test_unreadable_cache_file(self):
+        # A truncated cache file, or one missing a key, is ignored and the templates are looked up again
+        for contents in ('[{"endpoint": "http://127.0.0.1/service", "obs_property"',
+                         '[{"endpoint": "http://127.0.0.1/service", "obs_property": "test-property"}]'):
+            with open(self.cache_path, 'w') as cache_file:
+                cache_file.write(contents)
+            session = FakeSosSession(self.respond)
+            with self.assertLogs(level='WARNING'):
+                templates = ObLo.TemplateRegistry(self.cache_path)
+            self.assertTrue(templates.resolve('test-procedure', 'test-property', 'test-offering', {},
+                                              'http://127.0.0.1/service', session)[0] == 'test-property-test-offering')
+            self.assertTrue(len(session.requests) == 1)
+
+    def test_expiry_and_invalidation(self):
+        session = FakeSosSession(self.respond)
+        ObLo.TemplateRegistry(self.cache_path).resolve('test-procedure', 'test-property', 'test-offering', {},
+                                                       'http://127.0.0.1/service', session)
+
+        # Expired templates are looked up again
+        templates = ObLo.TemplateRegistry(self.cache_path, max_age=-1)
+        templates.resolve('test-procedure', 'test-property', 'test-offering', {}, 'http://127.0.0.1/service', session)
+        self.assertTrue(len(session.requests) == 2)
+
+        templates = ObLo.TemplateRegistry(self.cache_path)
+        templates.invalidate(obs_property='test-property')
+        self.assertTrue(ObLo.TemplateRegistry(self.cache_path).resolve(
+            'test-procedure', 'test-property', 'test-offering', {}, 'http://127.0.0.1/service', session)[0] ==
+                        'test-property-test-offering')
+        self.assertTrue(len(session.requests) == 3)
+
+    def test_prefill(self):
+        session = FakeSosSession(self.respond)
+        templates = ObLo.TemplateRegistry()
+        templates.prefill([('test-property', 'test-offering'), ('missing-property', 'test-offering')],
+                          'http://127.0.0.1/service', session)
+        self.assertTrue(len(session.requests) == 2)
+
+        # The found template is used without a request, the missing one is created without being looked up again
+        templates.resolve('test-procedure', 'test-property', 'test-offering', {}, 'http://127.0.0.1/service', session)
+        template_id, _, created = templates.resolve('test-procedure', 'missing-property', 'test-offering',
+                                                    {'feature_identifier': 'f', 'feature_name': 'f',
+                                                     'feature_lat': 1, 'feature_lon': 1, 'result_name': 'r',
+                                                     'result_definition': 'r', 'result_unit': 'm'},
+                                                    'http://127.0.0.1/service', session)
+        self.assertTrue(created)
+        self.assertTrue([request['request'] for request in session.requests[2:]] == ['InsertResultTemplate'])
+
+
+class TestAdaptiveChunkSize(unittest.TestCase):
+    def test_size_follows_latency(self):
+        chunk_size = ObLo.AdaptiveChunkSize(seed=100, minimum=10, maximum=1000, target_latency=1.0)
+
+        # A fast response at most doubles the size
+        chunk_size.record(100, 0.01, 2000)
+        self.assertTrue(chunk_size.next_size() == 200)
+
+        # Slow responses shrink it, by at most half at a time
+        for _ in range(10):
+            chunk_size.record(chunk_size.size, 10.0, 2000)
+        self.assertTrue(chunk_size.next_size() == 10)
+
+        chunk_size = ObLo.AdaptiveChunkSize(seed=100, minimum=10, maximum=150, target_latency=1.0)
+        chunk_size.record(100, 0.01, 2000)
+        self.assertTrue(chunk_size.next_size() == 150)
+        chunk_size.record(150, 0.01, 2000, failed=True)
+        self.assertTrue(chunk_size.next_size() == 75)
+
+    def test_payload_limit(self):
+        chunk_size = ObLo.AdaptiveChunkSize(seed=100, minimum=10, maximum=1000, target_latency=1.0,
+                                            max_payload_bytes=3000)
+        chunk_size.record(100, 0.01, 2000)
+        self.assertTrue(chunk_size.next_size() == 150)
+
+    def test_adaptive_save(self):
+        test_dataset = pd.DataFrame([["2017-09-27T{:02d}:{:02d}:00".format(row // 60, row % 60), float(row)]
+                                     for row in range(1000)])
+        test_dataset.columns = ['datetime', 'value']
+        for max_in_flight in (1, 3):
+            chunk_size = ObLo.AdaptiveChunkSize(seed=20, minimum=10, maximum=400, target_latency=10.0)
+            session = FakeSosSession()
+            outcomes = ObLo.save_observations(test_dataset, "http://test.template", "http://127.0.0.1/service",
+                                              chunk_size, session, max_in_flight)
+
+            # Every observation is sent once, in chunks that grow towards the maximum
+            self.assertTrue(sum(outcome.inserted for outcome in outcomes) == 1000)
+            self.assertTrue(all(outcome.start == previous.stop for previous, outcome in zip(outcomes, outcomes[1:])))
+            self.assertTrue(outcomes[-2].stop - outcomes[-2].start > outcomes[0].stop - outcomes[0].start)
+
+    def test_retried_chunk_shrinks(self):
+        test_dataset = pd.DataFrame([["2017-09-27T09:{:02d}:00".format(row), float(row)] for row in range(40)])
+        test_dataset.columns = ['datetime', 'value']
+        answers = iter([(503, None)])
+
+        # The chunk is answered once sent again, and its size is halved as if it had failed
+        chunk_size = ObLo.AdaptiveChunkSize(seed=20, minimum=5, maximum=400, target_latency=10.0)
+        session = FakeSosSession(lambda request: next(answers, {"request": request['request']}))
+        outcomes = ObLo.save_observations(test_dataset, "http://test.template", "http://127.0.0.1/service",
+                                          chunk_size, session)
+
+        self.assertTrue(session.metrics.counters['retries'] == 1)
+        self.assertTrue(outcomes[0].stop - outcomes[0].start == 20)
+        self.assertTrue(outcomes[1].stop - outcomes[1].start == 10)
+
+
+class TestUploadJournal(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.observations = os.path.join(self.folder.name, 'series.csv')
+        with open(self.observations, 'w') as observation_file:
+            observation_file.write('datetime,value\n')
+            for minute in range(10):
+                observation_file.write('2017-09-27T09:{:02d}:00,{}.0\n'.format(minute, minute))
+
+        self.template_metadata = {'feature_identifier': 'test-feature',
+                                  'feature_name': 'test-feature-name',
+                                  'feature_lat': 22,
+                                  'feature_lon': 22,
+                                  'result_name': 'test-result-name',
+                                  'result_definition': 'test-result-definition',
+                                  'result_unit': 'm'}
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def load(self, session, resume):
+        return ObLo.prepare_observations(self.observations, 'test-procedure', 'test-property', 'test-offering',
+                                         self.template_metadata, 'http://127.0.0.1/service', session,
+                                         max_in_flight=1, chunk_size=3, journal=True, resume=resume)
+
+    @staticmethod
+    def sent_values(session):
+        return [value for request in session.requests if request['request'] == 'InsertResult'
+                for value in request['resultValues'].split('#')]
+
+    def test_resume_skips_sent_rows(self):
+        def drop_connection(request):
+            if request['request'] == 'InsertResult' and '09:06:00' in request['resultValues']:
+                raise ConnectionResetError()
+            return {"request": request['request']}
+
+        # The load fails at the third chunk, leaving a journal of the first two
+        result = self.load(FakeSosSession(drop_connection), resume=False)
+        self.assertTrue(result is ObLo.ResultTypes.ENDPOINT_FAILURE)
+        with open(self.observations + ObLo.JOURNAL_SUFFIX) as journal_file:
+            self.assertTrue(json.load(journal_file)['committed'] == [[0, 6]])
+
+        session = FakeSosSession()
+        result = self.load(session, resume=True)
+        self.assertTrue(result is ObLo.ResultTypes.OBSERVATIONS_OK)
+        self.assertTrue(self.sent_values(session) == ['2017-09-27T09:{:02d}:00,{}.0'.format(minute, minute)
+                                                      for minute in range(6, 10)])
+
+        # The journal is removed once the file has been sent
+        self.assertFalse(os.path.exists(self.observations + ObLo.JOURNAL_SUFFIX))
+
+    def test_changed_file_loaded_from_start(self):
+        journal = ObLo.UploadJournal(self.observations)
+        journal.commit(0, 6)
+        journal.flush()
+
+        with open(self.observations, 'a') as observation_file:
+            observation_file.write('2017-09-27T09:10:00,10.0\n')
+
+        session = FakeSosSession()
+        self.load(session, resume=True)
+        self.assertTrue(len(self.sent_values(session)) == 11)
+
+    def test_committed_ranges(self):
+        journal = ObLo.UploadJournal(self.observations, interval=60)
+        journal.commit(6, 9)
+        journal.commit(0, 3)
+        self.assertFalse(os.path.exists(journal.path))
+
+        curr_obs = ObLo.read_observations(self.observations)
+        self.assertTrue(journal.remove_committed(curr_obs).index.tolist() == [3, 4, 5, 9])
+
+        journal.commit(3, 6)
+        journal.flush()
+        resumed = ObLo.UploadJournal(self.observations, resume=True)
+        self.assertTrue(resumed.committed_rows == 9)
+        self.assertTrue(resumed.remove_committed(curr_obs).index.tolist() == [9])
+
+    def test_unwritable_journal(self):
+        # A full disk stops the journal being written, with a warning rather than an error
+        journal = ObLo.UploadJournal(self.observations, interval=0)
+        with patch.object(ObLo, '_write_atomically', side_effect=OSError(28, 'No space left on device')) as write:
+            with self.assertLogs(level='WARNING'):
+                journal.commit(0, 3)
+            journal.commit(3, 6)
+            journal.flush()
+        self.assertTrue(write.call_count == 1)
+        self.assertTrue(journal.committed_rows == 6)
+
+        # An unreadable journal is ignored, and the file loaded from the start
+        with open(self.observations + ObLo.JOURNAL_SUFFIX, 'w') as journal_file:
+            journal_file.write('{"source_hash": ')
+        session = FakeSosSession()
+        self.assertTrue(self.load(session, resume=True) is ObLo.ResultTypes.OBSERVATIONS_OK)
+        self.assertTrue(len(self.sent_values(session)) == 10)
+
+
+class TestFollowing(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        self.observations = os.path.join(self.folder.name, 'logger.csv')
+        self.load = {'observations': self.observations,
+                     'procedure': 'test-procedure',
+                     'obs_property': 'test-property',
+                     'offering': 'test-offering',
+                     'template_metadata': {}}
+
+    def append(self, text, path=None):
+        with open(path or self.observations, 'a') as observation_file:
+            observation_file.write(text)
+
+    def sent_times(self, session):
+        return [block.split(',')[0] for request in session.requests if request['request'] == 'InsertResult'
+                for block in request['resultValues'].split('#')]
+
+    def test_appended_rows(self):
+        session = FakeSosSession()
+        self.append('datetime,value\n2017-09-27T09:00:00,1.0\n2017-09-27T09:01:00,2.0\n')
+        ObLo.follow_observations([self.load], 'http://127.0.0.1/service', session, polls=1)
+        self.assertTrue(self.sent_times(session) == ['2017-09-27T09:00:00', '2017-09-27T09:01:00'])
+
+        # A line still being written is left until it is complete, and a new follower carries on from the state
+        self.append('2017-09-27T09:02:00,3.0\n2017-09-27T09:03')
+        templates = ObLo.TemplateRegistry()
+        ObLo.follow_observations([self.load], 'http://127.0.0.1/service', session, templates, polls=1)
+        self.append(':00,4.0\n2017-09-27T09:03:30,bad\n2017-09-27T09:04:00,5.0\n')
+        ObLo.follow_observations([self.load], 'http://127.0.0.1/service', session, templates, polls=1)
+        ObLo.follow_observations([self.load], 'http://127.0.0.1/service', session, templates, polls=1)
+
+        self.assertTrue(self.sent_times(session)[2:] == ['2017-09-27T09:02:00', '2017-09-27T09:03:00',
+                                                         '2017-09-27T09:04:00'])
+        self.assertTrue(sum(request['request'] == 'GetResultTemplate' for request in session.requests) == 2)
+        self.assertTrue(session.metrics.counters['rows_unparseable'] == 1)
+
+    def test_unreachable_sos(self):
+        self.append('datetime,value\n2017-09-27T09:00:00,1.0\n')
+        session = FakeSosSession(lambda request: (503, None), retry_policy=ObLo.RetryPolicy(retries=0))
+        ObLo.follow_observations([self.load], 'http://127.0.0.1/service', session, polls=1)
+
+        # The rows are sent again once the SOS answers
+        session = FakeSosSession()
+        ObLo.follow_observations([self.load], 'http://127.0.0.1/service', session, polls=1)
+        self.assertTrue(self.sent_times(session) == ['2017-09-27T09:00:00'])
+
+    def test_block_size(self):
+        # Each poll reads at most block_size rows, the rest are read by the next
+        self.append('datetime,value\n2017-09-27T09:00:00,1.0\n2017-09-27T09:01:00,2.0\n2017-09-27T09:02:00,3.0\n')
+        session = FakeSosSession()
+        ObLo.follow_observations([self.load], 'http://127.0.0.1/service', session, polls=1, block_size=2)
+        self.assertTrue(self.sent_times(session) == ['2017-09-27T09:00:00', '2017-09-27T09:01:00'])
+
+        ObLo.follow_observations([self.load], 'http://127.0.0.1/service', session, polls=1, block_size=2)
+        self.assertTrue(self.sent_times(session)[2:] == ['2017-09-27T09:02:00'])
+
+    def test_rotation_and_truncation(self):
+        self.append('datetime,value\n2017-09-27T09:00:00,1.0\n')
+        followed = ObLo.FollowedFile(self.observations)
+        self.assertTrue(followed.read_appended() == 'datetime,value\n2017-09-27T09:00:00,1.0\n')
+        followed.commit(60)
+
+        # The rest of a rotated file is read before the new file at the path
+        self.append('2017-09-27T09:01:00,2.0\n')
+        os.rename(self.observations, self.observations + '.1')
+        self.append('datetime,value\n2017-09-27T09:02:00,3.0\n')
+        self.assertTrue(followed.read_appended() == 'datetime,value\n2017-09-27T09:01:00,2.0\n')
+        followed.commit()
+        self.assertTrue(followed.read_appended() == 'datetime,value\n2017-09-27T09:02:00,3.0\n')
+        followed.commit()
+        self.assertTrue(followed.read_appended() is None)
+
+        # A truncated file is read again from its header
+        with open(self.observations, 'w') as observation_file:
+            observation_file.write('datetime,value\n')
+        self.assertTrue(followed.read_appended() is None)
+        self.append('2017-09-27T09:03:00,4.0\n')
+        self.assertTrue(followed.read_appended() == 'datetime,value\n2017-09-27T09:03:00,4.0\n')
+        followed.close()
+
+    def test_rows_already_sent(self):
+        # A new file repeating rows sent from the file it replaced only has its later rows sent
+        self.append('datetime,value\n2017-09-27T09:00:00,1.0\n2017-09-27T09:01:00,2.0\n')
+        session = FakeSosSession()
+        ObLo.follow_observations([self.load], 'http://127.0.0.1/service', session, polls=1)
+        os.remove(self.observations)
+        self.append('datetime,value\n2017-09-27T09:01:00,2.0\n2017-09-27T09:02:00,3.0\n')
+        ObLo.follow_observations([self.load], 'http://127.0.0.1/service', session, polls=1)
+
+        self.assertTrue(self.sent_times(session) == ['2017-09-27T09:00:00', '2017-09-27T09:01:00',
+                                                     '2017-09-27T09:02:00'])
+        self.assertTrue(session.metrics.counters['rows_skipped'] == 1)
+
+
+class TestFailureHandling(unittest.TestCase):
+    def setUp(self):
+        self.test_dataset = pd.DataFrame([["2017-09-27T09:{:02d}:00".format(minute), float(minute)]
+                                          for minute in range(8)])
+        self.test_dataset.columns = ['datetime', 'value']
+
+    def test_classification(self):
+        invalid_template = {"exceptions": [{"code": "InvalidParameterValue", "locator": "templateIdentifier",
+                                            "text": "The requested template identifier is not supported!"}]}
+        no_connection = {"exceptions": [{"code": "NoApplicableCode",
+                                         "text": "FATAL: sorry, too many clients already"}]}
+        # The same message starts the report of any database error, not only of a duplicate
+        lost_connection = {"exceptions": [{"code": "NoApplicableCode",
+                                           "text": "Insert result into database failed! Connection timed out"}]}
+        null_value = {"exceptions": [{"code": "NoApplicableCode",
+                                      "text": "Insert result into database failed! ERROR: null value in column "
+                                              "\"featureofinterestid\" violates not-null constraint"}]}
+
+        self.assertTrue(ObLo.classify_failure(200, {"request": "InsertResult"}) is None)
+        self.assertTrue(ObLo.classify_failure(400, DUPLICATE_REPLY) is ObLo.FailureTypes.DUPLICATE)
+        self.assertTrue(ObLo.classify_failure(200, DUPLICATE_REPLY) is ObLo.FailureTypes.DUPLICATE)
+        self.assertTrue(ObLo.classify_failure(500, no_connection) is ObLo.FailureTypes.TRANSIENT)
+        self.assertTrue(ObLo.classify_failure(500, lost_connection) is ObLo.FailureTypes.TRANSIENT)
+        self.assertTrue(ObLo.classify_failure(400, null_value) is ObLo.FailureTypes.FATAL)
+        self.assertTrue(ObLo.classify_failure(503, None) is ObLo.FailureTypes.TRANSIENT)
+        self.assertTrue(ObLo.classify_failure(400, invalid_template) is ObLo.FailureTypes.FATAL)
+        self.assertTrue(ObLo.classify_failure(404, None) is ObLo.FailureTypes.FATAL)
+        self.assertTrue(ObLo.classify_failure(200, None) is ObLo.FailureTypes.FATAL)
+
+    def test_transient_retried(self):
+        failures = iter([(503, None), (502, None)])
+        session = FakeSosSession(lambda request: next(failures, {"request": "InsertResult"}))
+
+        outcomes = ObLo.save_observations(self.test_dataset, "http://test.template", "http://127.0.0.1/service", 8,
+                                          session)
+
+        # The chunk is sent again, rather than split as if it held duplicates
+        self.assertTrue(outcomes == [ObLo.ChunkOutcome(0, 8, 8, 0, 1)])
+        self.assertTrue(len(session.requests) == 3)
+        self.assertTrue(all(request['resultValues'].count('#') == 7 for request in session.requests))
+        self.assertTrue(session.retry_policy.retried == 2)
+
+    def test_fatal_not_bisected(self):
+        session = FakeSosSession(lambda request: (400, {"exceptions": [{"code": "InvalidParameterValue",
+                                                                        "locator": "templateIdentifier"}]}))
+        with self.assertRaises(ObLo.SosRequestError) as raised:
+            ObLo.save_observations(self.test_dataset, "http://test.template", "http://127.0.0.1/service", 8, session)
+
+        self.assertTrue(raised.exception.failure is ObLo.FailureTypes.FATAL)
+        self.assertTrue(len(session.requests) == 1)
+
+    def test_circuit_breaker(self):
+        def drop_connection(request):
+            raise ConnectionResetError()
+
+        retry_policy = ObLo.RetryPolicy(retries=1, backoff=0, breaker_threshold=3, breaker_reset=60)
+        session = FakeSosSession(drop_connection, retry_policy=retry_policy)
+        for _ in range(3):
+            with self.assertRaises(ObLo.SosRequestError):
+                ObLo.request_json({"request": "GetResultTemplate"}, "http://127.0.0.1/service", session)
+
+        # The breaker opened on the third failure, after which nothing more was sent
+        self.assertTrue(len(session.requests) == 3)
+        self.assertTrue(retry_policy.breaker_trips == 1)
+
+        # A load against the endpoint stops without sending anything
+        result = ObLo.prepare_observations(io.StringIO("datetime,value\n2017-09-27T09:00:00,1.0\n"), 'procedure',
+                                           'property', 'offering', {}, "http://127.0.0.1/service", session)
+        self.assertTrue(result is ObLo.ResultTypes.ENDPOINT_FAILURE)
+        self.assertTrue(len(session.requests) == 3)
+
+
+class TestLoaderMetrics(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+
+    def test_load_metrics(self):
+        test_csv = "datetime,value\n" + "".join("2017-09-27T09:{:02d}:00,{}.0\n".format(minute, minute)
+                                                  for minute in [0, 1, 2, 2, 3, 4, 5, 6, 7])
+        session = FakeSosSession(lambda request: DUPLICATE_REPLY if '09:05:00' in request.get('resultValues', '')
+                                 else {"request": request['request']})
+        result = ObLo.prepare_observations(io.StringIO(test_csv), 'test-procedure', 'test-property', 'test-offering',
+                                           {}, 'http://127.0.0.1/service', session, max_in_flight=1, chunk_size=4)
+        self.assertTrue(result is ObLo.ResultTypes.OBSERVATIONS_OK)
+
+        summary = session.metrics.summary()
+        self.assertTrue({'template', 'read', 'parse', 'deduplicate', 'send', 'encode'} <= set(summary['phases']))
+        self.assertTrue(summary['counters']['rows_read'] == 9)
+        self.assertTrue(summary['counters']['duplicates_dropped'] == 1)
+        self.assertTrue(summary['counters']['rows_inserted'] == 7)
+        self.assertTrue(summary['counters']['rows_rejected'] == 1)
+        self.assertTrue(summary['counters']['chunks'] == 2)
+        self.assertTrue(summary['counters']['bisected_chunks'] == 1)
+        self.assertTrue(summary['counters']['bytes_sent'] > 0)
+
+        insert_requests = [request for request in session.requests if request['request'] == 'InsertResult']
+        self.assertTrue(summary['requests']['InsertResult']['count'] == len(insert_requests))
+        self.assertTrue(summary['counters']['bisection_requests'] == len(insert_requests) - 2)
+
+        json_path = os.path.join(self.folder.name, 'metrics.json')
+        session.metrics.write_json(json_path)
+        with open(json_path) as json_file:
+            self.assertTrue(json.load(json_file)['counters'] == summary['counters'])
+
+    def test_prometheus_textfile(self):
+        metrics = ObLo.LoaderMetrics()
+        for seconds in (0.002, 0.03, 0.03, 0.7, 120):
+            metrics.observe_request('InsertResult', seconds)
+        metrics.count('retries', 2)
+        with metrics.phase('parse'):
+            pass
+
+        path = os.path.join(self.folder.name, 'loader.prom')
+        metrics.write_prometheus(path)
+        with open(path) as prom_file:
+            samples = dict(line.rsplit(' ', 1) for line in prom_file.read().splitlines() if not line.startswith('#'))
+
+        buckets = [int(value) for name, value in samples.items() if name.startswith(
+            'sos_loader_request_duration_seconds_bucket{operation="InsertResult"')]
+        self.assertTrue(buckets == sorted(buckets))
+        bucket = 'sos_loader_request_duration_seconds_bucket{{operation="InsertResult",le="{}"}}'
+        self.assertTrue(samples[bucket.format('0.05')] == '3')
+        self.assertTrue(samples[bucket.format('+Inf')] == '5')
+        self.assertTrue(samples['sos_loader_request_duration_seconds_count{operation="InsertResult"}'] == '5')
+        self.assertTrue(samples['sos_loader_retries_total'] == '2')
+        self.assertTrue('sos_loader_phase_seconds_total{phase="parse"}' in samples)
+
+    def test_profile_and_memory(self):
+        self.addCleanup(tracemalloc.stop)
+        metrics = ObLo.LoaderMetrics(profile=['parse'], trace_memory=True)
+        with metrics.phase('parse'):
+            held = [str(number) for number in range(100000)]
+        with metrics.phase('encode'):
+            pass
+
+        metrics.write_profiles(self.folder.name)
+        self.assertTrue(os.listdir(self.folder.name) == ['parse.prof'])
+        self.assertTrue(metrics.memory_peaks['parse'] > len(held) * 50)
+        self.assertTrue(metrics.summary()['phases']['encode']['count'] == 1)
+
+
+class TestStandInSos(unittest.TestCase):
+    def setUp(self):
+        self.template_metadata = {'feature_identifier': 'test-feature',
+                                  'feature_name': 'test-feature-name',
+                                  'feature_lat': 22,
+                                  'feature_lon': 22,
+                                  'result_name': 'test-result-name',
+                                  'result_definition': 'test-result-definition',
+                                  'result_unit': 'm'}
+
+    def load(self, stand_in, session):
+        with session:
+            return ObLo.prepare_observations('test-data.csv', 'test-procedure', 'test-property', 'test-offering',
+                                             self.template_metadata, stand_in.endpoint, session)
+
+    def test_load_over_http(self):
+        # A real load through a SosSession, with observations rejected as stored and requests failing transiently
+        with StandInSos.StandInSos(duplicate_rate=0.005, error_rate=0.05) as stand_in:
+            session = ObLo.SosSession(retry_policy=ObLo.RetryPolicy(backoff=0.001))
+            result = self.load(stand_in, session)
+
+        self.assertTrue(result is ObLo.ResultTypes.OBSERVATIONS_OK)
+        counters = session.metrics.summary()['counters']
+        self.assertTrue(counters['rows_inserted'] == stand_in.statistics['rows_inserted'])
+        self.assertTrue(counters['rows_inserted'] + counters['rows_rejected'] == 4000)
+        self.assertTrue(counters['rows_rejected'] > 0)
+        self.assertTrue(counters['retries'] == stand_in.statistics['errors_injected'])
+        self.assertTrue(session.connections_opened <= session.pool_size)
+
+    def test_compressed_requests(self):
+        for content_encoding in ObLo.CONTENT_ENCODINGS:
+            with StandInSos.StandInSos() as stand_in:
+                session = ObLo.SosSession(compression=content_encoding)
+                result = self.load(stand_in, session)
+
+            self.assertTrue(result is ObLo.ResultTypes.OBSERVATIONS_OK)
+            self.assertTrue(stand_in.statistics['rows_inserted'] == 4000)
+            self.assertTrue(stand_in.statistics['compressed_requests'] == sum(stand_in.statistics['requests'].values()))
+            counters = session.metrics.summary()['counters']
+            self.assertTrue(counters['bytes_sent'] < counters['bytes_before_compression'] / 2)
+
+    def test_compression_refused(self):
+        with StandInSos.StandInSos(accept_compression=False) as stand_in:
+            session = ObLo.SosSession(compression={stand_in.endpoint: 'gzip'})
+            result = self.load(stand_in, session)
+
+        # Only the first request is sent compressed, and then again without
+        self.assertTrue(result is ObLo.ResultTypes.OBSERVATIONS_OK)
+        self.assertTrue(stand_in.statistics['rows_inserted'] == 4000)
+        self.assertTrue(stand_in.statistics['compression_refused'] == 1)
+        self.assertTrue(session.content_encoding(stand_in.endpoint) is None)
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.template_metadata = {'feature_identifier': 'test-feature',
+                                  'feature_name': 'test-feature-name',
+                                  'feature_lat': 22,
+                                  'feature_lon': 22,
+                                  'result_name': 'test-result-name',
+                                  'result_definition': 'test-result-definition',
+                                  'result_unit': 'm'}
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        self.stand_in = StandInSos.StandInSos(latency=0.01)
+        self.stand_in.__enter__()
+        self.addCleanup(self.stand_in.__exit__, None, None, None)
+        ObLo.prepare_observations('test-data.csv', 'test-procedure', 'test-property', 'test-offering',
+                                  self.template_metadata, self.stand_in.endpoint, max_in_flight=1)
+        self.expected = ObLo.remove_duplicate_observations(ObLo.read_observation_arrays('test-data.csv'), sort=True)
+
+    def export(self, output, offering='test-offering', **options):
+        path = os.path.join(self.folder.name, output)
+        return ObservationExporter.export_observations('test-procedure', 'test-property', offering,
+                                                       self.stand_in.endpoint, path, **options), path
+
+    def test_export_csv(self):
+        result, path = self.export('export.csv', window='30D', max_in_flight=3)
+
+        self.assertTrue(result is ObLo.ResultTypes.OBSERVATIONS_OK)
+        with open(path) as exported:
+            self.assertTrue(exported.read() == 'datetime,value\n' +
+                            ObLo.encode_result_values(self.expected, ',', '\n') + '\n')
+        # The series spans 166 days, fetched as six windows, no more than three at once
+        self.assertTrue(self.stand_in.statistics['requests']['GetResult'] == 6)
+        self.assertTrue(self.stand_in.statistics['max_in_flight'] <= 3)
+        self.assertTrue(os.listdir(self.folder.name) == ['export.csv'])
+
+    def test_export_range(self):
+        result, path = self.export('export.csv', start='2017-02-01', end='2017-02-02T00:00:00+01:00', window='6h')
+
+        self.assertTrue(result is ObLo.ResultTypes.OBSERVATIONS_OK)
+        exported = ObLo.read_observation_arrays(path)
+        self.assertTrue(len(exported) == 24)
+        self.assertTrue(str(exported.datetimes[0]) == '2017-02-01T00:00:00')
+        self.assertTrue(str(exported.datetimes[-1]) == '2017-02-01T23:00:00')
+
+        # A range without observations exports only the header
+        result, path = self.export('empty.csv', start='2018-01-01', end='2018-02-01')
+        self.assertTrue(result is ObLo.ResultTypes.OBSERVATIONS_OK)
+        with open(path) as exported:
+            self.assertTrue(exported.read() == 'datetime,value\n')
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), 'needs pyarrow')
+    def test_export_columnar(self):
+        for output in ['export.parquet', 'export.arrow', 'export.arrows', 'export.feather']:
+            result, path = self.export(output, window='14D')
+
+            self.assertTrue(result is ObLo.ResultTypes.OBSERVATIONS_OK)
+            exported = ObLo.read_observation_arrays(path)
+            self.assertTrue(np.array_equal(exported.times, self.expected.times))
+            self.assertTrue(np.array_equal(exported.values, self.expected.values))
+
+    def test_export_failures(self):
+        result, path = self.export('export.csv', offering='missing-offering')
+        self.assertTrue(result is ObLo.ResultTypes.TEMPLATE_FAILURE)
+
+        with patch.object(ObservationExporter, 'fetch_window', side_effect=ObLo.SosRequestError('refused', None, 503)):
+            result, path = self.export('export.csv')
+        self.assertTrue(result is ObLo.ResultTypes.ENDPOINT_FAILURE)
+
+        result, path = self.export('export.csv', window='-1D')
+        self.assertTrue(result is ObLo.ResultTypes.PARSE_FAILURE)
+        self.assertTrue(os.listdir(self.folder.name) == [])
+
+    def test_time_windows(self):
+        windows = ObservationExporter.time_windows('2017-01-01', '2017-01-02T12:00:00', '1D')
+        self.assertTrue([(str(start), str(end)) for start, end in windows] ==
+                        [('2017-01-01 00:00:00', '2017-01-02 00:00:00'),
+                         ('2017-01-02 00:00:00', '2017-01-02 12:00:00')])
+        self.assertTrue(len(ObservationExporter.time_windows('2017-01-01', '2017-01-03', '1D')) == 2)
+        self.assertTrue(len(ObservationExporter.time_windows('2017-01-01', '2017-01-01', '1D')) == 1)
+
+
+class TestRollups(unittest.TestCase):
+    def setUp(self):
+        self.template_metadata = {'feature_identifier': 'test-feature',
+                                  'feature_name': 'test-feature-name',
+                                  'feature_lat': 22,
+                                  'feature_lon': 22,
+                                  'result_name': 'test-result-name',
+                                  'result_definition': 'test-result-definition',
+                                  'result_unit': 'm'}
+        with open('test-data.csv') as observation_file:
+            self.header, *self.rows = observation_file.read().splitlines()
+
+    def observations(self, rows):
+        return io.StringIO('\n'.join([self.header] + rows) + '\n')
+
+    def stored_rollups(self, stand_in, period, statistic):
+        stored = stand_in._templates['{}-test-offering'.format(ObLo.rollup_property('test-property', period,
+                                                                                    statistic))][1]
+        return [(curr_time, float(stored[curr_time])) for curr_time in sorted(stored)]
+
+    def expected_rollups(self, period, statistic, rows=None):
+        curr_obs = ObLo.read_observation_arrays(self.observations(self.rows if rows is None else rows))
+        # The last period is not yet complete, so it is not sent
+        rollup_obs = ObLo.compute_rollups(curr_obs, period)[statistic][:-1]
+        return list(zip(np.datetime_as_string(rollup_obs.datetimes).tolist(), rollup_obs.values.tolist()))
+
+    def test_compute_rollups(self):
+        curr_obs = pd.DataFrame({'datetime': ['2017-01-31T23:00:00', '2017-01-31T01:00:00', '2017-02-01T00:00:00',
+                                              '2017-01-31T12:00:00', '2017-02-01T06:00:00'],
+                                 'value': [4.0, 1.0, float('nan'), 2.5, float('nan')]})
+
+        daily = ObLo.compute_rollups(curr_obs, 'daily')
+        self.assertTrue(list(daily['mean'].datetimes.astype(str)) == ['2017-01-31T00:00:00', '2017-02-01T00:00:00'])
+        self.assertTrue(daily['mean'].values[0] == 2.5 and np.isnan(daily['mean'].values[1]))
+        self.assertTrue(list(daily['min'].values[:1]) == [1.0] and list(daily['max'].values[:1]) == [4.0])
+        self.assertTrue(list(daily['count'].values) == [3, 0])
+
+        monthly = ObLo.compute_rollups(curr_obs, 'monthly')
+        self.assertTrue(list(monthly['count'].datetimes.astype(str)) == ['2017-01-01T00:00:00',
+                                                                         '2017-02-01T00:00:00'])
+
+        # An unknown period, or a period given as a string rather than a list, fails the file as it is loaded
+        for rollups in (['weekly'], 'daily'):
+            self.assertTrue(ObLo.prepare_observations('test-data.csv', 'test-procedure', 'test-property',
+                                                      'test-offering', self.template_metadata,
+                                                      'http://127.0.0.1/service', FakeSosSession(), rollups=rollups)
+                            is ObLo.ResultTypes.PARSE_FAILURE)
+
+    def test_incremental_rollups(self):
+        # Loads overlapping the series already stored, the last in blocks, only recompute the periods they touch
+        with StandInSos.StandInSos() as stand_in:
+            session = ObLo.SosSession()
+            templates = ObLo.TemplateRegistry()
+            with session:
+                results = [ObLo.prepare_observations(self.observations(rows), 'test-procedure', 'test-property',
+                                                     'test-offering', self.template_metadata, stand_in.endpoint,
+                                                     session, templates=templates, rollups=['daily', 'monthly'],
+                                                     block_size=block_size)
+                           for rows, block_size in [(self.rows[:1000], None), (self.rows[1000:2500], None),
+                                                    (self.rows[2500:], 700)]]
+                get_results = stand_in.statistics['requests']['GetResult']
+
+        self.assertTrue(results == [ObLo.ResultTypes.OBSERVATIONS_OK] * 3)
+        for period in ObLo.ROLLUP_PERIODS:
+            for statistic in ObLo.ROLLUP_STATISTICS:
+                self.assertTrue(self.stored_rollups(stand_in, period, statistic) ==
+                                self.expected_rollups(period, statistic))
+        # The day and month left open by each load, and the days and month split between blocks, are fetched back,
+        #  the adjacent months in one request
+        self.assertTrue(get_results == 2 + 3 + 1)
+        counters = session.metrics.summary()['counters']
+        self.assertTrue(counters['rollup_periods'] == 166 + 5)
+        self.assertTrue(counters['rows_rejected'] == 0)
+        self.assertTrue(stand_in.statistics['requests']['InsertResultTemplate'] == 9)
+
+    def test_async_rollups(self):
+        async def load(endpoint):
+            async with AsyncObservationLoader.AsyncSosSession() as session:
+                templates = AsyncObservationLoader.AsyncTemplateRegistry()
+                return [await AsyncObservationLoader.prepare_observations(
+                    self.observations(rows), 'test-procedure', 'test-property', 'test-offering',
+                    self.template_metadata, endpoint, session, templates=templates, rollups=['daily'],
+                    incremental=ObLo.IncrementalModes.TIMESTAMPS) for rows in [self.rows[:2000], self.rows[1500:]]]
+
+        with StandInSos.StandInSos() as stand_in:
+            results = run_coroutine(load(stand_in.endpoint))
+
+        self.assertTrue(results == [ObLo.ResultTypes.OBSERVATIONS_OK] * 2)
+        for statistic in ObLo.ROLLUP_STATISTICS:
+            self.assertTrue(self.stored_rollups(stand_in, 'daily', statistic) ==
+                            self.expected_rollups('daily', statistic))
+
+
+class TestAsyncLoader(unittest.TestCase):
+    def setUp(self):
+        self.template_metadata = {'feature_identifier': 'test-feature',
+                                  'feature_name': 'test-feature-name',
+                                  'feature_lat': 22,
+                                  'feature_lon': 22,
+                                  'result_name': 'test-result-name',
+                                  'result_definition': 'test-result-definition',
+                                  'result_unit': 'm'}
+
+    def test_load_over_http(self):
+        async def load(endpoint):
+            async with AsyncObservationLoader.AsyncSosSession(retry_policy=ObLo.RetryPolicy(backoff=0.001)) as session:
+                result = await AsyncObservationLoader.prepare_observations(
+                    'test-data.csv', 'test-procedure', 'test-property', 'test-offering', self.template_metadata,
+                    endpoint, session)
+                # The template is found on a second load, and its observations are skipped as already stored
+                with open('test-data.csv') as observation_file:
+                    first_rows = ''.join(observation_file.readline() for _ in range(11))
+                again = await AsyncObservationLoader.prepare_observations(
+                    io.StringIO(first_rows), 'test-procedure', 'test-property', 'test-offering', self.template_metadata,
+                    endpoint, session, incremental=ObLo.IncrementalModes.TIMESTAMPS)
+                missing = await AsyncObservationLoader.prepare_observations(
+                    'missing.csv', 'test-procedure', 'test-property', 'test-offering', self.template_metadata,
+                    endpoint, session)
+            return (result, again, missing), session
+
+        with StandInSos.StandInSos(duplicate_rate=0.005, error_rate=0.05) as stand_in:
+            results, session = run_coroutine(load(stand_in.endpoint))
+
+        self.assertTrue(results == (ObLo.ResultTypes.OBSERVATIONS_OK, ObLo.ResultTypes.OBSERVATIONS_OK,
+                                    ObLo.ResultTypes.PARSE_FAILURE))
+        counters = session.metrics.summary()['counters']
+        self.assertTrue(counters['rows_inserted'] == stand_in.statistics['rows_inserted'])
+        self.assertTrue(counters['rows_inserted'] + counters['rows_rejected'] + counters['rows_skipped'] == 4010)
+        self.assertTrue(counters['rows_skipped'] == 10)
+        self.assertTrue(counters['retries'] == stand_in.statistics['errors_injected'])
+        self.assertTrue(stand_in.statistics['requests']['InsertResultTemplate'] == 1)
+        self.assertTrue(session.connections_opened <= session.pool_size)
+
+    def test_concurrent_series(self):
+        observations = "datetime,value\n" + "".join("2017-09-27T09:{:02d}:00,{}.0\n".format(minute, minute)
+                                                    for minute in range(10))
+
+        async def load_all(endpoint):
+            session = AsyncObservationLoader.AsyncSosSession(limits={endpoint: 3})
+            templates = AsyncObservationLoader.AsyncTemplateRegistry()
+            async with session:
+                return await asyncio.gather(*[AsyncObservationLoader.prepare_observations(
+                    io.StringIO(observations), 'test-procedure', 'test-property', 'test-offering-{}'.format(number),
+                    self.template_metadata, endpoint, session, templates=templates, chunk_size=4)
+                    for number in range(500)])
+
+        with StandInSos.StandInSos() as stand_in:
+            results = run_coroutine(load_all(stand_in.endpoint))
+
+        self.assertTrue(results == [ObLo.ResultTypes.OBSERVATIONS_OK] * 500)
+        self.assertTrue(stand_in.statistics['rows_inserted'] == 5000)
+        self.assertTrue(stand_in.statistics['max_in_flight'] <= 3)
+
+    def test_cancellation(self):
+        async def cancel(endpoint):
+            session = AsyncObservationLoader.AsyncSosSession()
+            load = asyncio.ensure_future(AsyncObservationLoader.prepare_observations(
+                'test-data.csv', 'test-procedure', 'test-property', 'test-offering', self.template_metadata,
+                endpoint, session))
+            await asyncio.sleep(0.3)
+            load.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await load
+
+            # The session is still usable once the load is cancelled
+            template_id = await AsyncObservationLoader.identify_template('test-property', 'test-offering', endpoint,
+                                                                         session)
+            session.close()
+            return template_id
+
+        with StandInSos.StandInSos(latency=0.05) as stand_in:
+            template_id = run_coroutine(cancel(stand_in.endpoint))
+            time.sleep(0.2)
+
+        self.assertTrue(template_id == 'test-property-test-offering')
+        self.assertTrue(0 < stand_in.statistics['rows_inserted'] < 4000)
+
+    def test_unreachable_endpoint(self):
+        async def load():
+            session = AsyncObservationLoader.AsyncSosSession(retry_policy=ObLo.RetryPolicy(retries=1, backoff=0.001))
+            return await AsyncObservationLoader.prepare_observations(
+                'test-data.csv', 'test-procedure', 'test-property', 'test-offering', self.template_metadata,
+                'http://127.0.0.1:1/service', session)
+
+        self.assertTrue(run_coroutine(load()) is ObLo.ResultTypes.ENDPOINT_FAILURE)
+
+    def test_failed_load_waits_for_read(self):
+        read_finished = threading.Event()
+
+        def observation_blocks(*args):
+            yield ObLo.ObservationArrays([1506502800], [1.0])
+            time.sleep(0.2)
+            read_finished.set()
+            raise ValueError('The second block does not parse.')
+
+        async def load(endpoint):
+            async with AsyncObservationLoader.AsyncSosSession() as session:
+                return await AsyncObservationLoader.prepare_observations(
+                    'test-data.csv', 'test-procedure', 'test-property', 'test-offering', self.template_metadata,
+                    endpoint, session, block_size=1)
+
+        # The send fails while the next block is being read, which the load waits for before it returns
+        refused = ObLo.SosRequestError('The SOS refused the InsertResult request.', ObLo.FailureTypes.FATAL, 400)
+        with patch.object(AsyncObservationLoader, '_observation_blocks', observation_blocks), \
+                patch.object(AsyncObservationLoader, 'save_observations', side_effect=refused):
+            with StandInSos.StandInSos() as stand_in:
+                result = run_coroutine(load(stand_in.endpoint))
+                self.assertTrue(read_finished.is_set())
+
+        self.assertTrue(result is ObLo.ResultTypes.ENDPOINT_FAILURE)
+
+    def test_chunked_response(self):
+        async def read(response):
+            reader = asyncio.StreamReader()
+            reader.feed_data(response)
+            reader.feed_eof()
+            return await AsyncObservationLoader._read_response(reader)
+
+        status, message, content, will_close = run_coroutine(read(
+            b'HTTP/1.1 200 OK\r\nContent-Type: application/json; charset=UTF-8\r\nTransfer-Encoding: chunked\r\n\r\n'
+            b'5\r\n{"a":\r\n3;ext=1\r\n 1}\r\n0\r\n\r\n'))
+        self.assertTrue((status, content, will_close) == (200, b'{"a": 1}', False))
+        self.assertTrue(message.get_content_charset() == 'utf-8')
+
+        with self.assertRaises(http.client.IncompleteRead):
+            run_coroutine(read(b'HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\n{}'))
+
+
+class TestInsertResultBody(unittest.TestCase):
+    def test_matches_json_encoding(self):
+        for result_values in ['2017-09-27T09:00:00,22.2#2017-09-27T09:04:00,nan',
+                              '2017-09-27T09:00:00\t22.2\n2017-09-27T09:04:00\t-1e-07',
+                              'quoted "value"#back\\slash#caf\u00e9']:
+            body = ObLo._insert_result_body('http://test.template', result_values)
+            self.assertTrue(json.loads(body.decode('utf-8')) == {"request": "InsertResult",
+                                                                 "service": "SOS",
+                                                                 "version": "2.0.0",
+                                                                 "templateIdentifier": "http://test.template",
+                                                                 "resultValues": result_values})
+
+
+class TestPostgresCopy(unittest.TestCase):
+    def test_copy_text(self):
+        text = PostgresLoader._copy_text(['1', '2'], '7', ['2017-01-01T00:00:00', '2017-01-01T01:00:00'])
+        self.assertTrue(text == '1\t7\t2017-01-01T00:00:00\n2\t7\t2017-01-01T01:00:00\n')
+
+    def test_copy_values(self):
+        values = PostgresLoader._copy_values(pd.Series([22.2, float('nan'), -1e-07]))
+        self.assertTrue(values == ['22.2', '\\N', '-1e-07'])
+
+    def test_observation_tables(self):
+        class PartitionCursor(object):
+            # Answers as a database whose observation table is partitioned by year, or is not
+            def __init__(self, partitioned):
+                self.partitioned = partitioned
+                self.row = None
+
+            def execute(self, statement, parameters=None):
+                if 'to_regprocedure' in statement:
+                    self.row = (self.partitioned,)
+                else:
+                    self.row = ('observation_y{}'.format(parameters[0].year),)
+
+            def fetchone(self):
+                return self.row
+
+        obs_times = np.array(['2016-12-31T22:00:00', '2017-01-01T00:00:00', '2016-12-31T23:00:00'],
+                             dtype='datetime64[s]')
+        self.assertTrue(PostgresLoader._observation_tables(PartitionCursor(False), obs_times) ==
+                        [('observation', None)])
+        self.assertTrue(PostgresLoader._observation_tables(PartitionCursor(True), obs_times) ==
+                        [('observation_y2016', [0, 2]), ('observation_y2017', [1])])
+        self.assertTrue(PostgresLoader._observation_tables(PartitionCursor(True), obs_times[[0, 2]]) ==
+                        [('observation_y2016', None)])
+
+    def test_psycopg2_missing(self):
+        with patch.object(PostgresLoader, 'psycopg2', None):
+            with self.assertRaises(ImportError):
+                PostgresLoader.connect('dbname=sos')
+
+
+@unittest.skipUnless(TEST_DSN and PostgresLoader.psycopg2, 'needs SOS_TEST_DSN and psycopg2')
+class TestPostgresBulkLoad(unittest.TestCase):
+    def setUp(self):
+        self.connection = PostgresLoader.connect(TEST_DSN)
+        # Every test loads a series of its own, so the database need not be emptied between runs
+        self.offering = 'http://www.52north.org/test/offering/bulk-{}-{}'.format(os.getpid(), time.time())
+        self.template_metadata = {'feature_identifier': self.offering + '/feature',
+                                  'feature_name': 'test-feature-name',
+                                  'feature_lat': 51,
+                                  'feature_lon': 7,
+                                  'result_name': 'test-result-name',
+                                  'result_definition': 'test-result-definition',
+                                  'result_unit': 'test-unit'}
+
+    def tearDown(self):
+        self.connection.close()
+
+    def load(self, observations, **options):
+        return PostgresLoader.bulk_load_observations(observations, self.offering + '/procedure',
+                                                     self.offering + '/property', self.offering,
+                                                     self.template_metadata, connection=self.connection, **options)
+
+    def stored(self):
+        with self.connection, self.connection.cursor() as cursor:
+            cursor.execute('SELECT count(*), count(DISTINCT o.phenomenontimestart), min(o.phenomenontimestart), '
+                           'max(o.phenomenontimestart), count(n.observationid), count(h.offeringid) '
+                           'FROM observation o JOIN series s ON s.seriesid = o.seriesid '
+                           'JOIN offering f ON f.offeringid = s.offeringid '
+                           'LEFT JOIN numericvalue n ON n.observationid = o.observationid '
+                           'LEFT JOIN observationhasoffering h ON h.observationid = o.observationid '
+                           'WHERE f.identifier = %s', (self.offering,))
+            return cursor.fetchone()
+
+    def series_range(self):
+        with self.connection, self.connection.cursor() as cursor:
+            cursor.execute('SELECT s.firsttimestamp, s.lasttimestamp, s.firstnumericvalue, s.lastnumericvalue '
+                           'FROM series s JOIN offering f ON f.offeringid = s.offeringid WHERE f.identifier = %s',
+                           (self.offering,))
+            return cursor.fetchall()
+
+    def test_load_creates_series(self):
+        observations = ObLo.read_observations('test-data.csv')
+        result = self.load('test-data.csv', batch_size=1000)
+
+        self.assertTrue(result is ObLo.ResultTypes.OBSERVATIONS_OK)
+        rows, distinct, first, last, values, offerings = self.stored()
+        self.assertTrue(rows == distinct == values == offerings == observations.shape[0])
+        self.assertTrue(first == observations['datetime'].min() and last == observations['datetime'].max())
+
+        series = self.series_range()
+        self.assertTrue(len(series) == 1)
+        self.assertTrue(series[0][:2] == (first, last))
+        self.assertTrue(series[0][2] == observations['value'].iloc[0])
+
+    def test_reload_skips_stored(self):
+        # A file overlapping the stored observations only adds the new ones, and a second load adds nothing
+        self.assertTrue(self.load(io.StringIO('datetime,value\n2017-01-01T01:00:00,1.0\n'
+                                              '2017-01-01T02:00:00,2.0\n')) is ObLo.ResultTypes.OBSERVATIONS_OK)
+        observations = io.StringIO('datetime,value\n2017-01-01T00:00:00,0.5\n2017-01-01T02:00:00,2.5\n'
+                                   '2017-01-01T03:00:00,3.0\n')
+        metrics = ObLo.LoaderMetrics()
+        self.assertTrue(self.load(observations, metrics=metrics) is ObLo.ResultTypes.OBSERVATIONS_OK)
+        self.assertTrue(metrics.counters['rows_inserted'] == 2 and metrics.counters['rows_skipped'] == 1)
+
+        observations.seek(0)
+        self.assertTrue(self.load(observations, block_size=1) is ObLo.ResultTypes.OBSERVATIONS_OK)
+        self.assertTrue(self.stored()[:2] == (4, 4))
+        self.assertTrue(self.series_range()[0][2:] == (0.5, 3.0))
+
+    def test_unreachable_database(self):
+        result = PostgresLoader.bulk_load_observations('test-data.csv', 'procedure', 'property', self.offering,
+                                                       self.template_metadata, dsn='host=/nonexistent dbname=sos')
+        self.assertTrue(result is ObLo.ResultTypes.ENDPOINT_FAILURE)
 
 
 if __name__ == '__main__':
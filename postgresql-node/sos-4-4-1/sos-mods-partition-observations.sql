@@ -0,0 +1,211 @@
+-- Partitions the observation table of a 4.4.1 database by the year of its phenomenon time, and indexes the time
+-- columns with BRIN rather than btree indexes.  It can be run on an empty database, as the Dockerfile does when its
+-- line adding this file is uncommented, or on a populated one with:
+--
+--     psql -v ON_ERROR_STOP=1 -d sos -f sos-mods-partition-observations.sql
+--
+-- The database is PostgreSQL 9.5, which has no declarative partitioning, so each year is a table inheriting from
+-- observation, named observation_y2017 and so on, with a CHECK constraint on its phenomenontimestart that lets the
+-- planner skip the years a query cannot match (constraint_exclusion = partition, the default).  Rows inserted into
+-- observation are routed to the table of their year by a trigger, which creates the table the first time a year is
+-- seen.  The trigger function is rewritten with a branch for each year table whenever one is created, so that each row
+-- is inserted by a statement whose plan is kept rather than planned again.  Bulk loads can skip the trigger and write
+-- straight into the table given by observation_partition(), as PostgresLoader.py does.
+--
+-- The routed row is also inserted into observation itself, and then deleted by a second trigger, so an INSERT still
+-- reports the row it inserted.  Hibernate checks that count, and a trigger returning NULL would fail every insert made
+-- by the SOS.
+--
+-- Each year table gets the indexes and the foreign keys of observation, and a primary key on observationid.  The
+-- phenomenontimestart, phenomenontimeend and resulttime btree indexes are replaced by BRIN indexes, which hold the
+-- range of times of every 16 pages, so they are a few pages per year rather than about a third of the size of the
+-- table, and cost little to keep up on insert.  They suit observations that arrive in time order.  A BRIN index only
+-- covers the pages that were full when it was last summarized, which autovacuum does, so run VACUUM after a large load.
+--
+-- Limits of the partitioned table:
+--   * The foreign keys of the value tables, observationhasoffering and the other tables referring to
+--     observation(observationid) are dropped, as a foreign key cannot refer to the rows of the year tables.  The
+--     observation of a value is no longer checked to exist.
+--   * observationid is only unique within a year, which the observationid_seq sequence the SOS and PostgresLoader.py
+--     take their ids from still guarantees.
+--   * An UPDATE cannot move an observation to another year.
+--   * Looking up an observation by its id probes the primary key of every year.
+
+BEGIN;
+
+-- The table of the year of a phenomenon time
+CREATE OR REPLACE FUNCTION observation_partition_name(phenomenontime timestamp without time zone)
+RETURNS text AS $$
+    SELECT 'observation_y' || to_char(phenomenontime, 'YYYY');
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Gives a year table the indexes and foreign keys of observation, and its primary key
+CREATE OR REPLACE FUNCTION index_observation_partition(partition text)
+RETURNS void AS $$
+DECLARE
+    definition record;
+BEGIN
+    EXECUTE format('ALTER TABLE %I ADD CONSTRAINT %I PRIMARY KEY (observationid)', partition, partition || '_pkey');
+
+    FOR definition IN
+        SELECT index_class.relname AS name, pg_get_indexdef(observation_index.indexrelid) AS statement
+        FROM pg_index observation_index JOIN pg_class index_class ON index_class.oid = observation_index.indexrelid
+        WHERE observation_index.indrelid = 'observation'::regclass AND NOT observation_index.indisprimary
+    LOOP
+        EXECUTE regexp_replace(definition.statement, '^CREATE (UNIQUE )?INDEX \S+ ON \S+ ',
+                               format('CREATE \1INDEX %I ON %I ', partition || '_' || definition.name, partition));
+    END LOOP;
+
+    FOR definition IN
+        SELECT conname AS name, pg_get_constraintdef(oid) AS statement
+        FROM pg_constraint
+        WHERE conrelid = 'observation'::regclass AND contype = 'f'
+    LOOP
+        EXECUTE format('ALTER TABLE %I ADD CONSTRAINT %I %s', partition, partition || '_' || definition.name,
+                       definition.statement);
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Rewrites the trigger function routing rows inserted into observation, with a branch for each year table, most
+-- recent first, and for other years a dynamic insert into the table of the year, creating it
+CREATE OR REPLACE FUNCTION write_observation_routing()
+RETURNS void AS $$
+DECLARE
+    branches text;
+    fallback text := $fallback$EXECUTE format('INSERT INTO %I SELECT ($1).*',
+                                              observation_partition(NEW.phenomenontimestart)) USING NEW;$fallback$;
+BEGIN
+    SELECT string_agg(format(E'NEW.phenomenontimestart >= %L AND NEW.phenomenontimestart < %L THEN\n' ||
+                             E'        INSERT INTO %I VALUES (NEW.*);',
+                             year_start, year_start + interval '1 year', name), E'\n    ELSIF '
+                      ORDER BY year_start DESC)
+    INTO branches
+    FROM (SELECT partition_class.relname AS name,
+                 to_timestamp(right(partition_class.relname, 4), 'YYYY')::timestamp without time zone AS year_start
+          FROM pg_inherits JOIN pg_class partition_class ON partition_class.oid = pg_inherits.inhrelid
+          WHERE pg_inherits.inhparent = 'observation'::regclass
+          AND partition_class.relname ~ '^observation_y[0-9]{4}$') partitions;
+
+    EXECUTE E'CREATE OR REPLACE FUNCTION route_observation()\nRETURNS trigger AS $route$\nBEGIN\n    '
+            || CASE WHEN branches IS NULL THEN fallback
+                    ELSE 'IF ' || branches || E'\n    ELSE\n        ' || fallback || E'\n    END IF;' END
+            || E'\n    RETURN NEW;\nEND;\n$route$ LANGUAGE plpgsql;';
+END;
+$$ LANGUAGE plpgsql;
+
+-- Creates the table of the year of a phenomenon time if it does not exist yet, indexed unless it is about to be
+-- filled in bulk, returning its name
+CREATE OR REPLACE FUNCTION create_observation_partition(phenomenontime timestamp without time zone,
+                                                        indexed boolean DEFAULT true)
+RETURNS text AS $$
+DECLARE
+    partition text := observation_partition_name(phenomenontime);
+    year_start timestamp without time zone := date_trunc('year', phenomenontime);
+BEGIN
+    -- Loads creating a year table at once take turns, the later ones finding the table made by the first
+    PERFORM pg_advisory_xact_lock('observation'::regclass::oid::bigint);
+    IF EXISTS (SELECT 1 FROM pg_class WHERE relname = partition AND pg_table_is_visible(oid)) THEN
+        RETURN partition;
+    END IF;
+
+    EXECUTE format('CREATE TABLE %I (CONSTRAINT %I CHECK (phenomenontimestart >= %L AND phenomenontimestart < %L)) '
+                   'INHERITS (observation)', partition, partition || '_phentimecheck', year_start,
+                   year_start + interval '1 year');
+    IF indexed THEN
+        PERFORM index_observation_partition(partition);
+    END IF;
+    PERFORM write_observation_routing();
+    RETURN partition;
+END;
+$$ LANGUAGE plpgsql;
+
+-- The table of the year of a phenomenon time, created if it does not exist yet
+CREATE OR REPLACE FUNCTION observation_partition(phenomenontime timestamp without time zone)
+RETURNS text AS $$
+DECLARE
+    partition text := observation_partition_name(phenomenontime);
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_class WHERE relname = partition AND pg_table_is_visible(oid)) THEN
+        PERFORM create_observation_partition(phenomenontime);
+    END IF;
+    RETURN partition;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Deletes a routed row from observation itself, once its statement has counted it
+CREATE OR REPLACE FUNCTION remove_routed_observation()
+RETURNS trigger AS $$
+BEGIN
+    DELETE FROM ONLY observation WHERE observationid = NEW.observationid;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Foreign keys cannot refer to the rows of the year tables
+DO $$
+DECLARE
+    reference record;
+BEGIN
+    FOR reference IN
+        SELECT conrelid::regclass AS referring, conname AS name
+        FROM pg_constraint
+        WHERE confrelid = 'observation'::regclass AND contype = 'f'
+    LOOP
+        EXECUTE format('ALTER TABLE %s DROP CONSTRAINT %I', reference.referring, reference.name);
+    END LOOP;
+END;
+$$;
+
+-- Move the stored observations into the tables of their years, indexing them once they are filled
+DO $$
+DECLARE
+    stored record;
+    partition text;
+BEGIN
+    FOR stored IN
+        SELECT DISTINCT date_trunc('year', phenomenontimestart) AS year_start FROM ONLY observation
+    LOOP
+        partition := create_observation_partition(stored.year_start, false);
+        EXECUTE format('INSERT INTO %I SELECT * FROM ONLY observation '
+                       'WHERE phenomenontimestart >= %L AND phenomenontimestart < %L', partition, stored.year_start,
+                       stored.year_start + interval '1 year');
+    END LOOP;
+    TRUNCATE ONLY observation;
+END;
+$$;
+
+DROP INDEX IF EXISTS obsphentimestartidx;
+DROP INDEX IF EXISTS obsphentimeendidx;
+DROP INDEX IF EXISTS obsresulttimeidx;
+CREATE INDEX obsphentimestartidx ON observation USING brin (phenomenontimestart) WITH (pages_per_range = 16);
+CREATE INDEX obsphentimeendidx ON observation USING brin (phenomenontimeend) WITH (pages_per_range = 16);
+CREATE INDEX obsresulttimeidx ON observation USING brin (resulttime) WITH (pages_per_range = 16);
+-- The observations of a series within a window of time, as GetObservation and GetResult ask for, are found from the
+-- series index without reading the rows of the series outside the window
+DROP INDEX IF EXISTS obsseriesidx;
+CREATE INDEX obsseriesidx ON observation USING btree (seriesid, phenomenontimestart);
+
+DO $$
+DECLARE
+    partition record;
+BEGIN
+    FOR partition IN
+        SELECT partition_class.relname AS name
+        FROM pg_inherits JOIN pg_class partition_class ON partition_class.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = 'observation'::regclass
+    LOOP
+        PERFORM index_observation_partition(partition.name);
+    END LOOP;
+    PERFORM write_observation_routing();
+END;
+$$;
+
+CREATE TRIGGER route_observation BEFORE INSERT ON observation
+    FOR EACH ROW EXECUTE PROCEDURE route_observation();
+CREATE TRIGGER remove_routed_observation AFTER INSERT ON observation
+    FOR EACH ROW EXECUTE PROCEDURE remove_routed_observation();
+
+COMMIT;
+
+ANALYZE observation;